@@ -0,0 +1,205 @@
+import queue
+import threading
+
+import chainer
+from chainer.dataset import convert
+
+import numpy
+
+
+def _get_arrays(dataset):
+    """Get arrays of a dataset, e.g., images and labels
+
+    Arrays of ``TupleDataset`` are used as they are (even if memory-mapped).
+    Other datasets are concatenated into arrays once.
+    """
+    arrays = getattr(dataset, '_datasets', None)
+    if arrays is not None and all(isinstance(array, numpy.ndarray)
+                                  for array in arrays):
+        return tuple(arrays)
+    arrays = convert.concat_examples(dataset)
+    if not isinstance(arrays, tuple):
+        arrays = (arrays,)
+    return arrays
+
+
+def concat_batch(batch, device=None, padding=None):
+    """Converter sending a batch of PrefetchIterator to a device
+
+    This replaces ``chainer.dataset.concat_examples``
+    as the converter of updaters and evaluators.
+    """
+    return tuple(convert.to_device(device, array) for array in batch)
+
+
+class PrefetchIterator(chainer.dataset.Iterator):
+    """Iterator assembling next batches in a background thread
+
+    Each batch is a tuple of arrays (e.g., images and labels)
+    gathered from arrays of the dataset by ``numpy.take``
+    into one of preallocated buffers, which are recycled.
+    ``transform`` (e.g., data augmentation) takes and returns the tuple
+    and is also applied in the thread.
+    A background thread keeps up to ``n_prefetch`` next batches ready,
+    so that their preparation overlaps with computation.
+    A returned batch is valid until the next call of ``next``.
+    Use :func:`concat_batch` as the converter.
+    """
+
+    def __init__(self, dataset, batch_size, repeat=True, shuffle=True,
+                 n_prefetch=2, transform=None, seed=None):
+        self.arrays = _get_arrays(dataset)
+        self.batch_size = batch_size
+        self._repeat = repeat
+        self._shuffle = shuffle
+        self.n_prefetch = n_prefetch
+        self.transform = transform
+        if seed is None:
+            seed = numpy.random.randint(2 ** 31)
+        self._random = numpy.random.RandomState(seed)
+        self._thread = None
+        self._returned = None
+        self.reset()
+
+    def reset(self):
+        self._stop()
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._previous_epoch_detail = -1.
+        self._order = self._new_order()
+
+    def _new_order(self):
+        if self._shuffle:
+            return self._random.permutation(len(self.arrays[0]))
+        return None
+
+    def _start(self):
+        self._buffers = queue.Queue()
+        for _ in range(self.n_prefetch + 2):
+            self._buffers.put(tuple(
+                numpy.empty((self.batch_size,) + array.shape[1:],
+                            dtype=array.dtype)
+                for array in self.arrays))
+        self._batches = queue.Queue(maxsize=self.n_prefetch)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._prefetch,
+            args=(self.current_position, self.epoch, self._order))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self._returned = None
+
+    def finalize(self):
+        self._stop()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _prefetch(self, position, epoch, order):
+        try:
+            n = len(self.arrays[0])
+            while not self._stopped.is_set():
+                if not self._repeat and epoch > 0:
+                    self._put(None)
+                    return
+                index = numpy.arange(position, min(position + self.batch_size,
+                                                   n))
+                if order is not None:
+                    index = order[index]
+                position += len(index)
+                if position >= n:
+                    epoch += 1
+                    order = self._new_order()
+                    position = 0
+                    if self._repeat and len(index) < self.batch_size:
+                        position = self.batch_size - len(index)
+                        rest = numpy.arange(position)
+                        if order is not None:
+                            rest = order[rest]
+                        index = numpy.concatenate([index, rest])
+
+                if len(index) == self.batch_size:
+                    buffers = None
+                    while buffers is None and not self._stopped.is_set():
+                        try:
+                            buffers = self._buffers.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+                    if buffers is None:
+                        return
+                    batch = tuple(
+                        numpy.take(array, index, axis=0, out=buffer)
+                        for array, buffer in zip(self.arrays, buffers))
+                else:
+                    # The last batch of an epoch without repeat
+                    buffers = None
+                    batch = tuple(numpy.take(array, index, axis=0)
+                                  for array in self.arrays)
+                if self.transform is not None:
+                    batch = tuple(self.transform(*batch))
+                if not self._put((batch, buffers, position, epoch, order)):
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def __next__(self):
+        if self._thread is None:
+            self._start()
+        if self._returned is not None:
+            self._buffers.put(self._returned)
+            self._returned = None
+        item = self._batches.get()
+        if item is None:
+            self._batches.put(None)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        batch, self._returned, position, epoch, self._order = item
+
+        self._previous_epoch_detail = self.epoch_detail
+        self.current_position = position
+        self.is_new_epoch = self.epoch < epoch
+        self.epoch = epoch
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + self.current_position * 1. / len(self.arrays[0])
+
+    @property
+    def previous_epoch_detail(self):
+        if self._previous_epoch_detail < 0:
+            return None
+        return self._previous_epoch_detail
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    def serialize(self, serializer):
+        if isinstance(serializer, chainer.serializer.Deserializer):
+            # Batches prefetched from the old state are dropped
+            self._stop()
+        self.current_position = serializer('current_position',
+                                           self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+        if self._order is not None:
+            serializer('order', self._order)
+        self._previous_epoch_detail = serializer(
+            'previous_epoch_detail', self._previous_epoch_detail)
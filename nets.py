@@ -1,3 +1,5 @@
+import os
+
 import numpy
 
 import chainer
@@ -11,6 +13,10 @@ import variational_dropout as VD
 
 class LeNet300100VD(VD.VariationalDropoutChain):
 
+    compact_layers = [('l1', None, F.relu),
+                      ('l2', None, F.relu),
+                      ('l3', None, None)]
+
     def __init__(self, warm_up=0.0001):
         super(LeNet300100VD, self).__init__(warm_up=warm_up)
         self.add_link('l1', VD.VariationalDropoutLinear(784, 300))
@@ -26,6 +32,11 @@ class LeNet300100VD(VD.VariationalDropoutChain):
 
 class LeNet5VD(VD.VariationalDropoutChain):
 
+    compact_layers = [('conv1', None, None),
+                      ('conv2', None, None),
+                      ('fc3', None, F.relu),
+                      ('fc4', None, None)]
+
     def __init__(self, warm_up=0.0001):
         super(LeNet5VD, self).__init__(warm_up=warm_up)
         self.add_link('conv1', VD.VariationalDropoutConvolution2D(1, 20, 5))
@@ -76,21 +87,122 @@ class Block(chainer.Chain):
         return F.relu(h)
 
 
+class CropFlip(object):
+
+    """Random crop and horizontal flip of a batch of images
+
+    Images are padded into a buffer, which is reused while the batch shape
+    is the same, and crops of all the images are gathered
+    from its strided view by one fancy indexing.
+    As in the original ``crop``, shifts are drawn from ``[0, 2 * pad)``.
+    Then, they are flipped with probability ``flip_ratio``.
+    This works on arrays of shape ``(N, C, H, W)`` in a model, or
+    on examples of a dataset by :meth:`transform`
+    (e.g., with ``chainer.datasets.TransformDataset`` in iterator workers).
+
+    Args:
+        pad (int): Width of padding, i.e., the maximum shift of crops.
+        flip_ratio (float): Probability of horizontal flips.
+        pad_value (float or array): Value of padding
+            (a value per channel if an array).
+
+    """
+
+    def __init__(self, pad=4, flip_ratio=0.5, pad_value=0.):
+        self.pad = pad
+        self.flip_ratio = flip_ratio
+        self.pad_value = pad_value
+        self._padded = None
+
+    def _pad(self, imgs, reuse=True):
+        xp = cuda.get_array_module(imgs)
+        n, c, h, w = imgs.shape
+        p = self.pad
+        shape = (n, c, h + p * 2, w + p * 2)
+        padded = self._padded if reuse else None
+        if padded is None or padded.shape != shape or \
+                padded.dtype != imgs.dtype or \
+                cuda.get_array_module(padded) is not xp:
+            padded = xp.empty(shape, dtype=imgs.dtype)
+            padded[...] = xp.asarray(
+                self.pad_value, dtype=imgs.dtype).reshape(-1, 1, 1)
+            if reuse:
+                self._padded = padded
+        # The border keeps the padding value
+        padded[:, :, p:p + h, p:p + w] = imgs
+        return padded
+
+    def __call__(self, imgs, reuse=True):
+        xp = cuda.get_array_module(imgs)
+        n, c, h, w = imgs.shape
+        n_shifts = max(self.pad * 2, 1)
+        padded = self._pad(imgs, reuse=reuse)
+        # A strided view of all the crops of each image
+        s = padded.strides
+        crops = xp.lib.stride_tricks.as_strided(
+            padded, shape=(n, n_shifts, n_shifts, c, h, w),
+            strides=(s[0], s[2], s[3], s[1], s[2], s[3]))
+        offsets = xp.random.randint(0, n_shifts, size=(n, 2))
+        cropped = crops[xp.arange(n), offsets[:, 0], offsets[:, 1]]
+        flip = xp.random.rand(n) < self.flip_ratio
+        cropped[flip] = cropped[flip, :, :, ::-1]
+        return cropped
+
+    def transform(self, in_data):
+        """Transform an example whose first element is an image
+
+        This does not reuse the buffer so that it can be called
+        from multiple threads.
+        """
+        img = self(in_data[0][None], reuse=False)[0]
+        return (img,) + tuple(in_data[1:])
+
+
 def crop(imgs):
-    PIXELS = 32
-    PAD_CROP = 4
-    xp = cuda.get_array_module(imgs)
-    cropped_imgs = xp.zeros(imgs.shape).astype('f')
-    padded_imgs = xp.pad(
-        imgs,
-        pad_width=((0, 0), (0, 0), (PAD_CROP, PAD_CROP), (PAD_CROP, PAD_CROP)),
-        mode='constant').astype('f')
-    for i, (x1, y1) in enumerate(
-            xp.random.randint(0, (PAD_CROP * 2), size=(imgs.shape[0], 2))):
-        x2 = x1 + PIXELS
-        y2 = y1 + PIXELS
-        cropped_imgs[i, :, :, :] = padded_imgs[i, :, x1:x2, y1:y2]
-    return cropped_imgs
+    return CropFlip(flip_ratio=0.)(imgs.astype('f', copy=False))
+
+
+def load_mean_std(class_labels=10):
+    """Load the mean and std of CIFAR-10 or 100 images"""
+    if class_labels == 10:
+        stats = numpy.load(open('cifar10_mean_std.npz', 'rb'))
+    else:
+        stats = numpy.load(open('cifar100_mean_std.npz', 'rb'))
+    return stats['mean'], stats['std']
+
+
+def get_normalized_cifar(class_labels=10, cache_dir='.'):
+    """Get CIFAR-10 or 100 train and test sets normalized for VGG16
+
+    Images normalized by the mean and std of ``load_mean_std``
+    are saved as float32 npy files in ``cache_dir`` at the first call
+    and memory-mapped at later calls.
+    Set ``normalize`` of the model False to use them.
+    """
+    prefix = os.path.join(cache_dir, 'cifar{}_normalized_'.format(
+        class_labels))
+    splits = ('train_x', 'train_t', 'test_x', 'test_t')
+    if not all(os.path.exists(prefix + split + '.npy') for split in splits):
+        if class_labels == 10:
+            train, test = chainer.datasets.get_cifar10()
+        else:
+            train, test = chainer.datasets.get_cifar100()
+        mean, std = load_mean_std(class_labels)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for name, dataset in (('train', train), ('test', test)):
+            x, t = chainer.dataset.concat_examples(dataset)
+            x -= mean[None, ]
+            x /= std[None, ]
+            for split, array in ((name + '_x', x), (name + '_t', t)):
+                # Write to a temporary file so that no partial file is used
+                tmp_path = prefix + split + '.tmp.npy'
+                numpy.save(tmp_path, array)
+                os.rename(tmp_path, prefix + split + '.npy')
+    arrays = [numpy.load(prefix + split + '.npy', mmap_mode='r')
+              for split in splits]
+    return (chainer.datasets.TupleDataset(arrays[0], arrays[1]),
+            chainer.datasets.TupleDataset(arrays[2], arrays[3]))
 
 
 class VGG16(chainer.Chain):
@@ -117,6 +229,15 @@ class VGG16(chainer.Chain):
 
     """
 
+    compact_layers = [('{}/conv'.format(block), '{}/bn'.format(block), F.relu)
+                      for block in ['block1_1', 'block1_2',
+                                    'block2_1', 'block2_2',
+                                    'block3_1', 'block3_2', 'block3_3',
+                                    'block4_1', 'block4_2', 'block4_3',
+                                    'block5_1', 'block5_2', 'block5_3']] + \
+        [('fc1', 'bn_fc1', F.relu),
+         ('fc2', None, None)]
+
     def __init__(self, class_labels=10):
         initializer = chainer.initializers.HeNormal()
         #initializer = utils.OutputHeNormal()
@@ -140,22 +261,36 @@ class VGG16(chainer.Chain):
                          initialW=initializer),
         )
         self.use_raw_dropout = False
-        if class_labels == 10:
-            stats = numpy.load(open('cifar10_mean_std.npz', 'rb'))
-        else:
-            stats = numpy.load(open('cifar100_mean_std.npz', 'rb'))
-        self.data_mean = stats['mean']
-        self.data_std = stats['std']
+        # Set None if images are augmented in the dataset
+        self.augment = CropFlip()
+        # Set False if images are normalized in the dataset
+        self.normalize = True
+        mean, std = load_mean_std(class_labels)
+        self.add_persistent('data_mean', mean)
+        self.add_persistent('data_std', std)
+
+    def serialize(self, serializer):
+        # Snapshots saved before the normalization constants
+        # became persistent do not have them
+        persistent = self._persistent
+        self._persistent = persistent - {'data_mean', 'data_std'}
+        try:
+            super(VGG16, self).serialize(serializer)
+        finally:
+            self._persistent = persistent
+        for name in ('data_mean', 'data_std'):
+            try:
+                serializer(name, getattr(self, name))
+            except KeyError:
+                pass
 
     def __call__(self, x):
         train = configuration.config.train
-        x = (x - self.xp.array(self.data_mean)[None, ]) \
-            / self.xp.array(self.data_std)[None, ]
-        if train:
-            # horizontal flips
-            flipped = x[:x.shape[0] // 2, :, :, ::-1]
-            x = self.xp.concatenate([flipped, x[x.shape[0] // 2:]], axis=0)
-            x = crop(x)
+        if self.normalize:
+            x = (x - self.data_mean[None, ]) / self.data_std[None, ]
+        if train and self.augment is not None:
+            # random crops and horizontal flips
+            x = self.augment(x)
 
         # 64 channel blocks:
         h = self.block1_1(x)
@@ -270,3 +405,30 @@ class RNNForLMVD(VD.VariationalDropoutChain, RNNForLM):
             delattr(self, 'l2')
             self.add_link('l2', VD.VariationalDropoutLSTM(
                 self.n_units, self.n_units))
+
+    @property
+    def n_step_available(self):
+        return isinstance(self.l1, VD.VariationalDropoutLSTM) and \
+            isinstance(self.l2, VD.VariationalDropoutLSTM)
+
+    def n_step_forward(self, xs):
+        """Forward a window of word IDs of shape (T, B) at once
+        This returns scores of shape (T * B, n_vocab).
+        """
+        n_step, batchsize = xs.shape
+        h0 = self.embed(xs)
+        if self.use_raw_dropout:
+            h0 = F.dropout(h0)
+        h1 = self.l1.n_step_forward(h0)
+        if self.use_raw_dropout:
+            h1 = F.dropout(h1)
+        h2 = self.l2.n_step_forward(h1)
+        if self.use_raw_dropout:
+            h2 = F.dropout(h2)
+        y = self.l3(F.reshape(h2, (n_step * batchsize, self.n_units)))
+        return y
+
+    def __call__(self, x):
+        if x.ndim == 2:
+            return self.n_step_forward(x)
+        return super(RNNForLMVD, self).__call__(x)
@@ -1,17 +1,232 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
 import warnings
 
 from chainer import cuda
 import chainer
 from chainer import configuration
+from chainer.utils import conv
 
 import numpy
 
 from scipy import sparse
 
 
+SPARSE_FORMATS = ('dense', 'csr', 'csc', 'bsr')
+
+
+def _pair(x):
+    if hasattr(x, '__getitem__'):
+        return x
+    return x, x
+
+
+def _bsr_blocksize(shape):
+    return tuple(max(b for b in (8, 4, 2, 1) if size % b == 0)
+                 for size in shape)
+
+
+def as_format(W, sparse_format):
+    """Convert a dense (masked) weight matrix into a format
+
+    ``sparse_format`` is one of 'dense', 'csr', 'csc' and 'bsr'.
+    Every format supports ``W.dot(x)``.
+    """
+    if sparse_format == 'dense':
+        return numpy.ascontiguousarray(W, dtype='f')
+    elif sparse_format == 'csr':
+        return sparse.csr_matrix(W)
+    elif sparse_format == 'csc':
+        return sparse.csc_matrix(W)
+    elif sparse_format == 'bsr':
+        return sparse.bsr_matrix(W, blocksize=_bsr_blocksize(W.shape))
+    else:
+        raise ValueError('Unknown sparse format: {}'.format(sparse_format))
+
+
+def count_nonzero(W):
+    if sparse.issparse(W):
+        return W.count_nonzero()
+    return numpy.count_nonzero(W)
+
+
+def autotune_sparse_format(link, W, x, formats=SPARSE_FORMATS, n_trials=5):
+    """Select the fastest format of W for forward of a link with input x
+
+    The link must have ``sparse_W`` used in ``forward_cpu_sparse``.
+    The winner and timings (the best of ``n_trials`` runs in seconds)
+    are stored as ``sparse_format`` and ``sparse_format_timings``.
+    """
+    timings = {}
+    for sparse_format in formats:
+        if sparse_format == 'bsr' and _bsr_blocksize(W.shape) == (1, 1):
+            continue  # the same as csr
+        link.sparse_W = as_format(W, sparse_format)
+        times = []
+        for i in range(n_trials):
+            start = time.time()
+            link.forward_cpu_sparse(x)
+            times.append(time.time() - start)
+        timings[sparse_format] = min(times)
+    link.sparse_format = min(timings, key=timings.get)
+    link.sparse_format_timings = timings
+    link.sparse_W = as_format(W, link.sparse_format)
+
+
+_thread_pools = {}
+
+
+def get_thread_pool(n_threads):
+    """Get a persistent thread pool shared by sparse links"""
+    if n_threads not in _thread_pools:
+        _thread_pools[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return _thread_pools[n_threads]
+
+
+def csr_row_shards(W, n_shards):
+    """Split a CSR matrix into row blocks with balanced nonzeros
+
+    Shards are views of values and indices of W without copy.
+    Returns a list of (start_row, end_row, shard).
+    """
+    rows = numpy.searchsorted(
+        W.indptr, numpy.linspace(0, W.nnz, n_shards + 1)[1:-1])
+    rows = [0] + sorted(set(int(r) for r in rows) - {0, W.shape[0]}) + \
+        [W.shape[0]]
+    shards = []
+    for start, end in zip(rows[:-1], rows[1:]):
+        p_start, p_end = W.indptr[start], W.indptr[end]
+        shards.append((start, end, sparse.csr_matrix(
+            (W.data[p_start:p_end], W.indices[p_start:p_end],
+             W.indptr[start:end + 1] - p_start),
+            shape=(end - start, W.shape[1]), copy=False)))
+    return shards
+
+
+def sharded_dot(link, X):
+    """Compute ``link.sparse_W.dot(X)`` with ``link.n_threads`` threads
+
+    scipy.sparse products release the GIL, so shards run in parallel
+    on a persistent thread pool and write into one output buffer.
+    A CSR matrix is split into row blocks with balanced nonzeros,
+    which are cached in the link.
+    Other sparse formats are split along columns of X (i.e., the batch).
+    Dense matrices are left to multithreaded BLAS.
+    """
+    W = link.sparse_W
+    n_threads = getattr(link, 'n_threads', 1)
+    if n_threads <= 1 or not sparse.issparse(W):
+        return W.dot(X)
+
+    X = numpy.ascontiguousarray(X)
+    Y = numpy.empty((W.shape[0], X.shape[1]), dtype='f')
+    if W.format == 'csr':
+        shards = getattr(link, '_csr_shards', None)
+        if shards is None or shards[0] is not W:
+            shards = (W, csr_row_shards(W, n_threads))
+            link._csr_shards = shards
+
+        def run(shard):
+            start, end, W_shard = shard
+            Y[start:end] = W_shard.dot(X)
+        jobs = shards[1]
+    else:
+        def run(columns):
+            start, end = columns
+            Y[:, start:end] = W.dot(X[:, start:end])
+        columns = numpy.linspace(0, X.shape[1], n_threads + 1).astype(int)
+        jobs = [(start, end) for start, end in zip(columns[:-1], columns[1:])
+                if start < end]
+    for _ in get_thread_pool(n_threads).map(run, jobs):
+        pass
+    return Y
+
+
+def save_sparse_matrix(prefix, W):
+    """Save a pruned weight matrix with the smallest encoding
+
+    Nonzero values are saved as float32 with either
+    CSR indices (int16 if possible, otherwise int32)
+    or a bitmask of nonzero positions, whichever is smaller.
+    Arrays are saved as ``prefix + '.<name>.npy'``
+    to be loaded with ``numpy.load(mmap_mode='r')``.
+    Returns metadata used in ``load_sparse_matrix``.
+    """
+    if sparse.issparse(W):
+        W = W.toarray()
+    W = numpy.asarray(W, dtype='f')
+    n_rows, n_cols = W.shape
+    is_nonzero = W != 0
+    n_nonzero = int(is_nonzero.sum())
+    index_dtype = numpy.int16 if n_cols <= 2 ** 15 else numpy.int32
+    indptr_dtype = numpy.int32 if n_nonzero < 2 ** 31 else numpy.int64
+
+    csr_bytes = n_nonzero * numpy.dtype(index_dtype).itemsize + \
+        (n_rows + 1) * numpy.dtype(indptr_dtype).itemsize
+    bitmask_bytes = (W.size + 7) // 8
+    if bitmask_bytes < csr_bytes:
+        numpy.save(prefix + '.bitmask.npy', numpy.packbits(is_nonzero))
+        numpy.save(prefix + '.data.npy', W[is_nonzero])
+        encoding = 'bitmask'
+    else:
+        sparse_W = sparse.csr_matrix(W)
+        numpy.save(prefix + '.data.npy', sparse_W.data.astype('f'))
+        numpy.save(prefix + '.indices.npy',
+                   sparse_W.indices.astype(index_dtype))
+        numpy.save(prefix + '.indptr.npy',
+                   sparse_W.indptr.astype(indptr_dtype))
+        encoding = 'csr'
+    return {'shape': [n_rows, n_cols], 'encoding': encoding}
+
+
+def load_sparse_matrix(prefix, meta, sparse_format=None, mmap_mode='r'):
+    """Load a pruned weight matrix saved by ``save_sparse_matrix``
+
+    With CSR encoding, values (and int32 indices) are memory-mapped
+    and shared without copy. int16 indices are widened at loading.
+    With bitmask encoding, a dense matrix is built.
+    If ``sparse_format`` is None, csr or dense is used
+    for CSR or bitmask encoding respectively.
+    """
+    shape = tuple(meta['shape'])
+    data = numpy.load(prefix + '.data.npy', mmap_mode=mmap_mode)
+    if meta['encoding'] == 'csr':
+        indices = numpy.load(prefix + '.indices.npy', mmap_mode=mmap_mode)
+        indptr = numpy.load(prefix + '.indptr.npy', mmap_mode=mmap_mode)
+        if indices.dtype == numpy.int16:
+            indices = indices.astype(numpy.int32)
+        W = sparse.csr_matrix((data, indices, indptr), shape=shape,
+                              copy=False)
+        default_format = 'csr'
+    elif meta['encoding'] == 'bitmask':
+        is_nonzero = numpy.unpackbits(
+            numpy.load(prefix + '.bitmask.npy', mmap_mode=mmap_mode),
+            count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        W = numpy.zeros(shape, dtype='f')
+        W[is_nonzero] = data
+        default_format = 'dense'
+    else:
+        raise ValueError('Unknown encoding: {}'.format(meta['encoding']))
+    if sparse_format is None or sparse_format == default_format:
+        return W, default_format
+    if sparse.issparse(W):
+        W = W.toarray()
+    return as_format(W, sparse_format), sparse_format
+
+
 class SparseLinearForwardCPU(chainer.links.Linear):
+    """Linear link with pruned weights for inference on CPU
+
+    ``sparse_format`` is one of 'dense', 'csr', 'csc', 'bsr' and 'auto'.
+    If 'auto', the fastest format at ``batch_size`` is selected
+    by benchmarking each candidate at initialization.
+    If None, csc (from NumPy weights) or csr (from CuPy weights) is used.
+    If ``n_threads`` > 1, sparse products are sharded over threads
+    (see ``sharded_dot``).
+    """
 
-    def __init__(self, old_linear, W_mask=None, with_dense=False):
+    def __init__(self, old_linear, W_mask=None, with_dense=False,
+                 sparse_format=None, batch_size=1, n_threads=1):
         W = old_linear.W.data
         b = getattr(old_linear, 'b', None)
         super(SparseLinearForwardCPU, self).__init__(
@@ -30,15 +245,46 @@ class SparseLinearForwardCPU(chainer.links.Linear):
             W_mask = xp.ones(W.shape).astype('f')
 
         if xp is numpy:
-            self.sparse_W = sparse.csc_matrix(W * W_mask)
+            W = W * W_mask
             if b is not None:
                 self.sparse_b = numpy.array(b).astype('f')
         else:
-            self.sparse_W = sparse.csr_matrix(
-                xp.asnumpy(W) * xp.asnumpy(W_mask))
+            W = xp.asnumpy(W) * xp.asnumpy(W_mask)
             if b is not None:
                 self.sparse_b = xp.asnumpy(b)[None, ]
 
+        self.n_threads = n_threads
+        if sparse_format is None:
+            sparse_format = 'csc' if xp is numpy else 'csr'
+        if sparse_format == 'auto':
+            x = numpy.random.rand(batch_size, W.shape[1]).astype('f')
+            autotune_sparse_format(self, W, x)
+        else:
+            self.sparse_format = sparse_format
+            self.sparse_W = as_format(W, sparse_format)
+
+    @classmethod
+    def from_arrays(cls, sparse_W, b=None, sparse_format='csr', n_threads=1):
+        """Make a link from a pruned weight matrix without dense parameters
+        """
+        link = cls.__new__(cls)
+        chainer.Link.__init__(link)
+        link.out_size = sparse_W.shape[0]
+        link.n_threads = n_threads
+        link.sparse_format = sparse_format
+        link.sparse_W = sparse_W
+        if b is not None:
+            link.sparse_b = numpy.array(b).astype('f')
+        return link
+
+    def forward_cpu_sparse(self, x):
+        if x.shape[0] == 1 and self.n_threads <= 1:
+            # matrix-vector product without transposes
+            y = self.sparse_W.dot(x[0])[None]
+        else:
+            y = sharded_dot(self, x.T).T
+        return y.astype('f') + getattr(self, 'sparse_b', 0.)
+
     def __call__(self, x):
         train = configuration.config.train
         if self.xp is numpy and not train:
@@ -46,8 +292,7 @@ class SparseLinearForwardCPU(chainer.links.Linear):
                 x = x.data
             if x.ndim > 2:
                 x = x.reshape(x.shape[0], x.size // x.shape[0])
-            return self.sparse_W.dot(x.T).T.astype('f') + \
-                getattr(self, 'sparse_b', 0.)
+            return self.forward_cpu_sparse(x)
         else:
             warnings.warn('SparseLinearForwardCPU link is made for'
                           ' inference usage. Sparse computation'
@@ -58,3 +303,118 @@ class SparseLinearForwardCPU(chainer.links.Linear):
                 return super(SparseLinearForwardCPU, self).__call__(x)
             else:
                 NotImplementedError
+
+
+class SparseConvolution2DForwardCPU(chainer.links.Convolution2D):
+    """Convolution link with pruned filters for inference on CPU
+
+    This computes im2col of inputs followed by a product
+    with the pruned filter matrix.
+    ``sparse_format`` is one of 'dense', 'csr', 'csc', 'bsr' and 'auto'.
+    If 'auto', the fastest format is selected by benchmarking
+    each candidate at the first call
+    because the product depends on the spatial size of inputs.
+    If None, csr is used.
+    If ``n_threads`` > 1, sparse products are sharded over threads
+    (see ``sharded_dot``).
+    """
+
+    def __init__(self, old_conv, W_mask=None, with_dense=False,
+                 sparse_format=None, n_threads=1):
+        W = old_conv.W.data
+        b = getattr(old_conv, 'b', None)
+        out_channels, in_channels, kh, kw = W.shape
+        super(SparseConvolution2DForwardCPU, self).__init__(
+            in_channels, out_channels, (kh, kw),
+            stride=old_conv.stride, pad=old_conv.pad, nobias=b is None)
+        self.W.data[:] = self.xp.array(W)
+        if b is not None:
+            b = b.data
+            self.b.data[:] = self.xp.array(b)
+        if not with_dense:
+            delattr(self, 'W')
+            if b is not None:
+                delattr(self, 'b')
+        self.kh, self.kw = kh, kw
+        self.sy, self.sx = _pair(old_conv.stride)
+        self.ph, self.pw = _pair(old_conv.pad)
+
+        xp = cuda.get_array_module(W)
+        if W_mask is None:
+            W_mask = xp.ones(W.shape).astype('f')
+
+        # Filters are flattened into (out_channels, in_channels * kh * kw)
+        # to be multiplied with im2col columns of inputs.
+        if xp is numpy:
+            W = (W * W_mask).reshape(out_channels, -1)
+            if b is not None:
+                self.sparse_b = numpy.array(b).astype('f')[None, :, None, None]
+        else:
+            W = (xp.asnumpy(W) * xp.asnumpy(W_mask)).reshape(
+                out_channels, -1)
+            if b is not None:
+                self.sparse_b = xp.asnumpy(b)[None, :, None, None]
+
+        self.n_threads = n_threads
+        if sparse_format is None:
+            sparse_format = 'csr'
+        self.sparse_format = sparse_format
+        if sparse_format == 'auto':
+            # Kept until autotuning at the first call.
+            self.sparse_W = W
+        else:
+            self.sparse_W = as_format(W, sparse_format)
+
+    @classmethod
+    def from_arrays(cls, sparse_W, ksize, stride=1, pad=0, b=None,
+                    sparse_format='csr', n_threads=1):
+        """Make a link from a pruned filter matrix without dense parameters
+
+        ``sparse_W`` is of shape (out_channels, in_channels * kh * kw).
+        """
+        link = cls.__new__(cls)
+        chainer.Link.__init__(link)
+        link.out_channels = sparse_W.shape[0]
+        link.n_threads = n_threads
+        link.ksize = ksize
+        link.stride = stride
+        link.pad = pad
+        link.kh, link.kw = _pair(ksize)
+        link.sy, link.sx = _pair(stride)
+        link.ph, link.pw = _pair(pad)
+        link.sparse_format = sparse_format
+        link.sparse_W = sparse_W
+        if b is not None:
+            link.sparse_b = numpy.array(b).astype('f')[None, :, None, None]
+        return link
+
+    def forward_cpu_sparse(self, x):
+        col = conv.im2col_cpu(x, self.kh, self.kw, self.sy, self.sx,
+                              self.ph, self.pw)
+        n, c, kh, kw, out_h, out_w = col.shape
+        col = col.transpose(1, 2, 3, 0, 4, 5).reshape(
+            c * kh * kw, n * out_h * out_w)
+        y = sharded_dot(self, col).astype('f', copy=False)
+        y = y.reshape(-1, n, out_h, out_w).transpose(1, 0, 2, 3)
+        if hasattr(self, 'sparse_b'):
+            y = y + self.sparse_b
+        return numpy.ascontiguousarray(y)
+
+    def __call__(self, x):
+        train = configuration.config.train
+        if self.xp is numpy and not train:
+            if isinstance(x, chainer.Variable):
+                x = x.data
+            if self.sparse_format == 'auto':
+                autotune_sparse_format(self, self.sparse_W, x)
+            return self.forward_cpu_sparse(x)
+        else:
+            warnings.warn('SparseConvolution2DForwardCPU link is made for'
+                          ' inference usage. Sparse computation'
+                          ' (scipy.sparse) computation is used'
+                          ' only in inference mode'
+                          ' rather than training mode.')
+            if hasattr(self, 'W'):
+                return super(SparseConvolution2DForwardCPU, self).__call__(x)
+            else:
+                NotImplementedError
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vd_functions as VDF  # NOQA
+
+
+class FixedNoiseEngine(object):
+    """Noise engine drawing the same noise for the same shape
+
+    Numerical gradients call a function many times,
+    so its noise has to be fixed over the calls.
+    """
+
+    def standard_normal(self, shape, dtype, xp=numpy):
+        noise = numpy.random.RandomState(sum(shape)).standard_normal(shape)
+        return xp.asarray(noise.astype(dtype))
+
+
+@pytest.fixture
+def fixed_noise():
+    engine = FixedNoiseEngine()
+    VDF.set_noise_engine(engine)
+    yield engine
+    VDF.set_noise_engine(None)
+
+
+@pytest.fixture(autouse=True)
+def clear_workspace_pool():
+    yield
+    VDF.get_workspace_pool().clear()
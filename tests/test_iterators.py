@@ -0,0 +1,72 @@
+import chainer
+from chainer.dataset import convert
+import numpy
+import pytest
+
+import iterators
+
+
+def _dataset(n=10):
+    x = numpy.arange(n * 3, dtype='f').reshape(n, 3)
+    t = numpy.arange(n, dtype=numpy.int32)
+    return chainer.datasets.TupleDataset(x, t)
+
+
+def _copy(batch):
+    # A batch is valid only until the next call
+    return tuple(array.copy() for array in batch)
+
+
+@pytest.mark.parametrize('repeat', [True, False])
+def test_prefetch_matches_serial(repeat):
+    dataset = _dataset()
+    it = iterators.PrefetchIterator(dataset, 4, repeat=repeat,
+                                    shuffle=False)
+    serial = chainer.iterators.SerialIterator(dataset, 4, repeat=repeat,
+                                              shuffle=False)
+    for expected in serial:
+        batch = iterators.concat_batch(it.next())
+        for array, expected_array in zip(batch, convert.concat_examples(
+                expected)):
+            numpy.testing.assert_array_equal(array, expected_array)
+        assert it.epoch == serial.epoch
+        assert it.is_new_epoch == serial.is_new_epoch
+        assert it.epoch_detail == serial.epoch_detail
+        if repeat and serial.epoch == 3:
+            break
+    else:
+        with pytest.raises(StopIteration):
+            it.next()
+    it.finalize()
+
+
+def test_prefetch_shuffle_and_transform():
+    dataset = _dataset()
+    it = iterators.PrefetchIterator(
+        dataset, 3, repeat=False, seed=0,
+        transform=lambda x, t: (x * 2, t))
+    xs, ts = zip(*[_copy(batch) for batch in it])
+    x, t = numpy.concatenate(xs), numpy.concatenate(ts)
+    assert sorted(t) == list(range(10))
+    numpy.testing.assert_array_equal(x, dataset._datasets[0][t] * 2)
+
+
+def test_prefetch_serialize():
+    dataset = _dataset(12)
+    it = iterators.PrefetchIterator(dataset, 4, seed=0)
+    for _ in range(4):
+        it.next()
+    serializer = chainer.serializers.DictionarySerializer()
+    it.serialize(serializer)
+    expected = [_copy(it.next()) for _ in range(2)]
+
+    resumed = iterators.PrefetchIterator(dataset, 4, seed=1)
+    resumed.serialize(chainer.serializers.NpzDeserializer(serializer.target))
+    assert resumed.epoch == 1 and resumed.current_position == 4
+    assert resumed.epoch_detail == pytest.approx(1 + 4 / 12.)
+    # Batches of the rest of the epoch follow the serialized order
+    for batch in expected:
+        for array, expected_array in zip(resumed.next(), batch):
+            numpy.testing.assert_array_equal(array, expected_array)
+    it.finalize()
+    resumed.finalize()
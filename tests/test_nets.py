@@ -0,0 +1,27 @@
+import numpy
+import pytest
+
+import nets
+
+
+@pytest.mark.parametrize('pad', [0, 1, 4])
+def test_crop_matches_baseline_shifts(pad):
+    imgs = numpy.random.RandomState(0).uniform(
+        -1, 1, (16, 3, 8, 8)).astype('f')
+    numpy.random.seed(1)
+    cropped = nets.CropFlip(pad=pad, flip_ratio=0.)(imgs)
+
+    numpy.random.seed(1)
+    shifts = numpy.random.randint(0, max(pad * 2, 1), size=(16, 2))
+    padded = numpy.pad(imgs, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                       mode='constant')
+    expected = numpy.stack([padded[i, :, y:y + 8, x:x + 8]
+                            for i, (y, x) in enumerate(shifts)])
+    numpy.testing.assert_array_equal(cropped, expected)
+
+
+def test_crop_flip_transform():
+    img = numpy.arange(2 * 4 * 4, dtype='f').reshape(2, 4, 4)
+    out, label = nets.CropFlip(pad=0, flip_ratio=1.).transform((img, 3))
+    numpy.testing.assert_array_equal(out, img[:, :, ::-1])
+    assert label == 3
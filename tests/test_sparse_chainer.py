@@ -0,0 +1,89 @@
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer import testing
+import numpy
+import pytest
+
+import sparse_chainer
+
+
+def _pruned(shape, seed=0):
+    rs = numpy.random.RandomState(seed)
+    W = rs.uniform(-1, 1, shape).astype('f')
+    W_mask = (rs.uniform(size=shape) > 0.7).astype('f')
+    return W, W_mask
+
+
+FORMATS = sparse_chainer.SPARSE_FORMATS + ('auto', )
+
+
+@pytest.mark.parametrize('sparse_format', FORMATS)
+@pytest.mark.parametrize('batch_size', [1, 5])
+def test_sparse_linear_forward(sparse_format, batch_size):
+    linear = L.Linear(6, 8)
+    W, W_mask = _pruned(linear.W.shape)
+    linear.W.array[...] = W
+    x = numpy.random.RandomState(2).uniform(
+        -1, 1, (batch_size, 6)).astype('f')
+
+    link = sparse_chainer.SparseLinearForwardCPU(
+        linear, W_mask=W_mask, sparse_format=sparse_format,
+        batch_size=batch_size)
+    assert link.sparse_format in sparse_chainer.SPARSE_FORMATS
+    with chainer.using_config('train', False):
+        y = link(x)
+    expected = x.dot((W * W_mask).T) + linear.b.array
+    testing.assert_allclose(y, expected, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize('sparse_format', FORMATS)
+@pytest.mark.parametrize('stride,pad', [(1, 0), (1, 1), (2, 1)])
+def test_sparse_convolution_2d_forward(sparse_format, stride, pad):
+    conv = L.Convolution2D(3, 4, 3, stride=stride, pad=pad)
+    W, W_mask = _pruned(conv.W.shape)
+    conv.W.array[...] = W
+    conv.b.array[...] = numpy.random.RandomState(1).uniform(-1, 1, 4)
+    x = numpy.random.RandomState(2).uniform(-1, 1, (2, 3, 7, 7)).astype('f')
+
+    link = sparse_chainer.SparseConvolution2DForwardCPU(
+        conv, W_mask=W_mask, sparse_format=sparse_format)
+    with chainer.using_config('train', False):
+        y = link(x)
+    assert link.sparse_format in sparse_chainer.SPARSE_FORMATS
+    expected = F.convolution_2d(x, W * W_mask, conv.b.array,
+                                stride=stride, pad=pad).array
+    testing.assert_allclose(y, expected, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize('n_shards', [1, 2, 3, 16])
+def test_csr_row_shards(n_shards):
+    W, W_mask = _pruned((10, 6))
+    csr = sparse_chainer.as_format(W * W_mask, 'csr')
+    shards = sparse_chainer.csr_row_shards(csr, n_shards)
+    assert shards[0][0] == 0 and shards[-1][1] == 10
+    for (_, end, _), (start, _, _) in zip(shards[:-1], shards[1:]):
+        assert end == start
+    testing.assert_allclose(
+        numpy.concatenate([shard.toarray() for _, _, shard in shards]),
+        W * W_mask)
+
+
+@pytest.mark.parametrize('sparse_format', sparse_chainer.SPARSE_FORMATS)
+@pytest.mark.parametrize('n_threads', [2, 3])
+def test_sharded_sparse_linear_forward(sparse_format, n_threads):
+    linear = L.Linear(6, 8)
+    W, W_mask = _pruned(linear.W.shape)
+    linear.W.array[...] = W
+    x = numpy.random.RandomState(2).uniform(-1, 1, (7, 6)).astype('f')
+
+    link = sparse_chainer.SparseLinearForwardCPU(
+        linear, W_mask=W_mask, sparse_format=sparse_format,
+        n_threads=n_threads)
+    with chainer.using_config('train', False):
+        y = link(x)
+        # Cached shards are reused
+        y2 = link(x)
+    expected = x.dot((W * W_mask).T) + linear.b.array
+    testing.assert_allclose(y, expected, atol=1e-5, rtol=1e-4)
+    testing.assert_allclose(y2, y)
@@ -0,0 +1,112 @@
+import copy
+
+import chainer
+from chainer import testing
+import numpy
+import pytest
+
+import nets
+import train_ptb
+import vd_functions as VDF
+
+
+class ZeroNoiseEngine(object):
+
+    def standard_normal(self, shape, dtype, xp=numpy):
+        return xp.zeros(shape, dtype=dtype)
+
+
+@pytest.fixture
+def zero_noise():
+    VDF.set_noise_engine(ZeroNoiseEngine())
+    yield
+    VDF.set_noise_engine(None)
+
+
+@pytest.mark.parametrize('n_iterations', [1, 4, 7])
+def test_next_words_matches_next(n_iterations):
+    dataset = numpy.random.RandomState(0).randint(0, 50, 23)
+    it = train_ptb.ParallelSequentialIterator(dataset, 3)
+    window_it = train_ptb.ParallelSequentialIterator(dataset, 3)
+    for _ in range(5):
+        words = window_it.next_words(n_iterations)
+        assert words.shape == (n_iterations + 1, 3)
+        assert words.dtype == numpy.int32
+        is_new_epoch = False
+        for i in range(n_iterations):
+            batch = it.__next__()
+            assert [tuple(pair) for pair in batch] == \
+                list(zip(words[i], words[i + 1]))
+            is_new_epoch |= it.is_new_epoch
+        assert window_it.iteration == it.iteration
+        assert window_it.epoch == it.epoch
+        # A window is in a new epoch if any of its iterations is
+        assert window_it.is_new_epoch == is_new_epoch
+
+
+def test_next_words_serialize():
+    dataset = numpy.arange(23)
+    it = train_ptb.ParallelSequentialIterator(dataset, 3)
+    it.next_words(9)
+    serializer = chainer.serializers.DictionarySerializer()
+    it.serialize(serializer)
+
+    resumed = train_ptb.ParallelSequentialIterator(dataset, 3)
+    resumed.serialize(chainer.serializers.NpzDeserializer(serializer.target))
+    assert resumed.iteration == 9 and resumed.epoch == 1
+    numpy.testing.assert_array_equal(resumed.next_words(5), it.next_words(5))
+
+
+def test_next_words_truncated_last_window():
+    # 10 words in 3 sequences are visited in ceil(10 / 3) = 4 iterations
+    dataset = numpy.arange(10)
+    it = train_ptb.ParallelSequentialIterator(dataset, 3, repeat=False)
+    batches = list(train_ptb.ParallelSequentialIterator(
+        dataset, 3, repeat=False))
+    assert len(batches) == 4
+
+    first = it.next_words(3)
+    last = it.next_words(3)
+    assert first.shape == (4, 3) and last.shape == (2, 3)
+    assert it.iteration == 4 and it.is_new_epoch and it.epoch == 1
+    numpy.testing.assert_array_equal(first[-1], last[0])
+    pairs = [list(zip(words[i], words[i + 1]))
+             for words in (first, last) for i in range(len(words) - 1)]
+    assert pairs == [[tuple(pair) for pair in batch] for batch in batches]
+    with pytest.raises(StopIteration):
+        it.next_words(3)
+
+
+def _updater(model, bprop_len):
+    optimizer = chainer.optimizers.Adam()
+    optimizer.setup(model)
+    train_iter = train_ptb.ParallelSequentialIterator(
+        numpy.arange(100) % 10, 3)
+    return train_ptb.BPTTUpdater(train_iter, optimizer, bprop_len, -1,
+                                 loss_func=model.calc_loss), optimizer
+
+
+@pytest.mark.parametrize('kl_coef', [0., 0.5, 0.999])
+def test_update_window_matches_update_steps(zero_noise, kl_coef):
+    bprop_len = 5
+    numpy.random.seed(0)
+    model = nets.RNNForLMVD(10, 4, warm_up=1e-3)
+    model.kl_coef = kl_coef
+    window_model = copy.deepcopy(model)
+    assert window_model.n_step_available
+    words = numpy.random.RandomState(1).randint(
+        0, 10, (bprop_len + 1, 3)).astype(numpy.int32)
+
+    updater, optimizer = _updater(model, bprop_len)
+    loss = updater.update_steps(words, optimizer)
+    loss.backward()
+    window_updater, window_optimizer = _updater(window_model, bprop_len)
+    window_loss = window_updater.update_window(words, window_optimizer)
+    window_loss.backward()
+
+    testing.assert_allclose(window_loss.array, loss.array, rtol=1e-5)
+    assert window_model.kl_coef == model.kl_coef
+    for (name, param), (_, window_param) in zip(
+            sorted(model.namedparams()), sorted(window_model.namedparams())):
+        numpy.testing.assert_allclose(window_param.grad, param.grad,
+                                      atol=1e-6, rtol=1e-4, err_msg=name)
@@ -0,0 +1,187 @@
+import json
+import os
+
+import chainer
+from chainer import testing
+import numpy
+import pytest
+
+import nets
+import variational_dropout as VD
+
+
+def _prune(model, seed=0, sparsity=None):
+    """Set log sigma^2 of VD links so that a part of weights are pruned
+
+    ``sparsity`` maps link names to ratios of pruned weights (0.3 otherwise).
+    """
+    rs = numpy.random.RandomState(seed)
+    sparsity = sparsity or {}
+    for name, link in sorted(model.namedlinks(skipself=True)):
+        if not getattr(link, 'is_variational_dropout', False):
+            continue
+        W = link.W.array
+        pruned = rs.uniform(size=W.shape) < sparsity.get(name, 0.3)
+        log_alpha = numpy.where(pruned, rs.uniform(4., 6., W.shape),
+                                rs.uniform(-4., 1., W.shape))
+        link.log_sigma2.array[...] = log_alpha + numpy.log(W * W + 1e-8)
+        VD.clear_vd_cache(link)
+    return model
+
+
+def _lenet5(seed=0):
+    numpy.random.seed(seed)
+    # fc3 is pruned enough to be saved with CSR indices
+    return _prune(nets.LeNet5VD(), seed, sparsity={'/fc3': 0.99})
+
+
+def _predict(model, x):
+    with chainer.using_config('train', False), \
+            chainer.no_backprop_mode():
+        y = model(x)
+    return getattr(y, 'array', y)
+
+
+@pytest.mark.parametrize('sparse_format', [None, 'dense', 'csr', 'auto'])
+def test_to_cpu_sparse(sparse_format):
+    model = _lenet5()
+    x = numpy.random.RandomState(1).uniform(0, 1, (3, 784)).astype('f')
+    expected = _predict(model, x)
+    model.to_cpu_sparse(sparse_format=sparse_format, batch_size=3)
+    testing.assert_allclose(_predict(model, x), expected,
+                            atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize('sparse_format', [None, 'dense', 'csr', 'auto'])
+def test_save_and_load_sparse(tmpdir, sparse_format):
+    model = _lenet5()
+    x = numpy.random.RandomState(1).uniform(0, 1, (3, 784)).astype('f')
+    expected = _predict(model, x)
+    path = str(tmpdir.join('model'))
+    model.save_sparse(path)
+    with open(os.path.join(path, 'model.json')) as f:
+        meta = json.load(f)
+    assert set(layer['encoding'] for layer in meta['layers'].values()) == \
+        {'bitmask', 'csr'}
+    assert not any('log_sigma2' in name for name in os.listdir(path))
+
+    loaded = nets.LeNet5VD()
+    loaded.load_sparse(path, sparse_format=sparse_format, batch_size=3)
+    testing.assert_allclose(_predict(loaded, x), expected,
+                            atol=1e-5, rtol=1e-4)
+
+
+def _lstm(in_size=6, out_size=4):
+    numpy.random.seed(0)
+    return _prune(VD.VariationalDropoutLSTM(in_size, out_size))
+
+
+def test_lstm_lateral_takes_input():
+    lstm = _lstm()
+    assert lstm.upward.W.shape == (16, 6)
+    assert lstm.lateral.W.shape == (16, 6)
+
+
+@pytest.mark.parametrize('every', [None, 1, 2])
+def test_lstm_n_step_forward_matches_steps(every):
+    lstm = _lstm()
+    xs = numpy.random.RandomState(1).uniform(-1, 1, (5, 3, 6)).astype('f')
+    with chainer.using_config('train', False), \
+            chainer.using_config('user_checkpoint_policy',
+                                 VD.CheckpointPolicy(every=every)):
+        expected = numpy.stack([lstm(x).array for x in xs])
+        expected_c = lstm.c.array
+        lstm.reset_state()
+        hs = lstm.n_step_forward(xs).array
+    testing.assert_allclose(hs, expected, atol=1e-6, rtol=1e-5)
+    testing.assert_allclose(lstm.c.array, expected_c, atol=1e-6, rtol=1e-5)
+
+
+@pytest.mark.parametrize('every', [None, 2])
+def test_tanh_rnn_n_step_forward_matches_steps(every):
+    numpy.random.seed(0)
+    rnn = _prune(VD.VariationalDropoutTanhRNN(6, 4))
+    xs = numpy.random.RandomState(1).uniform(-1, 1, (5, 3, 6)).astype('f')
+    with chainer.using_config('train', False), \
+            chainer.using_config('user_checkpoint_policy',
+                                 VD.CheckpointPolicy(every=every)):
+        expected = numpy.stack([rnn(x).array for x in xs])
+        rnn.reset_state()
+        hs = rnn.n_step_forward(xs).array
+    testing.assert_allclose(hs, expected, atol=1e-6, rtol=1e-5)
+
+
+def test_sparse_pattern_only_in_training():
+    numpy.random.seed(0)
+    linear = _prune(chainer.Sequential(VD.VariationalDropoutLinear(6, 8)),
+                    sparsity={'/0': 0.9})[0]
+    assert VD.get_sparse_pattern(linear) is None
+    with chainer.using_config('user_sparse_training_sparsity', 0.5):
+        assert VD.get_sparse_pattern(linear) is not None
+        with chainer.using_config('train', False):
+            assert VD.get_sparse_pattern(linear) is None
+
+
+def _snapshot(model, optimizer):
+    return {name: [param.array.copy()] +
+            [v.copy() for v in param.update_rule.state.values()]
+            for name, param in model.namedparams()}
+
+
+def test_mask_nan_update():
+    numpy.random.seed(0)
+    model = nets.LeNet300100VD()
+    optimizer = chainer.optimizers.Adam()
+    optimizer.setup(model)
+    hook = VD.MaskNaNUpdate()
+    optimizer.add_hook(hook)
+    optimizer.add_hook(chainer.optimizer.GradientClipping(10.))
+    rs = numpy.random.RandomState(1)
+    x = rs.uniform(0, 1, (4, 784)).astype('f')
+    t = rs.randint(0, 10, 4).astype(numpy.int32)
+    x_nan = x.copy()
+    x_nan[0, 0] = numpy.nan
+
+    optimizer.update(model.calc_loss, x, t)
+    before = _snapshot(model, optimizer)
+    with numpy.errstate(invalid='ignore'):
+        optimizer.update(model.calc_loss, x_nan, t)
+    assert not hook.ok and model.loss_ok is None
+    for name, arrays in _snapshot(model, optimizer).items():
+        for a, b in zip(arrays, before[name]):
+            numpy.testing.assert_array_equal(a, b, err_msg=name)
+    assert optimizer.t == 2
+
+    optimizer.update(model.calc_loss, x, t)
+    assert hook.ok
+    assert not any(numpy.array_equal(param.array, before[name][0])
+                   for name, param in model.namedparams())
+    assert all(numpy.isfinite(param.array).all()
+               for param in model.params())
+
+
+def test_stats_interval_per_mode():
+    numpy.random.seed(0)
+    model = _prune(nets.LeNet300100VD())
+    x = numpy.random.RandomState(1).uniform(0, 1, (2, 784)).astype('f')
+    t = numpy.array([1, 2], dtype=numpy.int32)
+    reporter = chainer.Reporter()
+    reporter.add_observer('main', model)
+
+    def calc_stats(train):
+        observation = {}
+        with reporter.scope(observation), \
+                chainer.using_config('train', train):
+            model.calc_loss(x, t)
+        return observation.get('main/nnz/l1')
+
+    with chainer.using_config('user_stats_interval', 3):
+        due = []
+        for i in range(7):
+            due.append(calc_stats(True))
+            calc_stats(False)
+    assert [nnz is not None for nnz in due] == \
+        [True, False, False, True, False, False, True]
+    assert isinstance(due[0], int)
+    clip_mask = VD.get_log_alpha_data(model.l1)[1]
+    assert due[0] == clip_mask.size - int(clip_mask.sum())
@@ -0,0 +1,285 @@
+import chainer
+import chainer.functions as F
+from chainer import gradient_check
+from chainer import testing
+import numpy
+import pytest
+
+import vd_functions as VDF
+
+EPS = 1e-8
+LOGA_THRESHOLD = 3.
+
+
+def _weights(shape, seed=0):
+    """W and log sigma^2 whose log alpha is away from thresholds and clips"""
+    rs = numpy.random.RandomState(seed)
+    W = rs.uniform(0.5, 1.5, shape) * rs.choice([-1., 1.], shape)
+    log_alpha = rs.uniform(-4., 1., shape)
+    pruned = rs.uniform(size=shape) < 0.3
+    log_alpha[pruned] = rs.uniform(4., 6., pruned.sum())
+    log_sigma2 = log_alpha + numpy.log(W * W + EPS)
+    return W, log_sigma2
+
+
+def _composite_weights(W, log_sigma2):
+    log_alpha = F.clip(log_sigma2 - F.log(W * W + EPS), -8., 8.)
+    keep = (log_alpha.array <= LOGA_THRESHOLD).astype(W.dtype)
+    clip_W = W * keep
+    return clip_W, F.exp(log_alpha) * clip_W * clip_W
+
+
+def _composite_linear(x, W, log_sigma2, b, noise):
+    clip_W, alpha_W2 = _composite_weights(W, log_sigma2)
+    mu = F.linear(x, clip_W, b)
+    si = F.sqrt(F.linear(x * x, alpha_W2) + EPS)
+    return mu + si * noise
+
+
+@pytest.mark.parametrize('dtype', [numpy.float32, numpy.float64])
+@pytest.mark.parametrize('pooled', [True, False])
+def test_vd_linear_with_log_alpha(fixed_noise, dtype, pooled):
+    W, log_sigma2 = [a.astype(dtype) for a in _weights((4, 3))]
+    x = numpy.random.RandomState(1).uniform(-1, 1, (5, 3)).astype(dtype)
+    b = numpy.random.RandomState(2).uniform(-1, 1, 4).astype(dtype)
+    gy = numpy.random.RandomState(3).uniform(-1, 1, (5, 4)).astype(dtype)
+    noise = fixed_noise.standard_normal((5, 4), dtype)
+
+    def f(x, W, log_sigma2, b):
+        return VDF.vd_linear_with_log_alpha(x, W, b, log_sigma2,
+                                            loga_threshold=LOGA_THRESHOLD)
+
+    with chainer.using_config('user_workspace_pool', pooled):
+        variables = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+        y = f(*variables)
+        y.grad = gy
+        y.backward()
+        expected = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+        y_expected = _composite_linear(*(expected + [noise]))
+        y_expected.grad = gy
+        y_expected.backward()
+
+    tol = {'atol': 1e-4, 'rtol': 1e-3} if dtype == numpy.float32 else {}
+    testing.assert_allclose(y.array, y_expected.array, **tol)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad, **tol)
+
+    if dtype == numpy.float64:
+        with chainer.using_config('user_workspace_pool', pooled):
+            gradient_check.check_backward(
+                f, (x, W, log_sigma2, b), gy, eps=1e-4)
+
+
+def test_vd_linear_with_log_alpha_precomputed(fixed_noise):
+    W, log_sigma2 = _weights((4, 3))
+    x = numpy.random.RandomState(1).uniform(-1, 1, (5, 3))
+    log_alpha = numpy.clip(log_sigma2 - numpy.log(W * W + EPS), -8., 8.)
+    y = VDF.vd_linear_with_log_alpha(x, W, None, log_sigma2,
+                                     log_alpha=log_alpha)
+    y_expected = VDF.vd_linear_with_log_alpha(x, W, None, log_sigma2)
+    testing.assert_allclose(y.array, y_expected.array)
+
+
+def test_vd_linear_with_log_alpha_eval():
+    W, log_sigma2 = _weights((4, 3))
+    x = numpy.random.RandomState(1).uniform(-1, 1, (5, 3))
+    with chainer.using_config('train', False):
+        y = VDF.vd_linear_with_log_alpha(x, W, None, log_sigma2)
+    clip_W = _composite_weights(chainer.Variable(W), log_sigma2)[0]
+    testing.assert_allclose(y.array, x.dot(clip_W.array.T))
+
+
+def _composite_convolution_2d(x, W, log_sigma2, b, noise, stride, pad):
+    clip_W, alpha_W2 = _composite_weights(W, log_sigma2)
+    mu = F.convolution_2d(x, clip_W, b, stride=stride, pad=pad)
+    si = F.sqrt(F.convolution_2d(x * x, alpha_W2, stride=stride, pad=pad) +
+                EPS)
+    return mu + si * noise
+
+
+@pytest.mark.parametrize('stride,pad', [(1, 0), (1, 1), (2, 1)])
+def test_vd_convolution_2d(fixed_noise, stride, pad):
+    W, log_sigma2 = _weights((4, 2, 3, 3))
+    x = numpy.random.RandomState(1).uniform(-1, 1, (2, 2, 5, 5))
+    b = numpy.random.RandomState(2).uniform(-1, 1, 4)
+
+    def f(x, W, log_sigma2, b):
+        return VDF.vd_convolution_2d(x, W, b, log_sigma2, stride=stride,
+                                     pad=pad, loga_threshold=LOGA_THRESHOLD)
+
+    variables = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+    y = f(*variables)
+    n, out_c, out_h, out_w = y.shape
+    gy = numpy.random.RandomState(3).uniform(-1, 1, y.shape)
+    y.grad = gy
+    y.backward()
+    # The function draws noise in the (n * out_h * out_w, out_c) layout
+    noise = fixed_noise.standard_normal(
+        (n * out_h * out_w, out_c), numpy.float64).reshape(
+            n, out_h, out_w, out_c).transpose(0, 3, 1, 2)
+    expected = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+    y_expected = _composite_convolution_2d(
+        *(expected + [noise, stride, pad]))
+    y_expected.grad = gy
+    y_expected.backward()
+
+    testing.assert_allclose(y.array, y_expected.array)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad)
+    gradient_check.check_backward(f, (x, W, log_sigma2, b), gy, eps=1e-4)
+
+
+def test_vd_convolution_2d_eval():
+    W, log_sigma2 = _weights((4, 2, 3, 3))
+    x = numpy.random.RandomState(1).uniform(-1, 1, (2, 2, 5, 5))
+    with chainer.using_config('train', False):
+        y = VDF.vd_convolution_2d(x, W, None, log_sigma2, pad=1)
+    clip_W = _composite_weights(chainer.Variable(W), log_sigma2)[0]
+    testing.assert_allclose(
+        y.array, F.convolution_2d(x, clip_W, pad=1).array)
+
+
+def test_vd_weights(fixed_noise):
+    W, log_sigma2 = _weights((4, 3))
+    g_clip_W, g_alpha_W2 = numpy.random.RandomState(3).uniform(
+        -1, 1, (2, 4, 3))
+
+    def f(W, log_sigma2):
+        return VDF.vd_weights(W, log_sigma2, loga_threshold=LOGA_THRESHOLD)
+
+    variables = [chainer.Variable(a) for a in (W, log_sigma2)]
+    expected = [chainer.Variable(a) for a in (W, log_sigma2)]
+    for outs in (f(*variables), _composite_weights(*expected)):
+        F.sum(outs[0] * g_clip_W + outs[1] * g_alpha_W2).backward()
+    for y, y_expected in zip(f(W, log_sigma2), _composite_weights(
+            chainer.Variable(W), log_sigma2)):
+        testing.assert_allclose(y.array, y_expected.array)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad)
+    gradient_check.check_backward(
+        f, (W, log_sigma2), (g_clip_W, g_alpha_W2), eps=1e-4)
+
+
+@pytest.mark.parametrize('bias', [True, False])
+def test_rnn_vd_linear(fixed_noise, bias):
+    rs = numpy.random.RandomState(1)
+    x = rs.uniform(-1, 1, (5, 3))
+    clip_W = rs.uniform(-1, 1, (4, 3))
+    alpha_W2 = rs.uniform(0.1, 1, (4, 3))
+    b = rs.uniform(-1, 1, 4)
+    gy = rs.uniform(-1, 1, (5, 4))
+    noise = fixed_noise.standard_normal((5, 4), numpy.float64)
+    inputs = (x, clip_W, alpha_W2, b) if bias else (x, clip_W, alpha_W2)
+
+    def f(*inputs):
+        return VDF.rnn_vd_linear(*inputs)
+
+    def composite(x, clip_W, alpha_W2, b=None):
+        return F.linear(x, clip_W, b) + \
+            F.sqrt(F.linear(x * x, alpha_W2) + EPS) * noise
+
+    variables = [chainer.Variable(a) for a in inputs]
+    expected = [chainer.Variable(a) for a in inputs]
+    for y in (f(*variables), composite(*expected)):
+        y.grad = gy
+        y.backward()
+    testing.assert_allclose(f(*inputs).array, composite(*inputs).array)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad)
+    gradient_check.check_backward(f, inputs, gy, eps=1e-4)
+
+
+def test_sparse_vd_linear(fixed_noise):
+    W, log_sigma2 = _weights((6, 5))
+    x = numpy.random.RandomState(1).uniform(-1, 1, (4, 5))
+    b = numpy.random.RandomState(2).uniform(-1, 1, 6)
+    gy = numpy.random.RandomState(3).uniform(-1, 1, (4, 6))
+    # The pattern has to hold all weights kept by the threshold
+    log_alpha = log_sigma2 - numpy.log(W * W + EPS)
+    pattern = VDF.SparsePattern(log_alpha <= LOGA_THRESHOLD + 1.)
+
+    def f(x, W, log_sigma2, b):
+        return VDF.vd_linear_with_log_alpha(x, W, b, log_sigma2,
+                                            loga_threshold=LOGA_THRESHOLD,
+                                            sparse_pattern=pattern)
+
+    variables = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+    expected = [chainer.Variable(a) for a in (x, W, log_sigma2, b)]
+    for y in (f(*variables), _composite_linear(*(expected + [
+            fixed_noise.standard_normal((4, 6), numpy.float64)]))):
+        y.grad = gy
+        y.backward()
+    testing.assert_allclose(
+        f(x, W, log_sigma2, b).array,
+        VDF.vd_linear_with_log_alpha(x, W, b, log_sigma2,
+                                     loga_threshold=LOGA_THRESHOLD).array)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad)
+    gradient_check.check_backward(f, (x, W, log_sigma2, b), gy, eps=1e-4)
+
+
+@pytest.mark.parametrize('mode', ['plain', 'flat', 'log_alphas'])
+def test_calculate_kl_all(mode):
+    shapes = [(4, 3), (2, 2, 3, 3), (5,)]
+    loga_thresholds = [3., 2., 3.]
+    Ws, log_sigma2s = zip(*[[a.astype(numpy.float32)
+                             for a in _weights(shape, seed=i)]
+                            for i, shape in enumerate(shapes)])
+    flat = log_alphas = None
+    if mode == 'flat':
+        flat = [numpy.concatenate([a.ravel() for a in arrays])
+                for arrays in (Ws, log_sigma2s)]
+        offsets = numpy.cumsum([0] + [W.size for W in Ws])
+        Ws, log_sigma2s = [
+            [buf[i:j].reshape(shape) for i, j, shape in
+             zip(offsets[:-1], offsets[1:], shapes)] for buf in flat]
+    elif mode == 'log_alphas':
+        log_alphas = [
+            numpy.clip(ls - numpy.log(W * W + EPS), -8., 8.)
+            for W, ls in zip(Ws, log_sigma2s)]
+
+    variables = [chainer.Variable(a) for a in Ws + log_sigma2s]
+    expected = [chainer.Variable(a.copy()) for a in Ws + log_sigma2s]
+    n = len(shapes)
+    kl = VDF.calculate_kl_all(variables[:n], variables[n:], loga_thresholds,
+                              flat=flat, log_alphas=log_alphas)
+    kl.backward()
+    kl_expected = sum(
+        VDF.compositional_calculate_kl(W, ls, loga_threshold=th)
+        for W, ls, th in zip(expected[:n], expected[n:], loga_thresholds))
+    kl_expected.backward()
+
+    testing.assert_allclose(kl.array, kl_expected.array)
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad, atol=1e-6, rtol=1e-4)
+
+
+def test_calculate_kl_all_backward():
+    shapes = [(4, 3), (2, 2, 3, 3)]
+    loga_thresholds = [3., 2.]
+    Ws, log_sigma2s = zip(*[_weights(shape, seed=i)
+                            for i, shape in enumerate(shapes)])
+
+    def f(*inputs):
+        return VDF.calculate_kl_all(inputs[:2], inputs[2:], loga_thresholds)
+
+    gradient_check.check_backward(
+        f, Ws + log_sigma2s, numpy.array(0.7), eps=1e-4)
+
+
+def test_calculate_kl():
+    W, log_sigma2 = _weights((4, 3))
+
+    def f(W, log_sigma2):
+        return VDF.calculate_kl(W, LOGA_THRESHOLD, log_sigma2=log_sigma2)
+
+    variables = [chainer.Variable(a.astype(numpy.float32))
+                 for a in (W, log_sigma2)]
+    expected = [chainer.Variable(v.array.copy()) for v in variables]
+    f(*variables).backward()
+    VDF.compositional_calculate_kl(
+        *expected, loga_threshold=LOGA_THRESHOLD).backward()
+    for v, e in zip(variables, expected):
+        testing.assert_allclose(v.grad, e.grad, atol=1e-6, rtol=1e-4)
+    gradient_check.check_backward(
+        f, (W, log_sigma2), numpy.array(0.7), eps=1e-4)
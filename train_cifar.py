@@ -14,7 +14,9 @@ from chainer.datasets import get_cifar10
 from chainer.datasets import get_cifar100
 chainer.using_config('cudnn_deterministic', True)
 
+import iterators
 import nets
+import variational_dropout as VD
 # VGG16VD
 
 
@@ -33,6 +35,22 @@ def main():
     parser.add_argument('--pretrain', default=0,
                         help='Pretrain (w/o VD) or not (w/ VD).' +
                         ' default is not (0).')
+    parser.add_argument('--augment', default='model',
+                        choices=('model', 'dataset'),
+                        help='Where to augment training images:'
+                        ' model (a batch at once on the device) or'
+                        ' dataset (each image in iterator threads)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches prepared (and augmented'
+                        ' with --augment dataset) by a background thread'
+                        ' (0: disabled)')
+    parser.add_argument('--sparse-training', type=float, default=0,
+                        help='Use sparse training kernels on CPU in VD linear'
+                        ' layers whose sparsity is over this (0: disabled)')
+    parser.add_argument('--cache', default='',
+                        help='Directory of a normalized copy of the dataset,'
+                        ' which is made at the first run and'
+                        ' memory-mapped later. Default is none.')
     parser.add_argument('--resume', '-r', default='',
                         help='Resume the training from snapshot')
     parser.add_argument('--resume-opt', '-ro', default='',
@@ -43,6 +61,9 @@ def main():
     print('# Minibatch-size: {}'.format(args.batchsize))
     print('# epoch: {}'.format(args.epoch))
     print('')
+    if args.sparse_training:
+        # VD linear layers switch to sparse kernels on CPU
+        chainer.config.user_sparse_training_sparsity = args.sparse_training
 
     # Set up a neural network to train.
     # Classifier reports softmax cross entropy loss and accuracy at every
@@ -50,13 +71,17 @@ def main():
     if args.dataset == 'cifar10':
         print('Using CIFAR10 dataset.')
         class_labels = 10
-        train, test = get_cifar10()
     elif args.dataset == 'cifar100':
         print('Using CIFAR100 dataset.')
         class_labels = 100
-        train, test = get_cifar100()
     else:
         raise RuntimeError('Invalid dataset choice.')
+    if args.cache:
+        train, test = nets.get_normalized_cifar(class_labels, args.cache)
+    elif class_labels == 10:
+        train, test = get_cifar10()
+    else:
+        train, test = get_cifar100()
     print('# train:', len(train))
     print('# test :', len(test))
 
@@ -83,9 +108,16 @@ def main():
         model(train[0][0][None, ])  # for setting in_channels automatically
         model.to_variational_dropout()
 
+    if args.cache:
+        # Images are already normalized
+        model.normalize = False
+
     if args.gpu >= 0:
         chainer.cuda.get_device(args.gpu).use()  # Make a specified GPU current
         model.to_gpu()  # Copy the model to the GPU
+    if not args.pretrain:
+        # KL of all VD layers is computed over flat buffers at once
+        model.flatten_vd_params()
 
     if args.pretrain:
         # Original Torch code (http://torch.ch/blog/2015/07/30/cifar.html)
@@ -97,12 +129,34 @@ def main():
     elif args.resume:
         optimizer = chainer.optimizers.Adam(1e-5)
         optimizer.setup(model)
+        optimizer.add_hook(VD.MaskNaNUpdate())
     else:
         optimizer = chainer.optimizers.Adam(1e-4)
         optimizer.setup(model)
+        # Updates at NaN losses are cancelled without synchronization
+        optimizer.add_hook(VD.MaskNaNUpdate())
         optimizer.add_hook(chainer.optimizer.GradientClipping(10.))
 
-    train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
+    if args.augment == 'dataset':
+        # Pad raw images with the mean, which is zero after normalization
+        augment = nets.CropFlip(pad_value=0. if args.cache else
+                                chainer.cuda.to_cpu(model.data_mean).mean(
+                                    axis=(1, 2)))
+        model.augment = None
+    converter = chainer.dataset.concat_examples
+    if args.prefetch > 0:
+        # Batches are gathered (and augmented) in a background thread
+        train_iter = iterators.PrefetchIterator(
+            train, args.batchsize, n_prefetch=args.prefetch,
+            transform=(lambda x, t: (augment(x), t))
+            if args.augment == 'dataset' else None)
+        converter = iterators.concat_batch
+    elif args.augment == 'dataset':
+        train_iter = chainer.iterators.MultithreadIterator(
+            chainer.datasets.TransformDataset(train, augment.transform),
+            args.batchsize)
+    else:
+        train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
     test_iter = chainer.iterators.SerialIterator(test, args.batchsize,
                                                  repeat=False, shuffle=False)
 
@@ -114,7 +168,8 @@ def main():
 
     # Set up a trainer
     updater = training.StandardUpdater(
-        train_iter, optimizer, device=args.gpu, loss_func=model.calc_loss)
+        train_iter, optimizer, device=args.gpu, converter=converter,
+        loss_func=model.calc_loss)
     trainer = training.Trainer(updater, (args.epoch, 'epoch'), out=args.out)
 
     # Evaluate the model with the test dataset for each epoch
@@ -139,6 +194,10 @@ def main():
     # Write a log of evaluation statistics for each epoch
     # trainer.extend(extensions.LogReport())
     per = min(len(train) // args.batchsize // 2, 1000)
+    if not args.pretrain:
+        # Accumulate metrics on the device and report them at each log
+        trainer.extend(VD.AccumulatedReport(
+            model, trigger=(per, 'iteration')))
     trainer.extend(extensions.LogReport(trigger=(per, 'iteration')))
 
     # Print selected entries of the log to stdout
@@ -179,7 +238,7 @@ def main():
             test_iter, classifier, device=-1)()['main/accuracy']
         print('dense Cpu:', time.time() - start, 's/{} imgs'.format(len(test)))
 
-        model.to_cpu_sparse()
+        model.to_cpu_sparse(sparse_format='auto', batch_size=1)
         model.name = None
         classifier = L.Classifier(copy.deepcopy(model))
         start = time.time()
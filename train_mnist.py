@@ -11,7 +11,10 @@ import chainer.links as L
 from chainer import training
 from chainer.training import extensions
 
+import iterators
 import nets
+import variational_dropout as VD
+import vd_functions as VDF
 
 
 def main():
@@ -30,12 +33,25 @@ def main():
                         help='Resume the training from snapshot')
     parser.add_argument('--model', default='fc',
                         help='Model type from [fc, conv, lenet300100, lenet5]')
+    parser.add_argument('--prefill', type=int, default=4,
+                        help='Number of noise blocks pre-filled '
+                             'by a background thread on CPU (0: disabled)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches prepared '
+                             'by a background thread (0: disabled)')
+    parser.add_argument('--sparse-training', type=float, default=0,
+                        help='Use sparse training kernels on CPU in VD '
+                             'linear layers whose sparsity is over this '
+                             '(0: disabled)')
     args = parser.parse_args()
 
     print('GPU: {}'.format(args.gpu))
     print('# Minibatch-size: {}'.format(args.batchsize))
     print('# epoch: {}'.format(args.epoch))
     print('')
+    if args.sparse_training:
+        # VD linear layers switch to sparse kernels on CPU
+        chainer.config.user_sparse_training_sparsity = args.sparse_training
 
     if args.model in ['fc', 'lenet300100']:
         model = nets.LeNet300100VD(warm_up=0.001)
@@ -47,6 +63,10 @@ def main():
     if args.gpu >= 0:
         chainer.cuda.get_device(args.gpu).use()  # Make a specified GPU current
         model.to_gpu()  # Copy the model to the GPU
+    elif args.prefill > 0:
+        VDF.set_noise_engine(VDF.NoiseEngine(n_prefill_blocks=args.prefill))
+    # KL of all VD layers is computed over flat buffers at once
+    model.flatten_vd_params()
 
     # Setup an optimizer
     optimizer = chainer.optimizers.Adam(alpha=1e-3)
@@ -57,16 +77,25 @@ def main():
     # and finetunes it for 10-30 epochs
     # with variational dropout and learning rate=1e-5.
     optimizer.setup(model)
+    # Updates at NaN losses are cancelled without synchronization
+    optimizer.add_hook(VD.MaskNaNUpdate())
 
     # Load the MNIST dataset
     train, test = chainer.datasets.get_mnist()
 
-    train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
+    if args.prefetch > 0:
+        train_iter = iterators.PrefetchIterator(
+            train, args.batchsize, n_prefetch=args.prefetch)
+        converter = iterators.concat_batch
+    else:
+        train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
+        converter = chainer.dataset.concat_examples
     test_iter = chainer.iterators.SerialIterator(test, args.batchsize,
                                                  repeat=False, shuffle=False)
 
     # Set up a trainer
     updater = training.StandardUpdater(train_iter, optimizer, device=args.gpu,
+                                       converter=converter,
                                        loss_func=model.calc_loss)
     trainer = training.Trainer(updater, (args.epoch, 'epoch'), out=args.out)
 
@@ -84,6 +113,8 @@ def main():
 
     # Write a log of evaluation statistics for each epoch
     per = min(len(train) // args.batchsize // 2, 1000)
+    # Accumulate metrics on the device and report them at each log
+    trainer.extend(VD.AccumulatedReport(model, trigger=(per, 'iteration')))
     trainer.extend(extensions.LogReport(trigger=(per, 'iteration')))
 
     # Print selected entries of the log to stdout
@@ -126,7 +157,7 @@ def main():
         test_iter, classifier, device=-1)()['main/accuracy']
     print('dense Cpu:', time.time() - start, 's/{} imgs'.format(len(test)))
 
-    model.to_cpu_sparse()
+    model.to_cpu_sparse(sparse_format='auto', batch_size=1)
     model.name = None
     classifier = L.Classifier(copy.deepcopy(model))
     start = time.time()
@@ -8,6 +8,7 @@ https://github.com/tomsercu/lstm
 from __future__ import division
 from __future__ import print_function
 import argparse
+import time
 
 import numpy as np
 
@@ -20,6 +21,7 @@ from chainer import training
 from chainer.training import extensions
 
 import nets
+import variational_dropout as VD
 
 
 # Dataset iterator to create a batch of sequences at different positions.
@@ -38,11 +40,13 @@ class ParallelSequentialIterator(chainer.dataset.Iterator):
         # True if the epoch is incremented at the last iteration.
         self.is_new_epoch = False
         self.repeat = repeat
+        # Word IDs are gathered from this array by fancy indexing.
+        self.words = np.asarray(dataset, dtype=np.int32)
         length = len(dataset)
         # Offsets maintain the position of each sequence in the mini-batch.
-        self.offsets = [i * length // batch_size for i in range(batch_size)]
+        self.offsets = np.arange(batch_size) * length // batch_size
         # NOTE: this is not a count of parameter updates. It is just a count of
-        # calls of ``__next__``.
+        # calls of ``__next__`` (or of iterations of ``next_words``).
         self.iteration = 0
 
     def __next__(self):
@@ -52,32 +56,42 @@ class ParallelSequentialIterator(chainer.dataset.Iterator):
         # "current" position, while the second word at the next position.
         # At each iteration, the iteration count is incremented, which pushes
         # forward the "current" position.
+        words = self.next_words(1)
+        return list(zip(words[0], words[1]))
+
+    def next_words(self, n_iterations):
+        # This returns an int32 array of shape (n_iterations + 1, batch_size)
+        # of the words at the current position and n_iterations positions
+        # after it, i.e., the inputs (words[:-1]) and targets (words[1:])
+        # of n_iterations iterations at once. Without repeat, the last window
+        # has fewer iterations if the epoch ends in it.
         length = len(self.dataset)
-        if not self.repeat and self.iteration * self.batch_size >= length:
+        if not self.repeat:
             # If not self.repeat, this iterator stops at the end of the first
-            # epoch (i.e., when all words are visited once).
-            raise StopIteration
-        cur_words = self.get_words()
-        self.iteration += 1
-        next_words = self.get_words()
+            # epoch (i.e., when all words are visited once),
+            # and the last window is truncated there.
+            n_iterations = min(
+                n_iterations,
+                -(-length // self.batch_size) - self.iteration)
+            if n_iterations <= 0:
+                raise StopIteration
+        positions = self.iteration + np.arange(n_iterations + 1)
+        words = self.words[
+            (positions[:, None] + self.offsets[None, :]) % length]
+        self.iteration += n_iterations
 
         epoch = self.iteration * self.batch_size // length
         self.is_new_epoch = self.epoch < epoch
         if self.is_new_epoch:
             self.epoch = epoch
 
-        return list(zip(cur_words, next_words))
+        return words
 
     @property
     def epoch_detail(self):
         # Floating point version of epoch.
         return self.iteration * self.batch_size / len(self.dataset)
 
-    def get_words(self):
-        # It returns a list of current words.
-        return [self.dataset[(offset + self.iteration) % len(self.dataset)]
-                for offset in self.offsets]
-
     def serialize(self, serializer):
         # It is important to serialize the state to be recovered on resume.
         self.iteration = serializer('iteration', self.iteration)
@@ -88,67 +102,120 @@ class ParallelSequentialIterator(chainer.dataset.Iterator):
 class BPTTUpdater(training.StandardUpdater):
 
     def __init__(self, train_iter, optimizer, bprop_len, device,
-                 loss_func=None, decay_iter=(0, 0)):
+                 loss_func=None, decay_iter=(0, 0), peak_memory_interval=0):
         super(BPTTUpdater, self).__init__(
             train_iter, optimizer, device=device, loss_func=loss_func)
         self.bprop_len = bprop_len
+        # Measure the peak memory of every k-th update (0: never)
+        self.peak_memory_interval = peak_memory_interval
         self.decay_iter_start, self.decay_iter_span = decay_iter
         self.decay_iter_start *= bprop_len
         self.decay_iter_span *= bprop_len
 
     # The core part of the update routine can be customized by overriding.
     def update_core(self):
-        loss = 0
         # When we pass one iterator and optimizer to StandardUpdater.__init__,
         # they are automatically named 'main'.
         train_iter = self.get_iterator('main')
         optimizer = self.get_optimizer('main')
 
-        # Progress the dataset iterator for bprop_len words at each iteration.
-        for i in range(self.bprop_len):
-            # Get the next batch (a list of tuples of two word IDs)
-            batch = train_iter.__next__()
+        self.synchronize(optimizer)
+        start = time.time()
+        words = self.next_words(train_iter, optimizer)
+        self.synchronize(optimizer)
+        data_time = time.time() - start
+
+        observation = {'time/data': data_time}
+        policy = configuration.config.user_checkpoint_policy
+        if self.peak_memory_interval and \
+                self.iteration % self.peak_memory_interval == 0:
+            # Tracing memory slows the update down,
+            # so this update is not timed
+            with VD.PeakMemory(gpu=optimizer.target.xp is not np) as memory:
+                self.update_params(words, optimizer)
+            observation['peak_memory'] = memory.peak
+            if policy is not None:
+                policy.pop_stats()
+        else:
+            start = time.time()
+            self.update_params(words, optimizer)
+            self.synchronize(optimizer)
+            observation['time/compute'] = time.time() - start
+            if policy is not None:
+                observation.update(policy.pop_stats())
+        observation['lr'] = getattr(
+            optimizer, 'lr', getattr(optimizer, 'alpha', None))
+        reporter.report(observation, optimizer.target)
+
+    def synchronize(self, optimizer):
+        # Wait for GPU kernels so that the clock includes them
+        if optimizer.target.xp is not np:
+            chainer.cuda.Device().synchronize()
+
+    def update_params(self, words, optimizer):
+        if getattr(optimizer.target, 'n_step_available', False):
+            loss = self.update_window(words, optimizer)
+        else:
+            loss = self.update_steps(words, optimizer)
+
+        optimizer.target.cleargrads()  # Clear the parameter gradients
+        loss.backward()  # Backprop
+        loss.unchain_backward()  # Truncate the graph
+        optimizer.update()  # Update the parameters
 
-            # Concatenate the word IDs to matrices and send them to the device
-            # self.converter does this job
-            # (it is chainer.dataset.concat_examples by default)
-            x, t = self.converter(batch, self.device)
+    def next_words(self, train_iter, optimizer):
+        # Get the words of the whole window as one array
+        # and send it to the device at once
+        start = train_iter.iteration
+        words = train_iter.next_words(self.bprop_len)
+        for iteration in range(start + 1, start + self.bprop_len + 1):
+            self.decay_lr(iteration, optimizer)
+        return chainer.dataset.to_device(self.device, words)
+
+    def decay_lr(self, iteration, optimizer):
+        if self.decay_iter_span != 0 and \
+           (hasattr(optimizer, 'lr') and not hasattr(optimizer, 'alpha')):
+            if iteration >= self.decay_iter_start and \
+                    iteration % self.decay_iter_span == 0:
+                setattr(optimizer, 'lr', optimizer.lr / 1.2)
+                print('lr: {} -> {}'.format(
+                    optimizer.lr * 1.2, optimizer.lr))
+
+    def update_window(self, words, optimizer):
+        # Forward the whole window of bprop_len words at once
+        # by the sequence-level API of the model.
+        x = words[:-1]
+        t = words[1:].reshape(-1)
+
+        # The loss is the mean over the window;
+        # scale it to the sum over timesteps as in update_steps,
+        # where KL is added and warmed up at every timestep.
+        class_loss, kl_loss = self.loss_func(x, t, split_loss=True,
+                                             calc_stats=True,
+                                             kl_steps=self.bprop_len)
+        return (class_loss + kl_loss) * self.bprop_len
+
+    def update_steps(self, words, optimizer):
+        loss = 0
+        for i in range(self.bprop_len):
+            # Slice views of the word IDs of the current and next words
+            # (functions take arrays without wrapping them in Variables)
+            x, t = words[i], words[i + 1]
 
             # Compute the loss at this time step and accumulate it
             if getattr(optimizer.target, 'is_variational_dropout', False):
                 if i == 0:
-                    class_loss, kl_loss = self.loss_func(chainer.Variable(x),
-                                                         chainer.Variable(t),
+                    class_loss, kl_loss = self.loss_func(x, t,
                                                          split_loss=True,
                                                          calc_stats=True)
                     loss += class_loss
                     loss += kl_loss * self.bprop_len
                 else:
-                    loss += self.loss_func(chainer.Variable(x),
-                                           chainer.Variable(t),
-                                           add_kl=False,
+                    loss += self.loss_func(x, t, add_kl=False,
                                            calc_stats=False)
             else:
-                loss += self.loss_func(chainer.Variable(x),
-                                       chainer.Variable(t))
-
-            if self.decay_iter_span != 0 and \
-               (hasattr(optimizer, 'lr') and not hasattr(optimizer, 'alpha')):
-                if train_iter.iteration >= self.decay_iter_start and \
-                        train_iter.iteration % self.decay_iter_span == 0:
-                    setattr(optimizer, 'lr', optimizer.lr / 1.2)
-                    print('lr: {} -> {}'.format(
-                        optimizer.lr * 1.2, optimizer.lr))
-
-        optimizer.target.cleargrads()  # Clear the parameter gradients
-        loss.backward()  # Backprop
-        loss.unchain_backward()  # Truncate the graph
-        optimizer.update()  # Update the parameters
-
-        reporter.report(
-            {'lr': getattr(optimizer, 'lr', getattr(
-                optimizer, 'alpha', None))},
-            optimizer.target)
+                loss += self.loss_func(x, t)
+        return loss
 
 
 # Routine to rewrite the result dictionary of LogReport to add perplexity
@@ -177,6 +244,21 @@ def main():
                         ' default is not (0).')
     parser.add_argument('--resume', '-r', default='',
                         help='Resume the training from snapshot')
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help='Keep states of VD RNNs at every k-th timestep'
+                        ' and recompute the others in backward'
+                        ' (0: disabled)')
+    parser.add_argument('--memory-budget', type=float, default=0,
+                        help='Memory budget (MB) of activations of each VD'
+                        ' RNN in a window, by which the largest fitting'
+                        ' checkpointing interval is chosen (0: disabled)')
+    parser.add_argument('--peak-memory-interval', type=int, default=0,
+                        help='Measure the peak memory of every k-th update'
+                        ' instead of timing it (0: disabled)')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Choose the fastest memory efficiency level'
+                        ' fitting --memory-budget by a few updates'
+                        ' at each level instead of checkpointing')
     parser.add_argument('--test', action='store_true',
                         help='Use tiny datasets for quick tests')
     parser.set_defaults(test=False)
@@ -231,6 +313,17 @@ def main():
             configuration.config.user_memory_efficiency = 0
         else:
             configuration.config.user_memory_efficiency = 3
+    if not args.pretrain and (args.checkpoint_every or
+                              (args.memory_budget and not args.calibrate)):
+        # Checkpointing of the policy is used in VD RNNs
+        # instead of recomputation of all timesteps
+        configuration.config.user_checkpoint_policy = VD.CheckpointPolicy(
+            every=args.checkpoint_every or None,
+            memory_budget=(args.memory_budget * 2 ** 20
+                           if args.memory_budget else None))
+    # Keep only seeds of noise for backward in memory-efficient training
+    configuration.config.user_regenerate_noise = \
+        configuration.config.user_memory_efficiency > 2
 
     if args.gpu >= 0:
         chainer.cuda.get_device(args.gpu).use()  # make the GPU current
@@ -246,13 +339,24 @@ def main():
         optimizer = chainer.optimizers.Adam(alpha=1e-5)
         #optimizer = chainer.optimizers.SGD(lr=1.0)
         optimizer.setup(model)
+        # Updates at NaN losses are cancelled without synchronization
+        optimizer.add_hook(VD.MaskNaNUpdate())
         optimizer.add_hook(chainer.optimizer.GradientClipping(5.))
 
     # Set up a trainer
     updater = BPTTUpdater(train_iter, optimizer, args.bproplen, args.gpu,
                           loss_func=model.calc_loss,
                           decay_iter=((n_iters * 6, n_iters) if args.pretrain
-                                      else (0, 0)))
+                                      else (0, 0)),
+                          peak_memory_interval=args.peak_memory_interval)
+    if args.calibrate and args.memory_budget and not args.pretrain:
+        def configure(level):
+            configuration.config.user_memory_efficiency = level
+            configuration.config.user_regenerate_noise = level > 2
+        VD.calibrate_memory_efficiency(
+            updater, args.memory_budget * 2 ** 20, configure=configure,
+            out=args.out)
+
     trainer = training.Trainer(updater, (args.epoch, 'epoch'), out=args.out)
 
     # Model with shared params and distinct states
@@ -265,6 +369,10 @@ def main():
 
     interval = min(10 if args.test else 100,
                    max(n_iters, 1))
+    if not args.pretrain:
+        # Accumulate metrics on the device and report them at each log
+        trainer.extend(VD.AccumulatedReport(
+            model, trigger=(interval, 'iteration')))
     trainer.extend(extensions.LogReport(postprocess=compute_perplexity,
                                         trigger=(interval, 'iteration')))
 
@@ -273,7 +381,7 @@ def main():
             ['epoch', 'iteration',
              'perplexity', 'val_perplexity',
              'main/accuracy', 'validation/main/accuracy',
-             'main/lr',
+             'main/lr', 'main/time/data', 'main/time/compute',
              'elapsed_time']), trigger=(interval, 'iteration'))
     else:
         trainer.extend(extensions.PrintReport(
@@ -282,6 +390,7 @@ def main():
              'main/accuracy', 'validation/main/accuracy',
              'main/class', 'main/kl', 'main/mean_p', 'main/sparsity',
              'main/W/Wnz', 'main/kl_coef', 'main/lr',
+             'main/time/data', 'main/time/compute',
              'elapsed_time']), trigger=(interval, 'iteration'))
 
     trainer.extend(extensions.ProgressBar(
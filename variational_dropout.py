@@ -1,11 +1,17 @@
+import json
+import os
+import time
+import tracemalloc
 import warnings
 from collections import defaultdict
 
 import chainer
 from chainer import configuration
+from chainer import cuda
 import chainer.functions as F
 import chainer.links as L
 from chainer import reporter
+from chainer import training
 
 import numpy
 
@@ -21,9 +27,330 @@ configuration.config.user_memory_efficiency = 0
 # 3<= : complex calculations like matrix ones
 # more memory efficient, it takes much time
 
+configuration.config.user_checkpoint_policy = None
+# A CheckpointPolicy for VD RNNs and linear links (None: disabled).
+# If set, it is used instead of user_memory_efficiency in them.
+
+configuration.config.user_stats_interval = 1
+# calc_loss calculates stats of VD every interval calls.
+# In training with AccumulatedReport, they are calculated at its trigger.
+
+configuration.config.user_sparse_training_sparsity = None
+configuration.config.user_sparse_training_interval = 100
+# VD linear links on CPU use sparse training kernels in training
+# if the ratio of weights out of their sparse pattern is over the sparsity
+# (None: disabled). The pattern is rebuilt every interval update steps.
+
 P_THRESHOLD = 0.95
 LOGA_THRESHOLD = 3.
 INITIAL_LOG_SIGMA2 = chainer.initializers.Constant(-10.)
+# Weights with log alpha up to LOGA_THRESHOLD + SPARSE_PATTERN_MARGIN
+# are kept in sparse patterns so that they can come back until a rebuild.
+SPARSE_PATTERN_MARGIN = 1.
+
+
+def _nan_guard(loss):
+    """Replace a NaN loss with zero without synchronization
+
+    This returns the guarded loss and a boolean array of its validity.
+    NaN in activations still makes gradients NaN,
+    so updates at NaN losses are cancelled by :class:`MaskNaNUpdate`.
+    """
+    xp = cuda.get_array_module(loss.data)
+    ok = ~xp.isnan(loss.data)
+    return F.where(ok, loss, xp.zeros_like(loss.data)), ok
+
+
+def forget_with_noise(func, *xs):
+    """F.forget drawing the same noise of VD in recomputation"""
+    replay = VDF.replay_noise()
+
+    def replayed(*xs):
+        with replay:
+            return func(*xs)
+    return F.forget(replayed, *xs)
+
+
+class CheckpointPolicy(object):
+    """Activation checkpointing policy for BPTT of VD RNNs
+
+    ``n_step_forward`` of :class:`VariationalDropoutLSTM` and
+    :class:`VariationalDropoutTanhRNN` splits timesteps of a window
+    into segments of ``every`` steps (None: no checkpointing).
+    Only states at the start of each segment are kept,
+    and each segment is recomputed in backward with the same noise.
+    If ``memory_budget`` (in bytes) is given, ``every`` is chosen for
+    each window and each RNN instead from the sizes of buffers kept for
+    backward (see :meth:`segment_length`); it is None if the whole window
+    fits in the budget, and otherwise the largest length fitting it.
+    If ``recompute_linear`` is True, :class:`VariationalDropoutLinear`
+    also recomputes its output in backward.
+    Time spent in recomputation and the number of recomputed timesteps
+    are accumulated in ``recompute_time`` and ``n_recomputed_steps``.
+    """
+
+    def __init__(self, every=None, memory_budget=None,
+                 recompute_linear=False):
+        self.every = every
+        self.memory_budget = memory_budget
+        self.recompute_linear = recompute_linear
+        self.last_every = None
+        self.recompute_time = 0.
+        self.n_recomputed_steps = 0
+
+    def segment_length(self, n_step, window_bytes, step_bytes,
+                       segment_step_bytes, output_bytes, state_bytes):
+        """Return the number of timesteps of a segment (None: no segments)
+
+        The caller gives bytes of buffers kept for backward: for the whole
+        window in any case (``window_bytes``, e.g., the input projection),
+        per timestep without checkpointing (``step_bytes``),
+        per timestep of a segment being recomputed (``segment_step_bytes``),
+        per timestep out of segments (``output_bytes``, the hidden states
+        returned) and per checkpoint (``state_bytes``).
+        """
+        if self.memory_budget is None:
+            every = self.every
+            if every is not None:
+                every = max(1, min(every, n_step))
+            self.last_every = every
+            return every
+
+        if window_bytes + n_step * step_bytes <= self.memory_budget:
+            self.last_every = None
+            return None
+
+        def peak(every):
+            n_segment = -(-n_step // every)
+            return (window_bytes + n_step * output_bytes +
+                    n_segment * state_bytes + every * segment_step_bytes)
+        fitting = [every for every in range(1, n_step + 1)
+                   if peak(every) <= self.memory_budget]
+        if fitting:
+            every = fitting[-1]
+        else:
+            every = min(range(1, n_step + 1), key=peak)
+            warnings.warn(
+                'No checkpoint interval fits the memory budget of {} bytes '
+                '(estimated peak: {} bytes with every={})'.format(
+                    self.memory_budget, peak(every), every))
+        self.last_every = every
+        return every
+
+    def checkpoint(self, func, n_step, *xs):
+        """Call func via F.forget counting the recomputation overhead"""
+        replay = VDF.replay_noise()
+        returns_tuple = []
+
+        def recomputable(*xs):
+            recompute = replay.recorded
+            start = time.time()
+            with replay:
+                outs = func(*xs)
+            if recompute:
+                self.recompute_time += time.time() - start
+                self.n_recomputed_steps += n_step
+            else:
+                returns_tuple.append(isinstance(outs, tuple))
+            return outs
+        outs = F.forget(recomputable, *xs)
+        if returns_tuple[0] and not isinstance(outs, tuple):
+            # F.forget returns a Variable for a tuple of one output
+            outs = (outs,)
+        return outs
+
+    def pop_stats(self):
+        """Return and reset stats of recomputation"""
+        stats = {'checkpoint_every': self.last_every or 0,
+                 'recompute_time': self.recompute_time,
+                 'recomputed_steps': self.n_recomputed_steps}
+        self.recompute_time = 0.
+        self.n_recomputed_steps = 0
+        return stats
+
+
+class PeakMemory(object):
+    """Context measuring the peak of memory allocated in it
+
+    Memory of numpy arrays is traced by tracemalloc on CPU
+    (if it is not tracing yet), and memory of the CuPy memory pool
+    is traced by a memory hook on GPU.
+    ``peak`` is the peak in bytes over the memory at the entry.
+    Contexts can be nested.
+    """
+
+    _active = []
+
+    def __init__(self, gpu=False):
+        self.gpu = gpu
+        self.peak = 0
+
+    def __enter__(self):
+        if self.gpu:
+            self._hook = _get_pool_peak_hook()
+            self._hook.__enter__()
+        else:
+            self._tracing = tracemalloc.is_tracing()
+            if not self._tracing:
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # Keep the peak so far of outer contexts before resetting it
+            for outer in PeakMemory._active:
+                outer.peak = max(outer.peak, peak - outer._start)
+            self._start = current
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            PeakMemory._active.append(self)
+        return self
+
+    def __exit__(self, *args):
+        if self.gpu:
+            self._hook.__exit__(*args)
+            self.peak = self._hook.peak
+        else:
+            PeakMemory._active.remove(self)
+            self.peak = max(self.peak,
+                            tracemalloc.get_traced_memory()[1] - self._start)
+            if not self._tracing:
+                tracemalloc.stop()
+
+
+def _get_pool_peak_hook():
+    from cupy.cuda import memory_hook
+
+    class PoolPeakHook(memory_hook.MemoryHook):
+
+        name = 'PoolPeakHook'
+
+        def __init__(self):
+            self.used = 0
+            self.peak = 0
+
+        def malloc_postprocess(self, device_id, size, mem_size,
+                               mem_ptr, pmem_id):
+            self.used += mem_size
+            self.peak = max(self.peak, self.used)
+
+        def free_postprocess(self, device_id, mem_size, mem_ptr, pmem_id):
+            self.used -= mem_size
+
+    return PoolPeakHook()
+
+
+def _set_memory_efficiency(level):
+    configuration.config.user_memory_efficiency = level
+
+
+def _out_of_memory_errors():
+    errors = (MemoryError, )
+    if cuda.available:
+        errors += (cuda.cupy.cuda.memory.OutOfMemoryError, )
+    return errors
+
+
+def calibrate_memory_efficiency(updater, memory_budget, levels=(3, 2, 1, 0),
+                                n_iterations=3, configure=None, out=None):
+    """Choose the fastest memory efficiency level fitting a memory budget
+
+    This runs ``n_iterations`` updates of ``updater`` at each level
+    (``configure(level)`` sets it, which sets ``user_memory_efficiency``
+    by default). The first update measures the peak of memory allocated
+    in an update (see :class:`PeakMemory`) including workspaces of
+    CPU kernels, whose pool is cleared before each level,
+    and the others are timed.
+    Levels are probed in the order of ``levels``, i.e., from the most
+    memory-efficient one by default, until a level exceeds
+    ``memory_budget`` (in bytes) or runs out of memory,
+    whose peak is recorded as None.
+    The model, optimizer and iterators are restored afterwards
+    (and states of RNNs are reset).
+    The fastest level fitting the budget is set and returned with
+    the measurements (``{level: (peak, step time)}``);
+    the first level is chosen if none fits.
+    If ``out`` is given, they are also written to ``out/calibration.json``.
+    """
+    if configure is None:
+        configure = _set_memory_efficiency
+    model = updater.get_optimizer('main').target
+    gpu = model.xp is not numpy
+    serializer = chainer.serializers.DictionarySerializer()
+    updater.serialize(serializer)
+    # The serializer keeps references to arrays updated in place
+    state = {key: numpy.copy(value)
+             for key, value in serializer.target.items()}
+    kl_coef = getattr(model, 'kl_coef', None)
+    # States of optimizers not initialized yet are not in the snapshot
+    uninitialized = [param.update_rule for param in model.params()
+                     if param.update_rule is not None and
+                     param.update_rule.state is None]
+
+    results = {}
+    for level in levels:
+        configure(level)
+        # Each level allocates its own workspaces
+        VDF.get_workspace_pool().clear()
+        peak, step_time = None, None
+        try:
+            with PeakMemory(gpu=gpu) as memory:
+                updater.update_core()
+                if gpu:
+                    cuda.Device().synchronize()
+            peak = memory.peak
+            if peak <= memory_budget:
+                start = time.time()
+                n_timed = max(n_iterations - 1, 1)
+                for i in range(n_timed):
+                    updater.update_core()
+                if gpu:
+                    cuda.Device().synchronize()
+                step_time = (time.time() - start) / n_timed
+        except _out_of_memory_errors():
+            # Drop the graph and states left by the failed update
+            model.cleargrads()
+            if hasattr(model, 'reset_state'):
+                model.reset_state()
+        results[level] = (peak, step_time)
+        if peak is None:
+            print(' memory efficiency level {}:'.format(level) +
+                  '	out of memory')
+            break
+        print(' memory efficiency level {}:'.format(level) +
+              '	peak memory {:.1f} MB'.format(peak / 2. ** 20) +
+              ('	step time {:.4f} s'.format(step_time)
+               if step_time is not None else '	over the budget'))
+        if step_time is None:
+            break
+
+    for rule in uninitialized:
+        rule._state = None
+    updater.serialize(chainer.serializers.NpzDeserializer(
+        state, strict=False))
+    if kl_coef is not None:
+        model.kl_coef = kl_coef
+    if hasattr(model, 'reset_state'):
+        model.reset_state()
+
+    fitting = [level for level in results if results[level][1] is not None]
+    if fitting:
+        level = min(fitting, key=lambda level: results[level][1])
+    else:
+        level = levels[0]
+        warnings.warn('No memory efficiency level fits the memory budget.')
+    configure(level)
+    print('memory efficiency level: {} (budget {:.1f} MB)'.format(
+        level, memory_budget / 2. ** 20))
+    if out is not None:
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        with open(os.path.join(out, 'calibration.json'), 'w') as f:
+            json.dump({'level': level, 'memory_budget': memory_budget,
+                       'n_iterations': n_iterations,
+                       'results': [
+                           {'level': key, 'peak_memory': value[0],
+                            'step_time': value[1]}
+                           for key, value in results.items()]},
+                      f, indent=1, sort_keys=True)
+    return level, results
 
 
 def get_vd_links(link):
@@ -36,46 +363,179 @@ def get_vd_links(link):
             yield link
 
 
+def _param_version(param):
+    update_rule = getattr(param, 'update_rule', None)
+    if update_rule is None:
+        return None
+    return update_rule.t
+
+
+def get_log_alpha_data(link):
+    """Get log alpha and clip mask arrays of a link using variational dropout
+
+    Log alpha and its clip mask are computed once per update step
+    and shared by forward, KL and stats calculations.
+    The cache is keyed on the parameter arrays and their update counts,
+    so it is used only when the parameters are under an optimizer.
+    """
+    W, log_sigma2 = link.W, link.log_sigma2
+    key = (W.data, log_sigma2.data,
+           _param_version(W), _param_version(log_sigma2))
+    cache = getattr(link, '_log_alpha_cache', None)
+    if key[2] is not None and key[3] is not None and cache is not None and \
+            cache[0] is key[0] and cache[1] is key[1] and \
+            cache[2:4] == key[2:]:
+        return cache[4:]
+
+    log_alpha = VDF.calculate_log_alpha(
+        W.data, log_sigma2.data, eps=1e-8, thresholds=(-8., 8.)).data
+    clip_mask = (log_alpha > link.loga_threshold).astype(
+        log_alpha.dtype, copy=False)
+    link._log_alpha_cache = key + (log_alpha, clip_mask)
+    return log_alpha, clip_mask
+
+
+def get_log_alpha(link):
+    """Get log alpha variable and clip mask of a link using variational dropout
+
+    A new LogAlpha node is created at every call
+    and only its forward computation is skipped by the cache.
+    """
+    log_alpha, clip_mask = get_log_alpha_data(link)
+    log_alpha = VDF.calculate_log_alpha(
+        link.W, link.log_sigma2, eps=1e-8, thresholds=(-8., 8.),
+        precomputed=log_alpha)
+    return log_alpha, clip_mask
+
+
+def get_effective_W(link):
+    """Get the masked weight array of a link for inference
+
+    The array is cached until the parameter arrays are replaced
+    or updated by an optimizer (or loaded by a serializer).
+    Unlike log alpha, it is cached even without optimizers;
+    call ``clear_vd_cache`` after modifying parameters in place otherwise.
+    """
+    W, log_sigma2 = link.W, link.log_sigma2
+    key = (W.data, log_sigma2.data,
+           _param_version(W), _param_version(log_sigma2))
+    cache = getattr(link, '_effective_W_cache', None)
+    if cache is not None and cache[0] is key[0] and cache[1] is key[1] and \
+            cache[2:4] == key[2:]:
+        return cache[4]
+
+    effective_W = W.data * (1. - get_log_alpha_data(link)[1])
+    link._effective_W_cache = key + (effective_W, )
+    return effective_W
+
+
+def get_vd_weights(link):
+    """Get masked W and alpha * W ** 2 variables of a link for a sequence
+
+    They are computed once and shared by all timesteps of a sequence
+    through ``VDF.rnn_vd_linear``.
+    """
+    return VDF.vd_weights(
+        link.W, link.log_sigma2, link.loga_threshold,
+        eps=1e-8, thresholds=(-8., 8.),
+        log_alpha=get_log_alpha_data(link)[0])
+
+
+def get_sparse_pattern(link):
+    """Get the sparse pattern of a linear link for sparse training kernels
+
+    This returns None on GPU, out of training (the pattern is not built)
+    or if the link is not sparse enough.
+    The pattern is rebuilt every ``user_sparse_training_interval``
+    update steps, or at every call without optimizers.
+    """
+    sparsity = configuration.config.user_sparse_training_sparsity
+    if sparsity is None or link.xp is not numpy or \
+            not configuration.config.train:
+        return None
+    W = link.W
+    version = _param_version(W)
+    cache = getattr(link, '_sparse_pattern_cache', None)
+    if version is not None and cache is not None and \
+            cache[0] is W.data and cache[1] is not None and \
+            0 <= version - cache[1] < \
+            configuration.config.user_sparse_training_interval:
+        return cache[2]
+
+    log_alpha = get_log_alpha_data(link)[0]
+    mask = log_alpha <= link.loga_threshold + SPARSE_PATTERN_MARGIN
+    if 1. - numpy.count_nonzero(mask) * 1. / mask.size >= sparsity:
+        pattern = VDF.SparsePattern(mask)
+    else:
+        pattern = None
+    link._sparse_pattern_cache = (W.data, version, pattern)
+    return pattern
+
+
+def clear_vd_cache(link):
+    link._log_alpha_cache = None
+    link._effective_W_cache = None
+    link._sparse_pattern_cache = None
+
+
 def calculate_p(link):
     """Calculate (something like) probabilities of variational dropout
     This method takes high computational cost.
     """
-    alpha = link.xp.exp(VDF.calculate_log_alpha(
-        link.W, link.log_sigma2, eps=1e-8, thresholds=(-8., 8.)).data)
+    alpha = link.xp.exp(get_log_alpha_data(link)[0])
     p = alpha / (1 + alpha)
     return p
 
 
-def calculate_stats(chain, threshold=P_THRESHOLD):
+def calculate_stats(chain, threshold=None):
     """Calculate stats for parameters of variational dropout
+
+    Weights are counted as pruned by comparing log alpha
+    with ``loga_threshold`` of each link (or with the logit of
+    a probability ``threshold`` if given) without building
+    the probabilities of all the links.
+    Sparsity and the number of nonzero weights of each link are
+    also returned as ``sparsity/<link name>`` and ``nnz/<link name>``.
     This method takes high computational cost.
     """
-    xp = chain.xp
     stats = {}
-    all_p = [calculate_p(link).flatten()
-             for link in get_vd_links(chain)]
-    if not all_p:
+    if threshold is not None:
+        if any(link.p_threshold != threshold
+               for link in get_vd_links(chain)):
+            warnings.warn('The threshold for sparsity calculation'
+                          ' is different from'
+                          ' thresholds used for prediction with'
+                          ' threshold-based pruning.')
+        loga_threshold = numpy.log(threshold / (1. - threshold))
+
+    n_all = 0
+    sum_p = 0
+    n_zero = 0
+    for name, link in chain.namedlinks(skipself=True):
+        if not getattr(link, 'is_variational_dropout', False):
+            continue
+        log_alpha, clip_mask = get_log_alpha_data(link)
+        # sigmoid(x) = (tanh(x / 2) + 1) / 2
+        sum_p += (link.xp.tanh(log_alpha * 0.5).sum() + log_alpha.size) * 0.5
+        if threshold is None:
+            n_zero_link = clip_mask.sum()
+        else:
+            n_zero_link = (log_alpha > loga_threshold).sum()
+        name = name.lstrip('/')
+        stats['sparsity/' + name] = n_zero_link * 1. / log_alpha.size
+        stats['nnz/' + name] = int(log_alpha.size - n_zero_link)
+        n_all += log_alpha.size
+        n_zero += n_zero_link
+    if not n_all:
         return defaultdict(float)
-    all_p = xp.concatenate(all_p, axis=0)
-    stats['mean_p'] = xp.mean(all_p)
-
-    all_threshold = [link.p_threshold
-                     for link in get_vd_links(chain)]
-    if any(th != threshold for th in all_threshold):
-        warnings.warn('The threshold for sparsity calculation'
-                      ' is different from'
-                      ' thresholds used for prediction with'
-                      ' threshold-based pruning.')
-    # TODO: directly use threshold of each link
-
-    is_zero = (all_p > threshold)
-    stats['sparsity'] = xp.mean(is_zero)
-
-    n_non_zero = (1 - is_zero).sum()
+
+    stats['mean_p'] = sum_p / n_all
+    stats['sparsity'] = n_zero * 1. / n_all
+    n_non_zero = n_all - n_zero
     if n_non_zero == 0:
         stats['W/Wnz'] = float('inf')
     else:
-        stats['W/Wnz'] = all_p.size * 1. / n_non_zero
+        stats['W/Wnz'] = n_all * 1. / n_non_zero
     return stats
 
 
@@ -95,6 +555,7 @@ class VariationalDropoutLinear(chainer.links.Linear):
         self.loga_threshold = loga_threshold
         self.is_variational_dropout = True
         self.is_variational_dropout_linear = True
+        clear_vd_cache(self)
 
     def _initialize_params(self, in_size, log_sigma2=False):
         if not log_sigma2:
@@ -102,19 +563,37 @@ class VariationalDropoutLinear(chainer.links.Linear):
         else:
             self.log_sigma2.initialize((self.out_size, in_size))
 
-    def get_sparse_cpu_model(self):
-        log_alpha = VDF.calculate_log_alpha(
-            self.W, self.log_sigma2, eps=1e-8, thresholds=(-8., 8.))
-        clip_mask = (log_alpha.data > self.loga_threshold)
-        return sparse_chainer.SparseLinearForwardCPU(self, (1. - clip_mask))
+    def serialize(self, serializer):
+        super(VariationalDropoutLinear, self).serialize(serializer)
+        clear_vd_cache(self)
+
+    def get_sparse_cpu_model(self, sparse_format=None, batch_size=1,
+                             n_threads=1):
+        clip_mask = get_log_alpha_data(self)[1]
+        return sparse_chainer.SparseLinearForwardCPU(
+            self, (1. - clip_mask),
+            sparse_format=sparse_format, batch_size=batch_size,
+            n_threads=n_threads)
 
     def __call__(self, x):
         if self.W.data is None:
             self._initialize_params(x.size // x.shape[0])
 
-        return VDF.vd_linear(
-            x, self.W, self.b, self.loga_threshold, log_sigma2=self.log_sigma2,
-            log_alpha=None, eps=1e-8, thresholds=(-8., 8.))
+        if not configuration.config.train and \
+                not configuration.config.enable_backprop:
+            # inference only; gradients w.r.t. W are not needed
+            return F.linear(x, get_effective_W(self), self.b)
+        policy = configuration.config.user_checkpoint_policy
+        if policy is not None and policy.recompute_linear:
+            return policy.checkpoint(self.dropout_linear, 0, x)
+        return self.dropout_linear(x)
+
+    def dropout_linear(self, x):
+        return VDF.vd_linear_with_log_alpha(
+            x, self.W, self.b, self.log_sigma2, self.loga_threshold,
+            eps=1e-8, thresholds=(-8., 8.),
+            log_alpha=get_log_alpha_data(self)[0],
+            sparse_pattern=get_sparse_pattern(self))
 
 
 def _pair(x):
@@ -140,6 +619,8 @@ class VariationalDropoutConvolution2D(chainer.links.Convolution2D):
         self.p_threshold = p_threshold
         self.loga_threshold = loga_threshold
         self.is_variational_dropout = True
+        self.is_variational_dropout_convolution_2d = True
+        clear_vd_cache(self)
 
     def _initialize_params(self, in_channels, log_sigma2=False):
         kh, kw = _pair(self.ksize)
@@ -149,26 +630,29 @@ class VariationalDropoutConvolution2D(chainer.links.Convolution2D):
         else:
             self.log_sigma2.initialize(W_shape)
 
+    def serialize(self, serializer):
+        super(VariationalDropoutConvolution2D, self).serialize(serializer)
+        clear_vd_cache(self)
+
+    def get_sparse_cpu_model(self, sparse_format=None, batch_size=1,
+                             n_threads=1):
+        clip_mask = get_log_alpha_data(self)[1]
+        return sparse_chainer.SparseConvolution2DForwardCPU(
+            self, (1. - clip_mask), sparse_format=sparse_format,
+            n_threads=n_threads)
+
     def dropout_convolution_2d(self, x):
-        train = configuration.config.train
-        W, b = self.W, self.b
-        log_alpha = VDF.calculate_log_alpha(
-            self.W, self.log_sigma2, eps=1e-8, thresholds=(-8., 8.))
-        clip_mask = (log_alpha.data > self.loga_threshold)
-        if train:
-            W = (1. - clip_mask) * W
-            mu = F.convolution_2d(x, (1. - clip_mask) * W, b=None,
-                                  stride=self.stride, pad=self.pad)
-            si = F.sqrt(
-                F.convolution_2d(x * x, F.exp(log_alpha) * W * W, b=None,
-                                 stride=self.stride, pad=self.pad) + 1e-8)
-            normal_noise = self.xp.random.normal(
-                0., 1., mu.shape).astype('f')
-            activation = mu + si * normal_noise
-            return F.bias(activation, b)
-        else:
-            return F.convolution_2d(x, (1. - clip_mask) * W, b,
+        if not configuration.config.train and \
+                not configuration.config.enable_backprop:
+            # inference only; gradients w.r.t. W are not needed
+            return F.convolution_2d(x, get_effective_W(self), self.b,
                                     stride=self.stride, pad=self.pad)
+        return VDF.vd_convolution_2d(
+            x, self.W, self.b, self.log_sigma2,
+            stride=self.stride, pad=self.pad,
+            loga_threshold=self.loga_threshold,
+            eps=1e-8, thresholds=(-8., 8.),
+            log_alpha=get_log_alpha_data(self)[0])
 
     def __call__(self, x):
         if self.W.data is None:
@@ -217,6 +701,72 @@ class VariationalDropoutTanhRNN(chainer.Chain):
 
         return new_h
 
+    def n_step_forward(self, xs, h=None):
+        """RNN call over a sequence window
+        This takes xs of shape (T, B, in_size) and returns hs of shape
+        (T, B, out_size), which is equivalent to T calls in distribution.
+        The input projection of all timesteps is one matrix product and
+        only the recurrent projection loops over timesteps.
+        """
+        stateful = (h is None)
+        n_step, batchsize = xs.shape[:2]
+        if stateful:
+            if self.h is None:
+                self.h = self.xp.zeros(
+                    (batchsize, self.out_size)).astype('f')
+            h = self.h
+
+        clip_W, alpha_W2 = get_vd_weights(self.W)
+        clip_Wx, clip_Wh = F.split_axis(clip_W, [self.in_size], axis=1)
+        alpha_W2x, alpha_W2h = F.split_axis(alpha_W2, [self.in_size], axis=1)
+        xs_W = VDF.rnn_vd_linear(
+            F.reshape(xs, (n_step * batchsize, self.in_size)),
+            clip_Wx, alpha_W2x, self.W.b)
+
+        x_Ws = F.split_axis(xs_W, n_step, axis=0, force_tuple=True)
+        policy = configuration.config.user_checkpoint_policy
+        every = None
+        if policy is not None:
+            # Bytes of (B, out_size) arrays kept for backward
+            # (noise is kept unless it is regenerated or replayed)
+            unit = batchsize * self.out_size * xs_W.dtype.itemsize
+            noise = 0 if configuration.config.user_regenerate_noise else 1
+            every = policy.segment_length(
+                n_step,
+                # xs_W and its noise
+                window_bytes=n_step * (1 + noise) * unit,
+                # h and the noise of the recurrent projection
+                step_bytes=(1 + noise) * unit,
+                segment_step_bytes=unit,
+                output_bytes=unit,
+                state_bytes=0)
+        if every is not None:
+            # Keep only h at the start of each segment
+            hs = []
+            for start in range(0, n_step, every):
+                segment = x_Ws[start:start + every]
+                hs.extend(policy.checkpoint(
+                    self._steps, len(segment),
+                    h, clip_Wh, alpha_W2h, *segment))
+                h = hs[-1]
+        else:
+            hs = self._steps(h, clip_Wh, alpha_W2h, *x_Ws)
+            h = hs[-1]
+
+        if stateful:
+            self.h = h
+        else:
+            self.h = None
+
+        return F.stack(hs)
+
+    def _steps(self, h, clip_Wh, alpha_W2h, *x_Ws):
+        hs = []
+        for x_W in x_Ws:
+            h = F.tanh(x_W + VDF.rnn_vd_linear(h, clip_Wh, alpha_W2h))
+            hs.append(h)
+        return tuple(hs)
+
 
 class VariationalDropoutLSTM(chainer.Chain):
 
@@ -253,14 +803,17 @@ class VariationalDropoutLSTM(chainer.Chain):
         """Stateful LSTM call
         """
         memory_efficiency = configuration.config.user_memory_efficiency
+        if configuration.config.user_checkpoint_policy is not None:
+            # The links follow the policy
+            memory_efficiency = 0
 
         if memory_efficiency > 2:
-            lstm_in = F.forget(self.upward, x)
+            lstm_in = forget_with_noise(self.upward, x)
         else:
             lstm_in = self.upward(x)
         if self.h is not None:
             if memory_efficiency > 2:
-                lstm_in += F.forget(self.lateral, x)
+                lstm_in += forget_with_noise(self.lateral, x)
             else:
                 lstm_in += self.lateral(x)
         if self.c is None:
@@ -272,6 +825,77 @@ class VariationalDropoutLSTM(chainer.Chain):
             self.c, self.h = F.lstm(self.c, lstm_in)
         return self.h
 
+    def n_step_forward(self, xs):
+        """Stateful LSTM call over a sequence window
+        This takes xs of shape (T, B, in_size) and returns hs of shape
+        (T, B, out_size), which is equivalent to T calls in distribution.
+        The upward and lateral projections of all timesteps are
+        matrix products over the window and only the cell loops
+        over timesteps.
+        """
+        memory_efficiency = configuration.config.user_memory_efficiency
+        n_step, batchsize = xs.shape[:2]
+
+        xs = F.reshape(xs, (n_step * batchsize, xs.shape[2]))
+        lstm_ins = self.upward(xs)
+        if self.h is not None:
+            lstm_ins += self.lateral(xs)
+        elif n_step > 1:
+            # The lateral projection is skipped at the first step
+            # after the state is reset
+            lstm_ins = F.concat(
+                [lstm_ins[:batchsize],
+                 lstm_ins[batchsize:] + self.lateral(xs[batchsize:])],
+                axis=0)
+        lstm_ins = F.split_axis(lstm_ins, n_step, axis=0, force_tuple=True)
+        if self.c is None:
+            self.c = self.xp.zeros((batchsize, self.out_size)).astype('f')
+
+        policy = configuration.config.user_checkpoint_policy
+        every = None
+        if policy is not None:
+            # Bytes of (B, out_size) arrays kept for backward
+            # (noise is kept unless it is regenerated or replayed)
+            unit = batchsize * self.out_size * lstm_ins[0].dtype.itemsize
+            noise = 0 if configuration.config.user_regenerate_noise else 1
+            every = policy.segment_length(
+                n_step,
+                # The gates input and noise of both projections
+                window_bytes=n_step * 4 * (1 + 2 * noise) * unit,
+                # c and h
+                step_bytes=2 * unit,
+                segment_step_bytes=2 * unit,
+                # h of every step is returned, and c is kept at checkpoints
+                output_bytes=unit,
+                state_bytes=unit)
+        if every is not None:
+            # Keep only c at the start of each segment
+            hs = []
+            for start in range(0, n_step, every):
+                segment = lstm_ins[start:start + every]
+                outs = policy.checkpoint(
+                    self._steps, len(segment), self.c, *segment)
+                self.c, self.h = outs[0], outs[-1]
+                hs.extend(outs[1:])
+        else:
+            outs = self._steps(self.c, *lstm_ins,
+                               memory_efficiency=memory_efficiency)
+            self.c, self.h = outs[0], outs[-1]
+            hs = outs[1:]
+        return F.stack(hs)
+
+    def _steps(self, c, *lstm_ins, **kwargs):
+        """Return c and h of every step"""
+        memory_efficiency = kwargs.get('memory_efficiency', 0)
+        hs = []
+        for lstm_in in lstm_ins:
+            if memory_efficiency > 1:
+                c, h = F.forget(F.lstm, c, lstm_in)
+            else:
+                c, h = F.lstm(c, lstm_in)
+            hs.append(h)
+        return (c,) + tuple(hs)
+
 
 def get_vd_link(link,
                 p_threshold=P_THRESHOLD, loga_threshold=LOGA_THRESHOLD,
@@ -334,6 +958,164 @@ def to_variational_dropout_link(parent, name, link, path_name=''):
             print('  Retain link {}.'.format(path_name + raw_name))
 
 
+def _get_child_link(chain, name):
+    link = chain
+    for child_name in name.split('/'):
+        link = getattr(link, child_name)
+    return link
+
+
+def _replace_child_link(chain, name, new_link):
+    parent = chain
+    names = name.split('/')
+    for parent_name in names[:-1]:
+        parent = getattr(parent, parent_name)
+    delattr(parent, names[-1])
+    parent.add_link(names[-1], new_link)
+
+
+def _pruned_mask(link):
+    if getattr(link, 'is_variational_dropout', False):
+        return get_log_alpha_data(link)[1] > 0.5
+    return link.W.data == 0
+
+
+def _slice_vd_link(link, out_idx=None, in_idx=None):
+    W = link.W.data
+    log_sigma2 = link.log_sigma2.data
+    b = None if link.b is None else link.b.data
+    if out_idx is not None:
+        W, log_sigma2 = W[out_idx], log_sigma2[out_idx]
+        if b is not None:
+            b = b[out_idx]
+    if in_idx is not None:
+        W, log_sigma2 = W[:, in_idx], log_sigma2[:, in_idx]
+
+    if getattr(link, 'is_variational_dropout_linear', False):
+        new_link = VariationalDropoutLinear(
+            W.shape[1], W.shape[0], nobias=b is None,
+            p_threshold=link.p_threshold, loga_threshold=link.loga_threshold)
+    elif getattr(link, 'is_variational_dropout_convolution_2d', False):
+        new_link = VariationalDropoutConvolution2D(
+            W.shape[1], W.shape[0], W.shape[2:],
+            stride=link.stride, pad=link.pad, nobias=b is None,
+            p_threshold=link.p_threshold, loga_threshold=link.loga_threshold)
+    else:
+        raise TypeError('Only links using variational dropout'
+                        ' can be compacted: {}'.format(type(link)))
+    new_link.W.data[:] = W
+    new_link.log_sigma2.data[:] = log_sigma2
+    if b is not None:
+        new_link.b.data[:] = b
+    return new_link
+
+
+def _slice_batch_normalization(bn, idx):
+    new_bn = L.BatchNormalization(len(idx), decay=bn.decay, eps=bn.eps)
+    for name in ['gamma', 'beta']:
+        if getattr(bn, name, None) is not None:
+            getattr(new_bn, name).data[:] = getattr(bn, name).data[idx]
+    new_bn.avg_mean[:] = bn.avg_mean[idx]
+    new_bn.avg_var[:] = bn.avg_var[idx]
+    new_bn.N = bn.N
+    return new_bn
+
+
+def compact_layer_pair(chain, name, bn_name, activation, next_name):
+    """Remove fully pruned output units of a layer and inputs of the next
+
+    A unit is removed if all its outgoing weights in the next layer
+    are pruned, or if all its incoming weights are pruned.
+    In the latter case, the unit outputs a constant
+    (bias -> batch normalization in inference -> activation),
+    which is folded into the bias of the next layer.
+    The constant is folded only if the next layer is linear or
+    a convolution without padding; otherwise, only units with
+    zero constants are removed.
+    """
+    link = _get_child_link(chain, name)
+    next_link = _get_child_link(chain, next_name)
+    bn = None if bn_name is None else _get_child_link(chain, bn_name)
+    xp = chain.xp
+    n_units = link.W.shape[0]
+
+    is_dead_in = _pruned_mask(link).reshape(n_units, -1).all(axis=1)
+    # Inputs of a linear layer after a convolution are channel-major.
+    next_mask = _pruned_mask(next_link)
+    next_mask = next_mask.reshape(next_mask.shape[0], n_units, -1)
+    is_dead_out = next_mask.all(axis=2).all(axis=0)
+
+    const = xp.zeros(n_units, dtype=link.W.dtype) if link.b is None \
+        else link.b.data.copy()
+    if bn is not None:
+        const = (const - bn.avg_mean) / xp.sqrt(bn.avg_var + bn.eps)
+        if getattr(bn, 'gamma', None) is not None:
+            const *= bn.gamma.data
+        if getattr(bn, 'beta', None) is not None:
+            const += bn.beta.data
+    if activation is not None:
+        const = activation(const)
+        const = getattr(const, 'data', const)
+
+    can_fold = next_link.b is not None and \
+        not any(_pair(getattr(next_link, 'pad', 0)))
+    is_removed = is_dead_out | (is_dead_in & ((const == 0) | can_fold))
+    if is_removed.all():
+        is_removed[int(xp.argmax(is_dead_out))] = False
+
+    is_folded = is_removed & ~is_dead_out & (const != 0)
+    if is_folded.any():
+        next_W = next_link.W.data * ~next_mask.reshape(next_link.W.shape)
+        next_W = next_W.reshape(next_W.shape[0], n_units, -1)
+        next_link.b.data += next_W[:, is_folded].sum(axis=2).dot(
+            const[is_folded])
+
+    keep = xp.flatnonzero(~is_removed)
+    n_in_per_unit = next_link.W.shape[1] // n_units
+    if next_link.W.ndim == 2 and n_in_per_unit > 1:
+        next_keep = (keep[:, None] * n_in_per_unit +
+                     xp.arange(n_in_per_unit)[None, :]).ravel()
+    else:
+        next_keep = keep
+    _replace_child_link(chain, name, _slice_vd_link(link, out_idx=keep))
+    if bn is not None:
+        _replace_child_link(chain, bn_name,
+                            _slice_batch_normalization(bn, keep))
+    _replace_child_link(chain, next_name,
+                        _slice_vd_link(next_link, in_idx=next_keep))
+    return n_units, len(keep)
+
+
+def _get_pruned_layer(link):
+    """Get a pruned weight matrix, bias and convolution settings of a link
+
+    Returns None if the link is neither a link using variational dropout
+    nor a sparsified link.
+    """
+    if getattr(link, 'is_variational_dropout', False):
+        clip_mask = get_log_alpha_data(link)[1]
+        W = cuda.to_cpu(link.W.data * (1. - clip_mask))
+        b = None if link.b is None else cuda.to_cpu(link.b.data)
+    elif isinstance(link, (sparse_chainer.SparseLinearForwardCPU,
+                           sparse_chainer.SparseConvolution2DForwardCPU)):
+        W = link.sparse_W
+        b = getattr(link, 'sparse_b', None)
+        if b is not None:
+            b = b.ravel()
+    else:
+        return None
+
+    if isinstance(link, (L.Convolution2D,
+                         sparse_chainer.SparseConvolution2DForwardCPU)):
+        layer = {'type': 'convolution_2d', 'ksize': list(_pair(link.ksize)),
+                 'stride': list(_pair(link.stride)),
+                 'pad': list(_pair(link.pad))}
+        W = W.reshape(W.shape[0], -1)
+    else:
+        layer = {'type': 'linear'}
+    return layer, W, b
+
+
 class VariationalDropoutChain(chainer.link.Chain):
 
     def __init__(self, warm_up=0.0001, **kwargs):
@@ -343,8 +1125,21 @@ class VariationalDropoutChain(chainer.link.Chain):
             self.kl_coef = 0.
         else:
             self.kl_coef = 1.
-
-    def calc_loss(self, x, t, add_kl=True, split_loss=False, calc_stats=True):
+        self.metrics = None
+        self.loss_ok = None
+        # Calls counted separately in training and evaluation
+        self._n_stats_calls = {True: 0, False: 0}
+
+    def calc_loss(self, x, t, add_kl=True, split_loss=False, calc_stats=True,
+                  kl_steps=1):
+        """Calculate the loss (sum of cross entropy and KL)
+
+        If ``x`` is a window of ``kl_steps`` timesteps,
+        the KL term and its warm-up are those of ``kl_steps`` calls
+        of one timestep, i.e., KL is weighted by the mean of
+        ``kl_coef`` over the timesteps and the warm-up advances
+        ``kl_steps`` times.
+        """
         train = configuration.config.train
         memory_efficiency = configuration.config.user_memory_efficiency
 
@@ -354,79 +1149,162 @@ class VariationalDropoutChain(chainer.link.Chain):
         else:
             self.class_loss = F.softmax_cross_entropy(self.y, t)
 
-        ignore = False
-        if train and self.xp.isnan(self.class_loss.data):
-            self.class_loss = chainer.Variable(
-                self.xp.array(0.).astype('f').sum())
-            ignore = True
-        else:
-            reporter.report({'class': self.class_loss.data}, self)
+        ok = None
+        if train:
+            self.class_loss, ok = _nan_guard(self.class_loss)
+        self._report({'class': self.class_loss.data}, ok)
 
         if add_kl:
-            a_regf = sum(
-                VDF.calculate_kl(
-                    link.W, link.loga_threshold,
-                    log_sigma2=link.log_sigma2, log_alpha=None,
-                    eps=1e-8, thresholds=(-8., 8.))
-                for link in self.links()
-                if getattr(link, 'is_variational_dropout', False))
-            self.kl_loss = a_regf * self.kl_coef
-
-            if train and self.xp.isnan(self.kl_loss.data):
-                self.kl_loss = chainer.Variable(
-                    self.xp.array(0.).astype('f').sum())
-                ignore = True
-            else:
-                reporter.report({'kl': self.kl_loss.data}, self)
-            self.kl_coef = min(self.kl_coef + self.warm_up, 1.)
-            reporter.report({'kl_coef': self.kl_coef}, self)
+            vd_links = [link for link in self.links()
+                        if getattr(link, 'is_variational_dropout', False)]
+            a_regf = VDF.calculate_kl_all(
+                [link.W for link in vd_links],
+                [link.log_sigma2 for link in vd_links],
+                [link.loga_threshold for link in vd_links],
+                eps=1e-8, thresholds=(-8., 8.),
+                flat=self._get_flat_vd_params(vd_links),
+                log_alphas=[get_log_alpha_data(link)[0]
+                            for link in vd_links])
+            kl_coef = 0.
+            for _ in range(kl_steps):
+                kl_coef += self.kl_coef
+                self.kl_coef = min(self.kl_coef + self.warm_up, 1.)
+            self.kl_loss = a_regf * (kl_coef / kl_steps)
+
+            kl_ok = None
+            if train:
+                self.kl_loss, kl_ok = _nan_guard(self.kl_loss)
+                ok = ok & kl_ok
+            self._report({'kl': self.kl_loss.data}, kl_ok)
+            self._report({'kl_coef': self.kl_coef})
 
             self.loss = self.class_loss + self.kl_loss
         else:
             self.loss = self.class_loss
 
-        if not ignore:
-            reporter.report({'loss': self.loss.data}, self)
+        self._report({'loss': self.loss.data}, ok)
+        if train:
+            # Validity of losses since the last update (see MaskNaNUpdate)
+            self.loss_ok = ok if self.loss_ok is None else self.loss_ok & ok
 
         self.accuracy = F.accuracy(self.y.data, t).data
-        reporter.report({'accuracy': self.accuracy}, self)
+        self._report({'accuracy': self.accuracy})
 
-        if calc_stats:
-            stats = calculate_stats(self)
-            reporter.report({'mean_p': stats['mean_p']}, self)
-            reporter.report({'sparsity': stats['sparsity']}, self)
-            reporter.report({'W/Wnz': stats['W/Wnz']}, self)
+        if calc_stats and self._stats_due():
+            self._report(calculate_stats(self))
 
         if split_loss:
             return self.class_loss, self.kl_loss
         else:
             return self.loss
 
-    def to_cpu_sparse(self):
+    def _stats_due(self):
+        """Return True every ``user_stats_interval`` calls
+
+        Calls in training and evaluation are counted separately,
+        so evaluation does not shift the calls in training with stats.
+        In training with ``metrics``, stats are left to
+        :class:`AccumulatedReport` and this returns False.
+        """
+        train = bool(configuration.config.train)
+        if self.metrics is not None and train:
+            return False
+        due = self._n_stats_calls[train] % \
+            configuration.config.user_stats_interval == 0
+        self._n_stats_calls[train] += 1
+        return due
+
+    def _report(self, values, ok=None):
+        """Report values unless ok (a boolean array) is False
+
+        In training with ``metrics`` (a :class:`MetricsAccumulator`),
+        values are accumulated on the device without synchronization.
+        """
+        if self.metrics is not None and configuration.config.train:
+            self.metrics.add(values, ok)
+        elif ok is None or bool(ok):
+            reporter.report(values, self)
+
+    def flatten_vd_params(self):
+        """Make W and log sigma^2 of all VD links views of flat buffers
+
+        W and log sigma^2 of the links are copied into
+        two contiguous buffers and replaced with views of them,
+        so that KL of all the links is computed over the buffers.
+        Call this after moving the model to a device or compacting it,
+        which replaces the arrays; KL falls back to concatenation then.
+        """
+        vd_links = [link for link in self.links()
+                    if getattr(link, 'is_variational_dropout', False)]
+        buffers = []
+        for name in ('W', 'log_sigma2'):
+            params = [getattr(link, name) for link in vd_links]
+            buffer = self.xp.empty(sum(param.size for param in params),
+                                   dtype=params[0].dtype)
+            offset = 0
+            for param in params:
+                view = buffer[offset:offset + param.size].reshape(param.shape)
+                view[...] = param.data
+                param.data = view
+                offset += param.size
+            buffers.append(buffer)
+        for link in vd_links:
+            clear_vd_cache(link)
+        self._flat_vd_params = (
+            [(link.W.data, link.log_sigma2.data) for link in vd_links],
+            tuple(buffers))
+
+    def _get_flat_vd_params(self, vd_links):
+        flat = getattr(self, '_flat_vd_params', None)
+        if flat is None or len(flat[0]) != len(vd_links):
+            return None
+        for (W, log_sigma2), link in zip(flat[0], vd_links):
+            if link.W.data is not W or link.log_sigma2.data is not log_sigma2:
+                return None
+        return flat[1]
+
+    def to_cpu_sparse(self, sparse_format=None, batch_size=1, n_threads=1):
+        """Make myself to use sparse computation for inference on CPU
+
+        ``sparse_format`` of each layer is one of
+        'dense', 'csr', 'csc', 'bsr' and 'auto'.
+        If 'auto', the fastest one for each layer is selected by benchmarking
+        (at ``batch_size`` for linear layers and
+        at the first call for convolutional layers).
+        If ``n_threads`` > 1, sparse products are sharded over
+        a persistent thread pool.
+        """
         self.to_cpu()
         n_total_old_params = 0
         n_total_new_params = 0
         if self.xp is not numpy:
-            warnings.warn('SparseLinearForwardCPU link is made for'
+            warnings.warn('SparseLinearForwardCPU and'
+                          ' SparseConvolution2DForwardCPU links are made for'
                           ' inference usage. Please to_cpu()'
                           ' before inference.')
-        print('Sparsifying fully-connected linear layer in the model...')
+        print('Sparsifying linear and convolutional layers in the model...')
         for name, link in sorted(
                 self.namedlinks(skipself=True), key=lambda x: x[0]):
             raw_name = name.lstrip('/')
             n_old_params = sum(p.size for p in link.params())
 
-            if getattr(link, 'is_variational_dropout_linear', False):
+            if getattr(link, 'is_variational_dropout_linear', False) or \
+                    getattr(link, 'is_variational_dropout_convolution_2d',
+                            False):
+                # A link can be nested in child chains, e.g., Block of VGG16
                 old = link.copy()
-                delattr(self, raw_name)
-                self.add_link(raw_name, old.get_sparse_cpu_model())
-                n_new_params = getattr(self, raw_name).sparse_W.size
-                if hasattr(getattr(self, raw_name), 'sparse_b'):
-                    n_new_params += getattr(self, raw_name).sparse_b.size
+                _replace_child_link(self, raw_name, old.get_sparse_cpu_model(
+                    sparse_format=sparse_format, batch_size=batch_size,
+                    n_threads=n_threads))
+                new_link = _get_child_link(self, raw_name)
+                n_new_params = sparse_chainer.count_nonzero(new_link.sparse_W)
+                if hasattr(new_link, 'sparse_b'):
+                    n_new_params += new_link.sparse_b.size
                 print(' Sparsified link {}.'.format(raw_name) +
                       '\t# of params: {} -> {} ({:.3f}%)'.format(
                           n_old_params, n_new_params,
-                          (n_new_params * 1. / n_old_params * 100)))
+                          (n_new_params * 1. / n_old_params * 100)) +
+                      '\tformat: {}'.format(new_link.sparse_format))
                 n_total_old_params += n_old_params
                 n_total_new_params += n_new_params
             elif not isinstance(link, chainer.Chain):
@@ -439,6 +1317,136 @@ class VariationalDropoutChain(chainer.link.Chain):
             n_total_old_params, n_total_new_params,
             (n_total_new_params * 1. / n_total_old_params * 100)))
 
+    def compact(self, layers=None):
+        """Remove fully pruned units and channels from the model
+
+        The result is a smaller dense model for inference.
+        ``layers`` is a list of ``(link_name, bn_name, activation)``
+        in forward order, where ``bn_name`` is the name of
+        batch normalization after the link (or None) and
+        ``activation`` is an element-wise function after it (or None).
+        If not given, ``compact_layers`` of the model is used.
+        Note that optimizers must be set up again after compaction.
+        """
+        if layers is None:
+            layers = getattr(self, 'compact_layers', None)
+        if layers is None:
+            raise NotImplementedError(
+                'compact_layers is not defined in {}.'.format(
+                    self.__class__.__name__))
+        if self._cpu:
+            gpu = -1
+        else:
+            gpu = self._device_id
+            self.to_cpu()
+
+        print('Compacting layers in the model...')
+        for (name, bn_name, activation), (next_name, _, _) in zip(
+                layers[:-1], layers[1:]):
+            n_old_units, n_new_units = compact_layer_pair(
+                self, name, bn_name, activation, next_name)
+            print(' Compacted link {}.'.format(name) +
+                  '\t# of units: {} -> {} ({:.3f}%)'.format(
+                      n_old_units, n_new_units,
+                      (n_new_units * 1. / n_old_units * 100)))
+
+        if gpu >= 0:
+            self.to_gpu(gpu)
+
+    def save_sparse(self, path):
+        """Save myself in a compact sparse format for inference
+
+        ``path`` is a directory. Each pruned layer is saved with
+        ``sparse_chainer.save_sparse_matrix`` and other parameters
+        (e.g., batch normalization) are saved as dense npy files.
+        Parameters only for training (log sigma^2) are not saved.
+        All arrays can be memory-mapped by ``load_sparse``.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta = {'layers': {}, 'arrays': []}
+        for name, link in sorted(
+                self.namedlinks(skipself=True), key=lambda x: x[0]):
+            if isinstance(link, chainer.Chain):
+                continue
+            raw_name = name.lstrip('/')
+            prefix = os.path.join(path, raw_name.replace('/', '.'))
+            pruned_layer = _get_pruned_layer(link)
+            if pruned_layer is not None:
+                layer, W, b = pruned_layer
+                layer.update(sparse_chainer.save_sparse_matrix(prefix, W))
+                if b is not None:
+                    numpy.save(prefix + '.b.npy', numpy.asarray(b, 'f'))
+                layer['bias'] = b is not None
+                meta['layers'][raw_name] = layer
+                continue
+            for param_name, param in link.namedparams():
+                if param.data is not None:
+                    array_name = raw_name + param_name
+                    numpy.save(prefix + param_name.replace('/', '.') + '.npy',
+                               cuda.to_cpu(param.data))
+                    meta['arrays'].append(array_name)
+            for persistent_name in sorted(link._persistent):
+                value = getattr(link, persistent_name)
+                if isinstance(value, (numpy.ndarray, cuda.ndarray)):
+                    numpy.save(prefix + '.' + persistent_name + '.npy',
+                               cuda.to_cpu(value))
+                    meta['arrays'].append(raw_name + '/' + persistent_name)
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+
+    def load_sparse(self, path, sparse_format=None, batch_size=1,
+                    n_threads=1, mmap_mode='r'):
+        """Load a model saved by ``save_sparse`` for inference on CPU
+
+        Pruned layers are replaced with sparse links
+        as ``to_cpu_sparse`` does, sharing memory-mapped arrays.
+        See ``to_cpu_sparse`` for ``sparse_format``, ``batch_size`` and
+        ``n_threads``.
+        """
+        self.to_cpu()
+        with open(os.path.join(path, 'model.json')) as f:
+            meta = json.load(f)
+        for raw_name, layer in sorted(meta['layers'].items()):
+            prefix = os.path.join(path, raw_name.replace('/', '.'))
+            W, W_format = sparse_chainer.load_sparse_matrix(
+                prefix, layer,
+                sparse_format='dense' if sparse_format == 'auto'
+                else sparse_format,
+                mmap_mode=mmap_mode)
+            b = numpy.load(prefix + '.b.npy', mmap_mode=mmap_mode) \
+                if layer['bias'] else None
+            if layer['type'] == 'linear':
+                new_link = sparse_chainer.SparseLinearForwardCPU.from_arrays(
+                    W, b=b, sparse_format=W_format, n_threads=n_threads)
+                if sparse_format == 'auto':
+                    sparse_chainer.autotune_sparse_format(
+                        new_link, W, numpy.random.rand(
+                            batch_size, W.shape[1]).astype('f'))
+            else:
+                new_link = \
+                    sparse_chainer.SparseConvolution2DForwardCPU.from_arrays(
+                        W, tuple(layer['ksize']),
+                        stride=tuple(layer['stride']),
+                        pad=tuple(layer['pad']), b=b,
+                        sparse_format='auto' if sparse_format == 'auto'
+                        else W_format, n_threads=n_threads)
+            _replace_child_link(self, raw_name, new_link)
+
+        for array_name in meta['arrays']:
+            array = numpy.load(
+                os.path.join(path, array_name.replace('/', '.') + '.npy'),
+                mmap_mode=mmap_mode)
+            link_name, value_name = array_name.rsplit('/', 1)
+            link = _get_child_link(self, link_name)
+            value = getattr(link, value_name)
+            if isinstance(value, chainer.Parameter):
+                if value.data is None:
+                    value.initialize(array.shape)
+                value.data[...] = array
+            else:
+                value[...] = array
+
     def to_variational_dropout(self):
         """Make myself to use variational dropout
 
@@ -451,3 +1459,114 @@ class VariationalDropoutChain(chainer.link.Chain):
         for name, link in sorted(
                 self.namedlinks(skipself=True), key=lambda x: x[0]):
             to_variational_dropout_link(self, name, link)
+
+
+class MetricsAccumulator(object):
+    """Running sums of metrics kept on the device
+
+    Values are added without synchronization, each with an optional
+    boolean array of validity (e.g., False for a NaN loss),
+    and their means are reported only at :meth:`report`.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, values, ok=None):
+        count = 1 if ok is None else ok.astype(numpy.int32)
+        for key, value in values.items():
+            if key in self.sums:
+                self.sums[key] = self.sums[key] + value
+                self.counts[key] = self.counts[key] + count
+            else:
+                self.sums[key] = value
+                self.counts[key] = count
+
+    def report(self, observer):
+        means = {}
+        for key, value in self.sums.items():
+            count = float(self.counts[key])
+            if count > 0:
+                means[key] = float(value) / count
+        self.sums = {}
+        self.counts = {}
+        reporter.report(means, observer)
+
+
+class AccumulatedReport(training.Extension):
+    """Trainer extension to report metrics accumulated in calc_loss
+
+    This sets a :class:`MetricsAccumulator` to ``target.metrics``
+    and reports the means at every trigger,
+    which should be the same as that of ``LogReport``.
+    Stats of VD (see :func:`calculate_stats`) are also calculated
+    and reported only at the trigger if ``stats`` is True
+    (otherwise, they are not calculated in training).
+    """
+
+    priority = training.PRIORITY_WRITER
+
+    def __init__(self, target, trigger=(1, 'epoch'), stats=True):
+        self.target = target
+        self.trigger = trigger
+        self.stats = stats
+        target.metrics = MetricsAccumulator()
+
+    def __call__(self, trainer):
+        self.target.metrics.report(self.target)
+        if self.stats:
+            reporter.report(calculate_stats(self.target), self.target)
+
+
+class MaskNaNUpdate(object):
+    """Optimizer hook cancelling updates at NaN losses without synchronization
+
+    :meth:`VariationalDropoutChain.calc_loss` keeps the validity of its losses
+    since the last update as ``loss_ok`` of the target.
+    Before each update, this hook takes it and registers hooks on the update
+    rule of each parameter, which copy the parameter and its optimizer states
+    before the update and put them back where the losses are invalid after it.
+    Thus an update at a NaN loss leaves them unchanged,
+    while ``t`` of the update rules still advances.
+    """
+
+    name = 'MaskNaNUpdate'
+    timing = 'pre'
+
+    def __init__(self):
+        self.ok = None
+        self._rules = set()
+        self._old = None
+
+    def __call__(self, optimizer):
+        target = optimizer.target
+        self.ok = getattr(target, 'loss_ok', None)
+        target.loss_ok = None
+        for param in target.params():
+            rule = param.update_rule
+            if rule is not None and rule not in self._rules:
+                rule.add_hook(self._save, name='mask_nan_update/save',
+                              timing='pre')
+                rule.add_hook(self._restore, name='mask_nan_update/restore',
+                              timing='post')
+                self._rules.add(rule)
+
+    def _arrays(self, rule, param):
+        return [param.data] + [value for value in rule.state.values()
+                               if value is not None]
+
+    def _save(self, rule, param):
+        if self.ok is None or param.data is None:
+            self._old = None
+        else:
+            self._old = [a.copy() for a in self._arrays(rule, param)]
+
+    def _restore(self, rule, param):
+        if self._old is None:
+            return
+        xp = cuda.get_array_module(param.data)
+        invalid = ~self.ok
+        for new, old in zip(self._arrays(rule, param), self._old):
+            xp.copyto(new, old, where=invalid)
+        self._old = None
@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import numpy
 
 import chainer
@@ -5,9 +8,262 @@ from chainer import cuda
 from chainer import function
 from chainer import functions as F
 from chainer import utils
+from chainer.utils import conv
 from chainer.utils import type_check
 from chainer import configuration
 import cupy
+from scipy import sparse
+
+
+configuration.config.user_regenerate_noise = False
+# If True, functions using variational dropout keep only a seed and
+# a counter of their noise and regenerate it in backward
+# instead of storing it until backward.
+
+_noise_key = None
+_noise_counter = 0
+
+
+def seed_noise(seed):
+    """Set the key of counter-based noise and reset its counter"""
+    global _noise_key, _noise_counter
+    _noise_key = int(seed)
+    _noise_counter = 0
+
+
+def _next_noise_seed():
+    global _noise_key, _noise_counter
+    if _noise_key is None:
+        _noise_key = int(numpy.random.randint(2 ** 62))
+    _noise_counter += 1
+    return _noise_key, _noise_counter
+
+
+class replay_noise(object):
+    """Context to draw the same noise again, e.g., in recomputation
+
+    Noise in the context is drawn from counter-based seeds
+    (as with ``user_regenerate_noise``).
+    The seeds are recorded at the first entry
+    and used in the same order at later entries.
+    """
+
+    _current = None
+
+    def __init__(self):
+        self.seeds = []
+        self.recorded = False
+
+    def __enter__(self):
+        self._previous = replay_noise._current
+        self._index = 0
+        replay_noise._current = self
+        return self
+
+    def __exit__(self, *args):
+        replay_noise._current = self._previous
+        self.recorded = True
+
+    def next_seed(self):
+        if not self.recorded:
+            self.seeds.append(_next_noise_seed())
+        seed = self.seeds[self._index]
+        self._index += 1
+        return seed
+
+
+def _counter_based_normal(seed, shape, dtype, xp):
+    key, counter = seed
+    if xp is numpy:
+        generator = numpy.random.Generator(numpy.random.Philox(
+            key=numpy.array([key, counter], dtype=numpy.uint64)))
+        noise = generator.standard_normal(shape, dtype=numpy.float32)
+    else:
+        from cupy.cuda import curand
+        random_state = cupy.random.RandomState(
+            (key ^ (counter * 0x9E3779B97F4A7C15)) & (2 ** 63 - 1),
+            method=curand.CURAND_RNG_PSEUDO_PHILOX4_32_10)
+        noise = random_state.standard_normal(shape, dtype=numpy.float32)
+    return noise.astype(dtype, copy=False)
+
+
+class NoiseEngine(object):
+    """Float32 standard normal noise for functions using variational dropout
+
+    Noise on CPU is drawn by ``numpy.random.Generator``
+    directly into float32 buffers.
+    If ``n_prefill_blocks`` > 0, a background thread pre-fills a ring of
+    up to ``n_prefill_blocks`` noise blocks of ``block_size`` elements,
+    from which noise of the next steps is served as views.
+    Noise on GPU is drawn by ``cupy.random`` in float32.
+    If ``seed`` is None, it is drawn from ``numpy.random``,
+    so that ``numpy.random.seed`` makes runs reproducible.
+    """
+
+    def __init__(self, seed=None, n_prefill_blocks=0, block_size=2 ** 20):
+        if seed is None:
+            seed = int(numpy.random.randint(2 ** 62))
+        seed_sequences = numpy.random.SeedSequence(seed).spawn(2)
+        self.generator = numpy.random.Generator(
+            numpy.random.PCG64(seed_sequences[0]))
+        self.block_size = block_size
+        self.n_prefill_blocks = n_prefill_blocks
+        self._block = None
+        self._offset = 0
+        self._ring = None
+        if n_prefill_blocks > 0:
+            self._prefill_generator = numpy.random.Generator(
+                numpy.random.PCG64(seed_sequences[1]))
+            self._ring = queue.Queue(maxsize=n_prefill_blocks)
+            self._closed = threading.Event()
+            self._thread = threading.Thread(target=self._prefill)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _prefill(self):
+        while not self._closed.is_set():
+            block = numpy.empty(self.block_size, dtype=numpy.float32)
+            self._prefill_generator.standard_normal(
+                dtype=numpy.float32, out=block)
+            while not self._closed.is_set():
+                try:
+                    self._ring.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def close(self):
+        """Stop the background thread"""
+        if self._ring is not None:
+            self._closed.set()
+            self._thread.join()
+            self._ring = None
+
+    def standard_normal(self, shape, dtype, xp=numpy):
+        if xp is not numpy:
+            return xp.random.standard_normal(
+                shape, dtype=numpy.float32).astype(dtype, copy=False)
+        size = int(numpy.prod(shape))
+        if self._ring is None or size > self.block_size:
+            noise = numpy.empty(shape, dtype=numpy.float32)
+            self.generator.standard_normal(dtype=numpy.float32, out=noise)
+        else:
+            if self._block is None or self._offset + size > self.block_size:
+                self._block = self._ring.get()
+                self._offset = 0
+            noise = self._block[self._offset:self._offset + size].reshape(
+                shape)
+            self._offset += size
+        return noise.astype(dtype, copy=False)
+
+
+_noise_engine = None
+
+
+def get_noise_engine():
+    """Get the noise source of functions using variational dropout
+
+    The default engine is seeded by ``numpy.random`` at the first call.
+    """
+    global _noise_engine
+    if _noise_engine is None:
+        _noise_engine = NoiseEngine()
+    return _noise_engine
+
+
+def set_noise_engine(engine):
+    """Set the noise source of functions using variational dropout
+
+    ``engine`` has ``standard_normal(shape, dtype, xp)``
+    like :class:`NoiseEngine`. If None, the default engine is used.
+    """
+    global _noise_engine
+    if _noise_engine is not None and _noise_engine is not engine and \
+            hasattr(_noise_engine, 'close'):
+        _noise_engine.close()
+    _noise_engine = engine
+
+
+def _sample_noise(func, shape, dtype, xp):
+    """Draw standard normal noise and keep it (or its seed) on func"""
+    if replay_noise._current is not None:
+        func.noise_seed = replay_noise._current.next_seed()
+        func.normal_noise = None
+        return _counter_based_normal(func.noise_seed, shape, dtype, xp)
+    if configuration.config.user_regenerate_noise:
+        func.noise_seed = _next_noise_seed()
+        func.normal_noise = None
+        return _counter_based_normal(func.noise_seed, shape, dtype, xp)
+    func.normal_noise = get_noise_engine().standard_normal(shape, dtype, xp)
+    return func.normal_noise
+
+
+def _restore_noise(func, shape, dtype, xp):
+    """Get the noise drawn in forward by _sample_noise"""
+    if func.normal_noise is not None:
+        return func.normal_noise
+    return _counter_based_normal(func.noise_seed, shape, dtype, xp)
+
+
+configuration.config.user_workspace_pool = True
+# If True, CPU kernels of functions using variational dropout write
+# their temporaries into arrays of the workspace pool reused over calls.
+
+
+class WorkspacePool(object):
+    """Shape-keyed pool of temporary arrays of CPU kernels
+
+    ``get(tag, shape, dtype)`` returns an uninitialized array kept for
+    the tag (the role of the temporary), shape and dtype,
+    and the same array is returned again at later calls.
+    So a workspace is valid only during one forward or backward
+    and is never returned as an output or a gradient.
+    ``hits`` and ``misses`` count reused and newly allocated workspaces
+    and ``nbytes`` is the memory held by the pool.
+    The pool keeps one array for each distinct key, e.g., a few arrays
+    of each weight shape of the model, and never releases them until
+    :meth:`clear` is called. Temporaries of the whole model
+    (e.g., of :class:`FusedKL`) are not pooled.
+    """
+
+    def __init__(self):
+        self._arrays = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tag, shape, dtype):
+        if not configuration.config.user_workspace_pool:
+            return numpy.empty(shape, dtype=dtype)
+        key = (tag, tuple(shape), numpy.dtype(dtype))
+        array = self._arrays.get(key)
+        if array is None:
+            self.misses += 1
+            array = numpy.empty(shape, dtype=dtype)
+            self._arrays[key] = array
+        else:
+            self.hits += 1
+        return array
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def clear(self):
+        """Release all workspaces and reset the counters"""
+        self._arrays.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_workspace_pool = WorkspacePool()
+
+
+def get_workspace_pool():
+    """Get the workspace pool shared by functions using variational dropout
+
+    The pool is not thread-safe; the functions are called from one thread.
+    """
+    return _workspace_pool
 
 
 def compositional_calculate_kl(W, log_sigma2, loga_threshold=3.,
@@ -26,9 +282,13 @@ def compositional_calculate_kl(W, log_sigma2, loga_threshold=3.,
     return _calculate_kl(W, log_sigma2)
 
 
-def _sigmoid(x):
+def _sigmoid(x, out=None):
     half = x.dtype.type(0.5)
-    return numpy.tanh(x * half) * half + half
+    y = numpy.multiply(x, half, out=out)
+    numpy.tanh(y, out=y)
+    y *= half
+    y += half
+    return y
 
 
 def _grad_sigmoid(x):
@@ -55,21 +315,33 @@ class KL(function.Function):
     def backward_cpu(self, inputs, gy):
         log_alpha = inputs[0]
         gy = gy[0]
-
-        sig = _sigmoid(1.87320 + 1.48695 * log_alpha)
-        exp_m_log_alpha = numpy.exp(- log_alpha)
-
-        reg = (0.63576 * sig) + \
-              (- 0.5 * numpy.log1p(exp_m_log_alpha)) - 0.63576
-        reg = reg * (1. - self.clip_mask)
-
-        greg = - gy / log_alpha.size * reg
-
-        gla_from_1 = greg * 0.63576 * _grad_sigmoid(sig) * 1.48695
-        gla_from_2 = greg * \
-            (- 0.5) / (1. + exp_m_log_alpha) * exp_m_log_alpha
-
-        gla = gla_from_1 + gla_from_2
+        pool = get_workspace_pool()
+        shape, dtype = log_alpha.shape, log_alpha.dtype
+
+        sig = numpy.multiply(log_alpha, 1.48695,
+                             out=pool.get('kl/sig', shape, dtype))
+        sig += 1.87320
+        _sigmoid(sig, out=sig)
+        exp_m_log_alpha = numpy.negative(
+            log_alpha, out=pool.get('kl/exp_m_log_alpha', shape, dtype))
+        numpy.exp(exp_m_log_alpha, out=exp_m_log_alpha)
+
+        # greg = - gy / size * (1 - clip_mask)
+        greg = numpy.subtract(1., self.clip_mask,
+                              out=pool.get('kl/greg', shape, dtype))
+        greg *= - gy / log_alpha.size
+
+        gla_from_1 = numpy.subtract(
+            1., sig, out=pool.get('kl/tmp', shape, dtype))
+        gla_from_1 *= sig
+        gla_from_1 *= greg
+        gla_from_1 *= 0.63576 * 1.48695
+
+        gla = numpy.add(exp_m_log_alpha, 1.)
+        numpy.divide(exp_m_log_alpha, gla, out=gla)
+        gla *= greg
+        gla *= 0.5
+        gla += gla_from_1
         gla = utils.force_array(gla, log_alpha.dtype)
         return gla,
 
@@ -104,11 +376,9 @@ class KL(function.Function):
             const T c148695 = 1.48695;
             T sig = (tanh((1.87320 + c148695 * la) * half) * half + half);
             T exp_m_la = exp(- la);
-            T reg = (c063576 * sig - 
-                     half * log1p(exp_m_la) - c063576) * (c1 - clip);
-            T greg = - gy * reg;
+            T greg = - gy * (c1 - clip);
             gla = greg * (c063576 * (sig * (c1 - sig)) * c148695
-                          - half / (c1 + exp_m_la) * exp_m_la)
+                          + half / (c1 + exp_m_la) * exp_m_la)
             ''',
             'kl_bwd')(
                 (gy / log_alpha.size).astype(log_alpha.dtype),
@@ -118,32 +388,273 @@ class KL(function.Function):
 
 def calculate_kl(W=None, loga_threshold=3.,
                  log_sigma2=None, log_alpha=None,
-                 eps=1e-8, thresholds=(-8., 8.)):
+                 eps=1e-8, thresholds=(-8., 8.), clip_mask=None):
     if log_alpha is None:
         if log_sigma2 is None or W is None:
             AttributeError()
         log_alpha = calculate_log_alpha(
             W, log_sigma2, eps=eps, thresholds=thresholds)
-    clip_mask = (log_alpha.data > loga_threshold).astype(
-        log_alpha.data.dtype, copy=False)
+    if clip_mask is None:
+        clip_mask = (log_alpha.data > loga_threshold).astype(
+            log_alpha.data.dtype, copy=False)
     return KL(clip_mask)(log_alpha)
 
 
+_kl_segments_cache = {}
+
+
+def _kl_segments(shapes, loga_thresholds, dtype, xp):
+    """Per-element normalizers and thresholds of flattened layers"""
+    key = (tuple(shapes), tuple(loga_thresholds), numpy.dtype(dtype), xp)
+    if key not in _kl_segments_cache:
+        sizes = [int(numpy.prod(shape)) for shape in shapes]
+        scale = numpy.repeat(
+            numpy.array([1. / size for size in sizes], dtype=dtype), sizes)
+        threshold = numpy.repeat(
+            numpy.array(loga_thresholds, dtype=dtype), sizes)
+        if xp is not numpy:
+            scale, threshold = cuda.to_gpu(scale), cuda.to_gpu(threshold)
+        _kl_segments_cache.clear()
+        _kl_segments_cache[key] = scale, threshold
+    return _kl_segments_cache[key]
+
+
+_FUSED_KL_REG = '''
+template <typename T> __device__ T vd_kl_reg(T la, T th) {
+    if (la > th) {
+        return 0;
+    }
+    const T half = 0.5;
+    const T c063576 = 0.63576;
+    return c063576 *
+        (tanh(((T)1.87320 + (T)1.48695 * la) * half) * half + half)
+        - half * log1p(exp(-la)) - c063576;
+}
+'''
+
+_FUSED_KL_GRAD = '''
+const T half = 0.5;
+const T c1 = 1.0;
+const T c063576 = 0.63576;
+const T c148695 = 1.48695;
+T square_W = W * W + eps;
+T y = %s;
+T la = min(max(y, lo_th), up_th);
+if (la > th || !((y > lo_th) & (y < up_th))) {
+    gs = 0;
+} else {
+    T sig = (tanh((1.87320 + c148695 * la) * half) * half + half);
+    T exp_m_la = exp(- la);
+    T greg = - gy * scale;
+    gs = greg * (c063576 * (sig * (c1 - sig)) * c148695
+                 + half / (c1 + exp_m_la) * exp_m_la);
+}
+gW = - gs / square_W * 2 * W;
+'''
+
+
+class FusedKL(function.Function):
+    """KL divergence summed over layers using variational dropout.
+
+    This function takes W_1, ..., W_n and log sigma^2_1, ..., log sigma^2_n
+    and computes the sum of KL of the layers (each is normalized by its size)
+    in one elementwise pass with log alpha over all the weights.
+    If ``flat`` is a pair of flat buffers of which W_i and log sigma^2_i
+    are consecutive views, the buffers are used without concatenation.
+    If ``log_alphas`` is given, the arrays are used as log alpha
+    of the layers (e.g., log alpha cached in an update step)
+    instead of recomputation of log(W ** 2 + eps) and the clip.
+    Gradients are the same as those of :class:`KL` through :class:`LogAlpha`.
+    """
+
+    def __init__(self, loga_thresholds, eps=1e-8,
+                 lower_threshold=-8., upper_threshold=8., flat=None,
+                 log_alphas=None):
+        self.loga_thresholds = loga_thresholds
+        self.eps = eps
+        self.lower_threshold = lower_threshold
+        self.upper_threshold = upper_threshold
+        self.flat = flat
+        self.log_alphas = log_alphas
+
+    def check_type_forward(self, in_types):
+        pass
+
+    def _flatten(self, inputs, with_W=True):
+        # Flat W, log sigma^2 (None if log alpha is given) and log alpha
+        # (None if not given) with per-element normalizers and thresholds
+        n = len(inputs) // 2
+        xp = cuda.get_array_module(inputs[0])
+        W = log_sigma2 = log_alpha = None
+        if self.log_alphas is not None:
+            log_alpha = xp.concatenate(
+                [x.ravel() for x in self.log_alphas])
+        if self.flat is not None:
+            W, log_sigma2 = self.flat
+        else:
+            if with_W:
+                W = xp.concatenate([x.ravel() for x in inputs[:n]])
+            if log_alpha is None:
+                log_sigma2 = xp.concatenate([x.ravel() for x in inputs[n:]])
+        scale, threshold = _kl_segments(
+            [x.shape for x in inputs[:n]], self.loga_thresholds,
+            inputs[0].dtype, xp)
+        return W, log_sigma2, log_alpha, scale, threshold
+
+    def _split(self, flat_grad, inputs):
+        grads = []
+        offset = 0
+        for x in inputs:
+            grads.append(flat_grad[offset:offset + x.size].reshape(x.shape))
+            offset += x.size
+        return grads
+
+    def forward_cpu(self, inputs):
+        W, log_sigma2, log_alpha, scale, threshold = self._flatten(
+            inputs, with_W=self.log_alphas is None)
+        if log_alpha is None:
+            log_alpha = numpy.square(W)
+            log_alpha += self.eps
+            numpy.log(log_alpha, out=log_alpha)
+            numpy.subtract(log_sigma2, log_alpha, out=log_alpha)
+            numpy.clip(log_alpha, self.lower_threshold, self.upper_threshold,
+                       out=log_alpha)
+        reg = (0.63576 * _sigmoid(1.87320 + 1.48695 * log_alpha)) + \
+              (- 0.5 * numpy.log1p(numpy.exp(- log_alpha))) - 0.63576
+        reg *= scale
+        reg *= log_alpha <= threshold
+        return utils.force_array(- reg.sum(), inputs[0].dtype),
+
+    def backward_cpu(self, inputs, gy):
+        n = len(inputs) // 2
+        W, log_sigma2, log_alpha, scale, threshold = self._flatten(inputs)
+        gy = gy[0]
+        # Temporaries are as large as the whole model,
+        # so they are not kept in the workspace pool
+        square_W = numpy.square(W)
+        square_W += self.eps
+        if log_alpha is None:
+            log_alpha = numpy.log(square_W)
+            numpy.subtract(log_sigma2, log_alpha, out=log_alpha)
+            numpy.clip(log_alpha, self.lower_threshold,
+                       self.upper_threshold, out=log_alpha)
+        # Clipped log alpha is strictly in range only where it is not clipped
+        in_range = numpy.greater(log_alpha, self.lower_threshold)
+        mask = numpy.less(log_alpha, self.upper_threshold)
+        in_range &= mask
+
+        sig = numpy.multiply(log_alpha, 1.48695)
+        sig += 1.87320
+        _sigmoid(sig, out=sig)
+        exp_m_log_alpha = numpy.negative(log_alpha)
+        numpy.exp(exp_m_log_alpha, out=exp_m_log_alpha)
+
+        # greg = - gy * scale (zero over the threshold)
+        greg = numpy.less_equal(log_alpha, threshold, out=mask).astype(
+            log_alpha.dtype)
+        greg *= scale
+        greg *= - gy
+
+        gla_from_1 = numpy.subtract(1., sig)
+        gla_from_1 *= sig
+        gla_from_1 *= greg
+        gla_from_1 *= 0.63576 * 1.48695
+
+        gs = numpy.add(exp_m_log_alpha, 1.)
+        numpy.divide(exp_m_log_alpha, gs, out=gs)
+        gs *= greg
+        gs *= 0.5
+        gs += gla_from_1
+        gs *= in_range
+        gs = utils.force_array(gs, inputs[n].dtype)
+        gW = numpy.divide(gs, square_W)
+        gW *= - 2.
+        gW *= W
+        gW = utils.force_array(gW, W.dtype)
+        return tuple(self._split(gW, inputs[:n]) +
+                     self._split(gs, inputs[n:]))
+
+    def forward_gpu(self, inputs):
+        W, log_sigma2, log_alpha, scale, threshold = self._flatten(
+            inputs, with_W=self.log_alphas is None)
+        dtype = inputs[0].dtype.type
+        if log_alpha is not None:
+            return cuda.reduce(
+                'T la, T scale, T th', 'T kl',
+                'scale * vd_kl_reg(la, th)',
+                'a + b', 'kl = -a', '0', 'fused_kl_la_fwd',
+                preamble=_FUSED_KL_REG)(log_alpha, scale, threshold),
+        return cuda.reduce(
+            'T W, T ls, T scale, T th, T eps, T lo_th, T up_th',
+            'T kl',
+            'scale * vd_kl_reg('
+            'min(max(ls - log(W * W + eps), lo_th), up_th), th)',
+            'a + b', 'kl = -a', '0', 'fused_kl_fwd',
+            preamble=_FUSED_KL_REG)(
+                W, log_sigma2, scale, threshold, dtype(self.eps),
+                dtype(self.lower_threshold), dtype(self.upper_threshold)),
+
+    def backward_gpu(self, inputs, gy):
+        n = len(inputs) // 2
+        W, log_sigma2, log_alpha, scale, threshold = self._flatten(inputs)
+        dtype = W.dtype.type
+        if log_alpha is not None:
+            gW, gs = cuda.elementwise(
+                'T W, T la0, T scale, T th, T gy, T eps, T lo_th, T up_th',
+                'T gW, T gs',
+                _FUSED_KL_GRAD % 'la0',
+                'fused_kl_la_bwd')(
+                    W, log_alpha, scale, threshold, gy[0], dtype(self.eps),
+                    dtype(self.lower_threshold), dtype(self.upper_threshold))
+        else:
+            gW, gs = cuda.elementwise(
+                'T W, T ls, T scale, T th, T gy, T eps, T lo_th, T up_th',
+                'T gW, T gs',
+                _FUSED_KL_GRAD % 'ls - log(square_W)',
+                'fused_kl_bwd')(
+                    W, log_sigma2, scale, threshold, gy[0], dtype(self.eps),
+                    dtype(self.lower_threshold), dtype(self.upper_threshold))
+        return tuple(self._split(gW, inputs[:n]) +
+                     self._split(gs, inputs[n:]))
+
+
+def calculate_kl_all(Ws, log_sigma2s, loga_thresholds,
+                     eps=1e-8, thresholds=(-8., 8.), flat=None,
+                     log_alphas=None):
+    """Sum of KL of layers using variational dropout in one function call
+
+    ``flat`` is an optional pair of flat buffers (arrays, not Variables)
+    of which ``Ws`` and ``log_sigma2s`` are consecutive views.
+    ``log_alphas`` is an optional list of arrays (not Variables)
+    of precomputed log alpha of the layers.
+    """
+    lower_threshold, upper_threshold = thresholds
+    return FusedKL(loga_thresholds, eps, lower_threshold, upper_threshold,
+                   flat=flat, log_alphas=log_alphas)(
+                       *(list(Ws) + list(log_sigma2s)))
+
+
 class LogAlpha(function.Function):
     """Function calculate log alpha from W and log sigma^2.
 
     This function is memory-efficient by recomputing in backward.
+    If ``precomputed`` is given, forward returns it as log alpha
+    without recomputation (e.g., log alpha cached in an update step).
     """
 
-    def __init__(self, eps=1e-8, lower_threshold=-8., upper_threshold=8.):
+    def __init__(self, eps=1e-8, lower_threshold=-8., upper_threshold=8.,
+                 precomputed=None):
         self.eps = eps
         self.lower_threshold = lower_threshold
         self.upper_threshold = upper_threshold
+        self.precomputed = precomputed
 
     def check_type_forward(self, in_types):
         pass
 
     def forward_cpu(self, inputs):
+        if self.precomputed is not None:
+            return self.precomputed,
         W, log_sigma2 = inputs
         log_alpha = log_sigma2 - numpy.log(numpy.square(W) + self.eps)
         log_alpha = utils.force_array(
@@ -155,18 +666,29 @@ class LogAlpha(function.Function):
     def backward_cpu(self, inputs, gy):
         W, log_sigma2 = inputs
         gy = gy[0]
-        square_W = numpy.square(W) + self.eps
-        log_alpha = log_sigma2 - numpy.log(square_W)
-        clip = (self.lower_threshold < log_alpha) * \
-               (log_alpha < self.upper_threshold)
-        clip_gy = gy * clip
-        gs = clip_gy
-        gW = - clip_gy / square_W * 2. * W
-        gs = utils.force_array(gs, log_sigma2.dtype)
+        pool = get_workspace_pool()
+        square_W = numpy.square(
+            W, out=pool.get('log_alpha/square_W', W.shape, W.dtype))
+        square_W += self.eps
+        log_alpha = numpy.log(
+            square_W, out=pool.get('log_alpha/log_alpha', W.shape, W.dtype))
+        numpy.subtract(log_sigma2, log_alpha, out=log_alpha)
+        clip = numpy.greater(
+            log_alpha, self.lower_threshold,
+            out=pool.get('log_alpha/clip', W.shape, numpy.bool_))
+        clip &= numpy.less(
+            log_alpha, self.upper_threshold,
+            out=pool.get('log_alpha/clip_upper', W.shape, numpy.bool_))
+        gs = utils.force_array(gy * clip, log_sigma2.dtype)
+        gW = numpy.divide(gs, square_W)
+        gW *= - 2.
+        gW *= W
         gW = utils.force_array(gW, W.dtype)
         return gW, gs
 
     def forward_gpu(self, inputs):
+        if self.precomputed is not None:
+            return self.precomputed,
         W, log_sigma2 = inputs
         return cuda.elementwise(
             'T W, T ls, T eps, T lo_th, T up_th',
@@ -194,9 +716,11 @@ class LogAlpha(function.Function):
         return gW, gs
 
 
-def calculate_log_alpha(W, log_sigma2, eps=1e-8, thresholds=(-8., 8.)):
+def calculate_log_alpha(W, log_sigma2, eps=1e-8, thresholds=(-8., 8.),
+                        precomputed=None):
     lower_threshold, upper_threshold = thresholds
-    return LogAlpha(eps, lower_threshold, upper_threshold)(W, log_sigma2)
+    return LogAlpha(eps, lower_threshold, upper_threshold,
+                    precomputed=precomputed)(W, log_sigma2)
 
 
 def _as_mat(x):
@@ -204,13 +728,14 @@ def _as_mat(x):
         return x
     return x.reshape(len(x), -1)
 
-# TODO: RNNVDLinear: efficient multiple (sampled) Linear re-using calculations.
-
 
 class VDLinear(function.Function):
     """Linear function using variational dropout.
 
     This function is memory-efficient by recomputing in backward.
+    It takes log alpha computed by :func:`calculate_log_alpha`;
+    :class:`VDLinearWithLogAlpha` merges the computation of log alpha
+    and reuses ``W ** 2`` instead.
     """
 
     def __init__(self, clip_mask,
@@ -224,16 +749,13 @@ class VDLinear(function.Function):
         pass
 
     def forward_cpu(self, inputs):
-        # TODO: merge calculate_log_alpha and reuse W ** 2
         x, W, log_alpha = inputs[:3]
         x = _as_mat(x)
         W = ((1. - self.clip_mask) * W).astype(W.dtype, copy=False)
         mu = x.dot(W.T)
         si = numpy.sqrt(
             (x * x).dot((numpy.exp(log_alpha) * W * W).T) + self.eps)
-        self.normal_noise = numpy.random.standard_normal(mu.shape).astype(
-            x.dtype, copy=False)
-        y = mu + si * self.normal_noise
+        y = mu + si * _sample_noise(self, mu.shape, x.dtype, numpy)
         if len(inputs) == 4:
             b = inputs[3]
             y += b
@@ -241,7 +763,6 @@ class VDLinear(function.Function):
 
     def forward_gpu(self, inputs):
         # TODO: cuda kernel
-        # TODO: merge calculate_log_alpha and reuse W ** 2
         x, W, log_alpha = inputs[:3]
         x = _as_mat(x)
         W, alpha_W2 = cuda.elementwise(
@@ -256,8 +777,7 @@ class VDLinear(function.Function):
         x2 = x * x
         mu = x.dot(W.T)
         si2 = x2.dot(alpha_W2.T)
-        self.normal_noise = cupy.random.standard_normal(mu.shape).astype(
-            x.dtype, copy=False)
+        normal_noise = _sample_noise(self, mu.shape, x.dtype, cupy)
         y = cuda.elementwise(
             'T mu, T si2, T eps, T noise',
             'T y',
@@ -265,43 +785,57 @@ class VDLinear(function.Function):
             y = mu + sqrt(si2 + eps) * noise;
             ''',
             'vdl2_fwd')(
-                mu, si2, self.eps, self.normal_noise)
+                mu, si2, self.eps, normal_noise)
         if len(inputs) == 4:
             b = inputs[3]
             y += b
         return y,
 
     def backward_cpu(self, inputs, gy):
-        # TODO: merge calculate_log_alpha and reuse W ** 2
         x, W, log_alpha = inputs[:3]
         x = _as_mat(x)
         gy = gy[0]
 
-        clip = (1. - self.clip_mask).astype(W.dtype, copy=False)
-        clip_W = clip * W
-        x2 = x * x
-        W2 = clip_W * clip_W
-        alpha = numpy.exp(log_alpha)
-        alpha_W2 = W2 * alpha
-        si_before_sqrt = x2.dot(alpha_W2.T) + self.eps
-
-        gmu = gy
-        gx_from_gmu = gmu.dot(clip_W)
-        gW_from_gmu = gmu.T.dot(x) * clip
-
-        gsi = gy * self.normal_noise
-        gsi_before_sqrt = gsi * (0.5 / numpy.sqrt(si_before_sqrt))
-        gx2_from_gsi = gsi_before_sqrt.dot(alpha_W2)
-        gx_from_gsi = gx2_from_gsi * (2. * x)
-        galpha_W2_from_gsi = gsi_before_sqrt.T.dot(x2)
-        gW2_from_gsi = galpha_W2_from_gsi * alpha
-        gW_from_gsi = gW2_from_gsi * (2. * clip_W)
-        galpha_from_gsi = galpha_W2_from_gsi * W2
-        glog_alpha = galpha_from_gsi * numpy.exp(log_alpha)
-
-        gx = (gx_from_gmu + gx_from_gsi).astype(x.dtype, copy=False).reshape(
-            inputs[0].shape)
-        gW = (gW_from_gmu + gW_from_gsi).astype(W.dtype, copy=False)
+        pool = get_workspace_pool()
+        clip = numpy.subtract(1., self.clip_mask,
+                              out=pool.get('vdl/clip', W.shape, W.dtype))
+        clip_W = numpy.multiply(clip, W,
+                                out=pool.get('vdl/clip_W', W.shape, W.dtype))
+        x2 = numpy.square(x, out=pool.get('vdl/x2', x.shape, x.dtype))
+        W2 = numpy.square(clip_W,
+                          out=pool.get('vdl/W2', W.shape, W.dtype))
+        alpha = numpy.exp(log_alpha,
+                          out=pool.get('vdl/alpha', W.shape, W.dtype))
+        alpha_W2 = numpy.multiply(
+            W2, alpha, out=pool.get('vdl/alpha_W2', W.shape, W.dtype))
+
+        # gsi is the gradient w.r.t. si before sqrt
+        gsi = numpy.dot(x2, alpha_W2.T, out=pool.get(
+            'vdl/gsi', gy.shape, numpy.result_type(x2, alpha_W2)))
+        gsi += self.eps
+        numpy.sqrt(gsi, out=gsi)
+        numpy.divide(0.5, gsi, out=gsi)
+        gsi *= gy
+        gsi *= _restore_noise(self, gy.shape, x.dtype, numpy)
+
+        gx = gsi.dot(alpha_W2)
+        gx *= x
+        gx *= 2.
+        gx += gy.dot(clip_W)
+        gx = gx.astype(x.dtype, copy=False).reshape(inputs[0].shape)
+
+        galpha_W2 = numpy.dot(gsi.T, x2, out=pool.get(
+            'vdl/galpha_W2', W.shape, numpy.result_type(gsi, x2)))
+        glog_alpha = numpy.multiply(galpha_W2, W2)
+        glog_alpha *= alpha
+
+        gW = gy.T.dot(x)
+        gW *= clip
+        galpha_W2 *= alpha
+        galpha_W2 *= clip_W
+        galpha_W2 *= 2.
+        gW += galpha_W2
+        gW = gW.astype(W.dtype, copy=False)
         if len(inputs) == 4:
             gb = gy.sum(0)
             return gx, gW, glog_alpha, gb
@@ -309,7 +843,6 @@ class VDLinear(function.Function):
             return gx, gW, glog_alpha
 
     def backward_gpu(self, inputs, gy):
-        # TODO: merge calculate_log_alpha and reuse W ** 2
         x, W, log_alpha = inputs[:3]
         x = _as_mat(x)
         xp = cuda.get_array_module(x)
@@ -340,7 +873,8 @@ class VDLinear(function.Function):
             gsi_bf_sqrt = gy * noise * ((T)0.5 / sqrt(si_bf_sqrt + eps));
             ''',
             'gsi_bwd')(
-                gy, self.normal_noise, si_before_sqrt, self.eps)
+                gy, _restore_noise(self, gy.shape, x.dtype, cupy),
+                si_before_sqrt, self.eps)
 
         galpha_W2_from_gsi = gsi_before_sqrt.T.dot(x2)
         gW_from_gsi = galpha_W2_from_gsi * alpha * (2. * clip_W)
@@ -367,14 +901,15 @@ class VDLinear(function.Function):
 
 
 def vd_linear(x, W, b, loga_threshold=3., log_sigma2=None,
-              log_alpha=None, eps=1e-8, thresholds=(-8., 8.)):
+              log_alpha=None, eps=1e-8, thresholds=(-8., 8.), clip_mask=None):
     if log_alpha is None:
         if log_sigma2 is None:
             AttributeError()
         log_alpha = calculate_log_alpha(
             W, log_sigma2, eps=eps, thresholds=thresholds)
-    clip_mask = (log_alpha.data > loga_threshold).astype(
-        log_alpha.data.dtype, copy=False)
+    if clip_mask is None:
+        clip_mask = (log_alpha.data > loga_threshold).astype(
+            log_alpha.data.dtype, copy=False)
 
     train = configuration.config.train
     if train:
@@ -387,6 +922,677 @@ def vd_linear(x, W, b, loga_threshold=3., log_sigma2=None,
     else:
         return F.linear(x, (1. - clip_mask) * W, b)
 
+
+class VDLinearWithLogAlpha(function.Function):
+    """Linear function using variational dropout with log alpha merged.
+
+    This function takes W and log sigma^2 directly,
+    computes log alpha, the masked weight and alpha * W ** 2 at once
+    and returns gradients w.r.t. W and log sigma^2
+    without an intermediate log alpha node.
+    This function is memory-efficient by recomputing in backward.
+    If ``log_alpha`` is given, it is used instead of recomputation.
+    Temporaries on CPU are taken from the workspace pool.
+    """
+
+    pooled = True
+
+    def __init__(self, loga_threshold=3., eps=1e-8,
+                 lower_threshold=-8., upper_threshold=8., log_alpha=None):
+        self.loga_threshold = loga_threshold
+        self.eps = eps
+        self.lower_threshold = lower_threshold
+        self.upper_threshold = upper_threshold
+        self.log_alpha = log_alpha
+
+    def check_type_forward(self, in_types):
+        pass
+
+    def _weights_cpu(self, W, log_sigma2, out=None):
+        # W ** 2, log alpha and the mask are workspaces, while the masked W
+        # and alpha * W ** 2 are written into ``out`` (new arrays if None)
+        W2 = numpy.square(W, out=self._workspace('W2', W.shape, W.dtype))
+        if self.log_alpha is None:
+            log_alpha = numpy.add(
+                W2, self.eps,
+                out=self._workspace('log_alpha', W.shape, W.dtype))
+            numpy.log(log_alpha, out=log_alpha)
+            numpy.subtract(log_sigma2, log_alpha, out=log_alpha)
+            numpy.clip(log_alpha, self.lower_threshold, self.upper_threshold,
+                       out=log_alpha)
+        else:
+            log_alpha = self.log_alpha
+        keep = numpy.less_equal(
+            log_alpha, self.loga_threshold,
+            out=self._workspace('keep', W.shape, numpy.bool_))
+        if out is None:
+            clip_W = numpy.multiply(W, keep)
+            alpha_W2 = numpy.exp(log_alpha)
+        else:
+            clip_W = numpy.multiply(W, keep, out=out[0])
+            alpha_W2 = numpy.exp(log_alpha, out=out[1])
+        numpy.multiply(alpha_W2, W2, out=alpha_W2)
+        numpy.multiply(alpha_W2, keep, out=alpha_W2)
+        return W2, log_alpha, keep, clip_W, alpha_W2
+
+    def _workspace(self, tag, shape, dtype):
+        if not self.pooled:
+            return numpy.empty(shape, dtype=dtype)
+        return get_workspace_pool().get('vdla/' + tag, shape, dtype)
+
+    def _weight_workspaces(self, shape, dtype):
+        return (self._workspace('clip_W', shape, dtype),
+                self._workspace('alpha_W2', shape, dtype))
+
+    def _x2_si_cpu(self, x, alpha_W2, gy_shape):
+        # x ** 2 and its product with alpha * W ** 2 plus eps in workspaces
+        x2 = numpy.square(x, out=self._workspace('x2', x.shape, x.dtype))
+        si = numpy.dot(x2, alpha_W2.T, out=self._workspace(
+            'si', gy_shape, numpy.result_type(x2, alpha_W2)))
+        si += self.eps
+        return x2, si
+
+    def forward_cpu(self, inputs):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        clip_W, alpha_W2 = self._weights_cpu(
+            W, log_sigma2, out=self._weight_workspaces(W.shape, W.dtype))[3:]
+        y = x.dot(clip_W.T)
+        si = self._x2_si_cpu(x, alpha_W2, y.shape)[1]
+        numpy.sqrt(si, out=si)
+        si *= _sample_noise(self, y.shape, x.dtype, numpy)
+        y += si
+        if len(inputs) == 4:
+            y += inputs[3]
+        return y,
+
+    def backward_cpu(self, inputs, gy):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        gy = gy[0]
+        W2, log_alpha, keep, clip_W, alpha_W2 = self._weights_cpu(
+            W, log_sigma2, out=self._weight_workspaces(W.shape, W.dtype))
+
+        x2, gsi = self._x2_si_cpu(x, alpha_W2, gy.shape)
+        numpy.sqrt(gsi, out=gsi)
+        numpy.divide(0.5, gsi, out=gsi)
+        gsi *= gy
+        gsi *= _restore_noise(self, gy.shape, x.dtype, numpy)
+
+        gx = gsi.dot(alpha_W2)
+        gx *= x
+        gx *= 2.
+        gx += gy.dot(clip_W)
+        gx = gx.astype(x.dtype, copy=False).reshape(inputs[0].shape)
+
+        gW, glog_sigma2 = self._grad_params_cpu(
+            gy.T.dot(x), gsi.T.dot(x2), W2, log_alpha, keep, clip_W, alpha_W2)
+        gW = gW.astype(W.dtype, copy=False)
+        glog_sigma2 = glog_sigma2.astype(log_sigma2.dtype, copy=False)
+
+        if len(inputs) == 4:
+            gb = gy.sum(0)
+            return gx, gW, glog_sigma2, gb
+        else:
+            return gx, gW, glog_sigma2
+
+    def _grad_params_cpu(self, gW_from_gmu, galpha_W2,
+                         W2, log_alpha, keep, clip_W, alpha_W2):
+        shape = log_alpha.shape
+        in_range = numpy.greater(
+            log_alpha, self.lower_threshold,
+            out=self._workspace('in_range', shape, numpy.bool_))
+        in_range &= numpy.less(
+            log_alpha, self.upper_threshold,
+            out=self._workspace('mask', shape, numpy.bool_))
+
+        # d(alpha * W ** 2) / d(log sigma^2) = alpha * W ** 2 in range
+        glog_sigma2 = numpy.multiply(galpha_W2, alpha_W2)
+        numpy.multiply(glog_sigma2, in_range, out=glog_sigma2)
+
+        # d(alpha * W ** 2) / dW = 2 * alpha * W * (eps / (W ** 2 + eps))
+        # in range, 2 * alpha * W out of range
+        numpy.add(W2, self.eps, out=W2)
+        numpy.divide(self.eps, W2, out=W2)
+        numpy.copyto(W2, 1., where=numpy.logical_not(in_range, out=in_range))
+        numpy.multiply(W2, clip_W, out=W2)
+        numpy.multiply(W2, numpy.exp(log_alpha, out=self._workspace(
+            'alpha', shape, log_alpha.dtype)), out=W2)
+        numpy.multiply(galpha_W2, W2, out=galpha_W2)
+        galpha_W2 *= 2.
+        gW = numpy.multiply(gW_from_gmu, keep, out=gW_from_gmu)
+        gW += galpha_W2
+        return gW, glog_sigma2
+
+    def _log_alpha_gpu(self, W, log_sigma2):
+        if self.log_alpha is not None:
+            return self.log_alpha
+        return cuda.elementwise(
+            'T W, T ls, T eps, T lo_th, T up_th',
+            'T y',
+            'y = min(max(ls - log(W * W + eps), lo_th), up_th)',
+            'log_alpha_fwd')(
+                W, log_sigma2,
+                self.eps, self.lower_threshold, self.upper_threshold)
+
+    def _weights_gpu(self, W, log_alpha):
+        return cuda.elementwise(
+            'T W, T la, T th',
+            'T clip_W, T alpha_W2',
+            '''
+            clip_W = (la > th) ? (T)0 : W;
+            alpha_W2 = exp(la) * clip_W * clip_W;
+            ''',
+            'vdla1_fwd')(
+                W, log_alpha, W.dtype.type(self.loga_threshold))
+
+    def forward_gpu(self, inputs):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        clip_W, alpha_W2 = self._weights_gpu(
+            W, self._log_alpha_gpu(W, log_sigma2))
+        mu = x.dot(clip_W.T)
+        si2 = (x * x).dot(alpha_W2.T)
+        normal_noise = _sample_noise(self, mu.shape, x.dtype, cupy)
+        y = cuda.elementwise(
+            'T mu, T si2, T eps, T noise',
+            'T y',
+            '''
+            y = mu + sqrt(si2 + eps) * noise;
+            ''',
+            'vdl2_fwd')(
+                mu, si2, self.eps, normal_noise)
+        if len(inputs) == 4:
+            y += inputs[3]
+        return y,
+
+    def backward_gpu(self, inputs, gy):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        gy = gy[0]
+        log_alpha = self._log_alpha_gpu(W, log_sigma2)
+        clip_W, alpha_W2 = self._weights_gpu(W, log_alpha)
+
+        x2 = x * x
+        gsi_before_sqrt = cuda.elementwise(
+            'T gy, T noise, T si_bf_sqrt, T eps',
+            'T gsi_bf_sqrt',
+            '''
+            gsi_bf_sqrt = gy * noise * ((T)0.5 / sqrt(si_bf_sqrt + eps));
+            ''',
+            'gsi_bwd')(
+                gy, _restore_noise(self, gy.shape, x.dtype, cupy),
+                x2.dot(alpha_W2.T), self.eps)
+        gx = gy.dot(clip_W) + gsi_before_sqrt.dot(alpha_W2) * 2. * x
+        gx = gx.astype(x.dtype, copy=False).reshape(inputs[0].shape)
+
+        gW, glog_sigma2 = self._grad_params_gpu(
+            gy.T.dot(x), gsi_before_sqrt.T.dot(x2), W, log_alpha)
+
+        if len(inputs) == 4:
+            gb = gy.sum(0)
+            return gx, gW, glog_sigma2, gb
+        else:
+            return gx, gW, glog_sigma2
+
+    def _grad_params_gpu(self, gW_from_gmu, galpha_W2, W, log_alpha):
+        return cuda.elementwise(
+            'T galpha_W2, T gW_from_gmu, T W, T la, '
+            'T eps, T lo_th, T up_th, T th',
+            'T gW, T gs',
+            '''
+            if (la > th) {
+                gW = 0;
+                gs = 0;
+            } else {
+                T W2 = W * W;
+                T alpha = exp(la);
+                bool in_range = (la > lo_th) && (la < up_th);
+                gs = in_range ? galpha_W2 * alpha * W2 : (T)0;
+                gW = gW_from_gmu + galpha_W2 * (T)2.0 * alpha * W *
+                    (in_range ? eps / (W2 + eps) : (T)1.0);
+            }
+            ''',
+            'vdla_bwd')(
+                galpha_W2, gW_from_gmu, W, log_alpha,
+                self.eps, self.lower_threshold, self.upper_threshold,
+                W.dtype.type(self.loga_threshold))
+
+
+class SparsePattern(object):
+    """Positions of weights handled by :class:`SparseVDLinear`
+
+    ``mask`` is a boolean array of the weight shape.
+    Weights out of the pattern are regarded as masked.
+    """
+
+    def __init__(self, mask):
+        self.shape = mask.shape
+        csr = sparse.csr_matrix(mask)
+        csr.sort_indices()
+        self.indptr = csr.indptr
+        self.indices = csr.indices
+        self.rows = numpy.repeat(
+            numpy.arange(self.shape[0], dtype=self.indices.dtype),
+            numpy.diff(self.indptr))
+        self.flat = self.rows.astype(numpy.int64) * self.shape[1] + \
+            self.indices
+        self.nnz = len(self.indices)
+
+    def csr(self, data):
+        return sparse.csr_matrix(
+            (data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def gather(self, a):
+        return a.ravel()[self.flat]
+
+    def scatter(self, data):
+        a = numpy.zeros(self.shape, dtype=data.dtype)
+        a.ravel()[self.flat] = data
+        return a
+
+    def sampled_dot(self, a, b, chunk_elements=2 ** 20):
+        """Entries of a.T.dot(b) only at positions in the pattern"""
+        a, b = numpy.ascontiguousarray(a.T), numpy.ascontiguousarray(b.T)
+        out = numpy.empty(self.nnz, dtype=numpy.result_type(a, b))
+        chunk = max(chunk_elements // max(a.shape[1], 1), 1)
+        for i in range(0, self.nnz, chunk):
+            rows = self.rows[i:i + chunk]
+            cols = self.indices[i:i + chunk]
+            numpy.einsum('ij,ij->i', a[rows], b[cols], out=out[i:i + chunk])
+        return out
+
+
+class SparseVDLinear(VDLinearWithLogAlpha):
+    """Linear function using variational dropout over a sparse pattern.
+
+    On CPU, products with the masked W and alpha * W ** 2 and
+    gradients w.r.t. them are computed only at positions in ``pattern``
+    (a :class:`SparsePattern`) by scipy CSR matrices.
+    On GPU, this is the same as :class:`VDLinearWithLogAlpha`.
+    Weights gathered over the pattern are not pooled
+    because their size changes whenever the pattern is rebuilt.
+    """
+
+    pooled = False
+
+    def __init__(self, pattern, loga_threshold=3., eps=1e-8,
+                 lower_threshold=-8., upper_threshold=8., log_alpha=None):
+        super(SparseVDLinear, self).__init__(
+            loga_threshold, eps, lower_threshold, upper_threshold,
+            log_alpha=log_alpha)
+        self.pattern = pattern
+
+    def _sparse_weights_cpu(self, W, log_sigma2):
+        pattern = self.pattern
+        full_log_alpha = self.log_alpha
+        self.log_alpha = None if full_log_alpha is None else \
+            pattern.gather(full_log_alpha)
+        try:
+            weights = self._weights_cpu(
+                pattern.gather(W), pattern.gather(log_sigma2),
+                out=self._weight_workspaces((pattern.nnz,), W.dtype))
+        finally:
+            self.log_alpha = full_log_alpha
+        return weights
+
+    def forward_cpu(self, inputs):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        clip_W, alpha_W2 = self._sparse_weights_cpu(W, log_sigma2)[3:]
+        y = self.pattern.csr(clip_W).dot(x.T).T
+        x2 = numpy.square(x, out=get_workspace_pool().get(
+            'vdla/x2', x.shape, x.dtype))
+        si = self.pattern.csr(alpha_W2).dot(x2.T).T
+        si += self.eps
+        numpy.sqrt(si, out=si)
+        si *= _sample_noise(self, y.shape, x.dtype, numpy)
+        y += si
+        if len(inputs) == 4:
+            y += inputs[3]
+        return numpy.ascontiguousarray(y, dtype=x.dtype),
+
+    def backward_cpu(self, inputs, gy):
+        x, W, log_sigma2 = inputs[:3]
+        x = _as_mat(x)
+        gy = gy[0]
+        W2, log_alpha, keep, clip_W, alpha_W2 = self._sparse_weights_cpu(
+            W, log_sigma2)
+        csr_clip_W = self.pattern.csr(clip_W)
+        csr_alpha_W2 = self.pattern.csr(alpha_W2)
+
+        x2 = numpy.square(x, out=get_workspace_pool().get(
+            'vdla/x2', x.shape, x.dtype))
+        gsi = csr_alpha_W2.dot(x2.T).T
+        gsi += self.eps
+        numpy.sqrt(gsi, out=gsi)
+        numpy.divide(0.5, gsi, out=gsi)
+        gsi *= gy
+        gsi *= _restore_noise(self, gy.shape, x.dtype, numpy)
+
+        gx = csr_alpha_W2.T.dot(gsi.T).T
+        gx *= x
+        gx *= 2.
+        gx += csr_clip_W.T.dot(gy.T).T
+        gx = gx.astype(x.dtype, copy=False).reshape(inputs[0].shape)
+
+        gW, glog_sigma2 = self._grad_params_cpu(
+            self.pattern.sampled_dot(gy, x), self.pattern.sampled_dot(gsi, x2),
+            W2, log_alpha, keep, clip_W, alpha_W2)
+        gW = self.pattern.scatter(gW.astype(W.dtype, copy=False))
+        glog_sigma2 = self.pattern.scatter(
+            glog_sigma2.astype(log_sigma2.dtype, copy=False))
+
+        if len(inputs) == 4:
+            gb = gy.sum(0)
+            return gx, gW, glog_sigma2, gb
+        else:
+            return gx, gW, glog_sigma2
+
+
+def vd_linear_with_log_alpha(x, W, b, log_sigma2, loga_threshold=3.,
+                             eps=1e-8, thresholds=(-8., 8.), log_alpha=None,
+                             sparse_pattern=None):
+    """Linear function using variational dropout from W and log sigma^2
+
+    ``log_alpha`` is an optional array (not Variable) of precomputed log alpha.
+    If ``sparse_pattern`` is given, :class:`SparseVDLinear` is used.
+    """
+    lower_threshold, upper_threshold = thresholds
+    train = configuration.config.train
+    if train:
+        if sparse_pattern is None:
+            func = VDLinearWithLogAlpha(
+                loga_threshold, eps, lower_threshold, upper_threshold,
+                log_alpha=log_alpha)
+        else:
+            func = SparseVDLinear(
+                sparse_pattern, loga_threshold, eps,
+                lower_threshold, upper_threshold, log_alpha=log_alpha)
+        if b is None:
+            return func(x, W, log_sigma2)
+        else:
+            return func(x, W, log_sigma2, b)
+    else:
+        if log_alpha is None:
+            log_alpha = calculate_log_alpha(
+                W, log_sigma2, eps=eps, thresholds=thresholds).data
+        clip_mask = (log_alpha > loga_threshold)
+        return F.linear(x, (1. - clip_mask) * W, b)
+
+
+def _pair(x):
+    if hasattr(x, '__getitem__'):
+        return x
+    return x, x
+
+
+class VDConvolution2D(VDLinearWithLogAlpha):
+    """Two-dimensional convolution function using variational dropout.
+
+    The mean and the variance are computed over one shared im2col of x
+    (the im2col of x * x is its square) with stacked weights,
+    i.e., both convolutions run as one batched matrix product.
+    This function is memory-efficient by recomputing in backward.
+    """
+
+    def __init__(self, stride=1, pad=0, loga_threshold=3., eps=1e-8,
+                 lower_threshold=-8., upper_threshold=8., log_alpha=None):
+        super(VDConvolution2D, self).__init__(
+            loga_threshold, eps, lower_threshold, upper_threshold,
+            log_alpha=log_alpha)
+        self.sy, self.sx = _pair(stride)
+        self.ph, self.pw = _pair(pad)
+
+    def _cols(self, x, kh, kw, xp):
+        # (2, n * out_h * out_w, c * kh * kw) stack of x and x * x columns
+        if xp is numpy:
+            col = conv.im2col_cpu(x, kh, kw, self.sy, self.sx,
+                                  self.ph, self.pw)
+        else:
+            col = conv.im2col_gpu(x, kh, kw, self.sy, self.sx,
+                                  self.ph, self.pw)
+        n, c, _, _, out_h, out_w = col.shape
+        cols = xp.empty((2, n, out_h, out_w, c, kh, kw), dtype=x.dtype)
+        cols[0] = col.transpose(0, 4, 5, 1, 2, 3)
+        del col
+        xp.square(cols[0], out=cols[1])
+        return cols.reshape(2, n * out_h * out_w, c * kh * kw), out_h, out_w
+
+    def _weights(self, W, log_sigma2, xp):
+        # (2, out_c, c * kh * kw) stack of masked W and alpha * W ** 2
+        if xp is numpy:
+            Ws = get_workspace_pool().get(
+                'vdconv/Ws', (2,) + W.shape, W.dtype)
+            weights = self._weights_cpu(W, log_sigma2, out=Ws)
+        else:
+            log_alpha = self._log_alpha_gpu(W, log_sigma2)
+            Ws = xp.stack(self._weights_gpu(W, log_alpha))
+            weights = (log_alpha, )
+        return Ws.reshape(2, W.shape[0], -1), weights
+
+    def forward(self, inputs):
+        x, W, log_sigma2 = inputs[:3]
+        xp = cuda.get_array_module(x)
+        n = x.shape[0]
+        out_c, _, kh, kw = W.shape
+        cols, out_h, out_w = self._cols(x, kh, kw, xp)
+        Ws = self._weights(W, log_sigma2, xp)[0]
+
+        mu_si = xp.matmul(cols, Ws.transpose(0, 2, 1))
+        del cols
+        y, si = mu_si
+        si += self.eps
+        xp.sqrt(si, out=si)
+        si *= _sample_noise(self, y.shape, x.dtype, xp)
+        y += si
+        if len(inputs) == 4:
+            y += inputs[3]
+        y = y.reshape(n, out_h, out_w, out_c).transpose(0, 3, 1, 2)
+        return xp.ascontiguousarray(y),
+
+    def backward(self, inputs, gy):
+        x, W, log_sigma2 = inputs[:3]
+        xp = cuda.get_array_module(x)
+        n, c, h, w = x.shape
+        out_c, _, kh, kw = W.shape
+        cols, out_h, out_w = self._cols(x, kh, kw, xp)
+        Ws, weights = self._weights(W, log_sigma2, xp)
+
+        gy = gy[0].transpose(0, 2, 3, 1).reshape(-1, out_c)
+        gmu_si = xp.empty((2, ) + gy.shape, dtype=gy.dtype)
+        gmu_si[0] = gy
+        gmu_si[1] = cols[1].dot(Ws[1].T)
+        gsi = gmu_si[1]
+        gsi += self.eps
+        xp.sqrt(gsi, out=gsi)
+        xp.divide(0.5, gsi, out=gsi)
+        gsi *= gy
+        gsi *= _restore_noise(self, gy.shape, x.dtype, xp)
+
+        # gradients w.r.t. masked W and alpha * W ** 2
+        gWs = xp.matmul(gmu_si.transpose(0, 2, 1), cols)
+
+        # gradients w.r.t. columns of x and x * x
+        gcols = xp.matmul(gmu_si, Ws)
+        gcol = cols[0]
+        gcol *= gcols[1]
+        gcol *= 2.
+        gcol += gcols[0]
+        del gcols
+        gcol = gcol.reshape(n, out_h, out_w, c, kh, kw).transpose(
+            0, 3, 4, 5, 1, 2)
+        if xp is numpy:
+            gx = conv.col2im_cpu(gcol, self.sy, self.sx,
+                                 self.ph, self.pw, h, w)
+        else:
+            gx = conv.col2im_gpu(gcol, self.sy, self.sx,
+                                 self.ph, self.pw, h, w)
+
+        gWs = gWs.reshape((2, ) + W.shape)
+        if xp is numpy:
+            W2, log_alpha, keep = weights[:3]
+            gW, glog_sigma2 = self._grad_params_cpu(
+                gWs[0], gWs[1], W2, log_alpha, keep, Ws[0].reshape(W.shape),
+                Ws[1].reshape(W.shape))
+        else:
+            gW, glog_sigma2 = self._grad_params_gpu(
+                gWs[0], gWs[1], W, weights[0])
+        gW = gW.astype(W.dtype, copy=False)
+        glog_sigma2 = glog_sigma2.astype(log_sigma2.dtype, copy=False)
+
+        if len(inputs) == 4:
+            gb = gy.sum(0)
+            return gx, gW, glog_sigma2, gb
+        else:
+            return gx, gW, glog_sigma2
+
+
+def vd_convolution_2d(x, W, b, log_sigma2, stride=1, pad=0,
+                      loga_threshold=3., eps=1e-8, thresholds=(-8., 8.),
+                      log_alpha=None):
+    """Convolution function using variational dropout from W and log sigma^2
+
+    ``log_alpha`` is an optional array (not Variable) of precomputed log alpha.
+    """
+    lower_threshold, upper_threshold = thresholds
+    train = configuration.config.train
+    if train:
+        func = VDConvolution2D(
+            stride, pad, loga_threshold, eps, lower_threshold, upper_threshold,
+            log_alpha=log_alpha)
+        if b is None:
+            return func(x, W, log_sigma2)
+        else:
+            return func(x, W, log_sigma2, b)
+    else:
+        if log_alpha is None:
+            log_alpha = calculate_log_alpha(
+                W, log_sigma2, eps=eps, thresholds=thresholds).data
+        clip_mask = (log_alpha > loga_threshold)
+        return F.convolution_2d(x, (1. - clip_mask) * W, b,
+                                stride=stride, pad=pad)
+
+
+class VDWeights(VDLinearWithLogAlpha):
+    """Masked W and alpha * W ** 2 of variational dropout as outputs.
+
+    This function computes both weights once so that
+    :class:`RNNVDLinear` can re-use them over timesteps of a sequence.
+    Their gradients accumulated over the timesteps are
+    propagated to W and log sigma^2 at once.
+    """
+
+    def forward_cpu(self, inputs):
+        W, log_sigma2 = inputs
+        return self._weights_cpu(W, log_sigma2)[3:]
+
+    def forward_gpu(self, inputs):
+        W, log_sigma2 = inputs
+        return self._weights_gpu(W, self._log_alpha_gpu(W, log_sigma2))
+
+    def backward(self, inputs, grad_outputs):
+        W, log_sigma2 = inputs
+        xp = cuda.get_array_module(W)
+        gclip_W, galpha_W2 = [
+            xp.zeros_like(W) if g is None else g for g in grad_outputs]
+        if xp is numpy:
+            W2, log_alpha, keep, clip_W, alpha_W2 = self._weights_cpu(
+                W, log_sigma2,
+                out=self._weight_workspaces(W.shape, W.dtype))
+            gW, glog_sigma2 = self._grad_params_cpu(
+                gclip_W.copy(), galpha_W2.copy(),
+                W2, log_alpha, keep, clip_W, alpha_W2)
+        else:
+            gW, glog_sigma2 = self._grad_params_gpu(
+                gclip_W, galpha_W2, W, self._log_alpha_gpu(W, log_sigma2))
+        gW = gW.astype(W.dtype, copy=False)
+        glog_sigma2 = glog_sigma2.astype(log_sigma2.dtype, copy=False)
+        return gW, glog_sigma2
+
+
+def vd_weights(W, log_sigma2, loga_threshold=3., eps=1e-8,
+               thresholds=(-8., 8.), log_alpha=None):
+    """Masked W and alpha * W ** 2 from W and log sigma^2
+
+    ``log_alpha`` is an optional array (not Variable) of precomputed log alpha.
+    """
+    lower_threshold, upper_threshold = thresholds
+    return VDWeights(loga_threshold, eps, lower_threshold, upper_threshold,
+                     log_alpha=log_alpha)(W, log_sigma2)
+
+
+class RNNVDLinear(function.Function):
+    """Linear function using variational dropout with given weights.
+
+    This function takes the masked W and alpha * W ** 2
+    computed by :func:`vd_weights` instead of W and log sigma^2,
+    so repeated calls, e.g., over timesteps, share them.
+    This function is memory-efficient by recomputing in backward.
+    """
+
+    def __init__(self, eps=1e-8):
+        self.eps = eps
+
+    def check_type_forward(self, in_types):
+        pass
+
+    def forward(self, inputs):
+        x, clip_W, alpha_W2 = inputs[:3]
+        xp = cuda.get_array_module(x)
+        x = _as_mat(x)
+        y = x.dot(clip_W.T)
+        si = xp.square(x).dot(alpha_W2.T)
+        si += self.eps
+        xp.sqrt(si, out=si)
+        si *= _sample_noise(self, y.shape, x.dtype, xp)
+        y += si
+        if len(inputs) == 4:
+            y += inputs[3]
+        return y,
+
+    def backward(self, inputs, gy):
+        x, clip_W, alpha_W2 = inputs[:3]
+        xp = cuda.get_array_module(x)
+        x = _as_mat(x)
+        gy = gy[0]
+
+        x2 = xp.square(x)
+        gsi = x2.dot(alpha_W2.T)
+        gsi += self.eps
+        xp.sqrt(gsi, out=gsi)
+        xp.divide(0.5, gsi, out=gsi)
+        gsi *= gy
+        gsi *= _restore_noise(self, gy.shape, x.dtype, xp)
+
+        gx = gsi.dot(alpha_W2)
+        gx *= x
+        gx *= 2.
+        gx += gy.dot(clip_W)
+        gx = gx.astype(x.dtype, copy=False).reshape(inputs[0].shape)
+        gclip_W = gy.T.dot(x).astype(clip_W.dtype, copy=False)
+        galpha_W2 = gsi.T.dot(x2).astype(alpha_W2.dtype, copy=False)
+
+        if len(inputs) == 4:
+            gb = gy.sum(0)
+            return gx, gclip_W, galpha_W2, gb
+        else:
+            return gx, gclip_W, galpha_W2
+
+
+def rnn_vd_linear(x, clip_W, alpha_W2, b=None, eps=1e-8):
+    """Linear function using variational dropout from weights of vd_weights
+    """
+    train = configuration.config.train
+    if train:
+        if b is None:
+            return RNNVDLinear(eps)(x, clip_W, alpha_W2)
+        else:
+            return RNNVDLinear(eps)(x, clip_W, alpha_W2, b)
+    else:
+        return F.linear(x, clip_W, b)
+
+
 if __name__ == '__main__':
     F = chainer.functions
     import time
@@ -504,6 +1710,28 @@ if __name__ == '__main__':
     for v1, v2 in zip(vs1, vs2):
         testing.assert_allclose(v1, v2, rtol=0.001)
 
+    print('### VD LINEAR WITH LOG ALPHA ###')
+    times = []
+    for i in range(10):
+        W.cleargrad()
+        b.cleargrad()
+        x.cleargrad()
+        log_sigma2.cleargrad()
+        xp.random.seed(777)
+        start = time.time()
+        y = vd_linear_with_log_alpha(x, W, b, log_sigma2, loga_threshold,
+                                     eps=1e-8, thresholds=(-8., 8.))
+        F.sum(y).backward()
+        vs3 = [y.data,
+               W.grad,
+               b.grad,
+               x.grad,
+               log_sigma2.grad]
+        times.append(time.time() - start)
+    print('fused', numpy.mean(times[5:]))
+    for v1, v3 in zip(vs1, vs3):
+        testing.assert_allclose(v1, v3, rtol=0.001)
+
     print('### KL ###')
     times = []
     for i in range(10):